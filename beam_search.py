@@ -0,0 +1,188 @@
+# Beam search with early termination and pruning
+import logging
+from collections import OrderedDict
+import numpy
+
+from blocks.search import BeamSearch
+
+logger = logging.getLogger(__name__)
+
+
+class PrunedBeamSearch(BeamSearch):
+    """Beam search which can stop early and prune hypotheses.
+
+    Without any policy, the search is that of BeamSearch, which expands
+    `beam_size` hypotheses until all of them are finished or the maximum
+    length is reached, finished hypotheses keeping their place in the
+    beam. With a policy, finished hypotheses leave the beam, and the
+    search stops once `beam_size` of them are found. The policies are:
+
+    * early termination: the search stops once the best finished
+      hypothesis cannot be beaten by any live one, whose costs can only
+      grow. With length normalization, a live hypothesis is bounded by
+      its current cost divided by the normalized maximum length.
+    * beam shrinking: the beam loses a place for every finished
+      hypothesis, as in the original RNNsearch beam search.
+    * relative threshold pruning: a word is not considered when its
+      probability is less than `relative_threshold` times that of the
+      best word following the same hypothesis.
+    * absolute threshold pruning: a hypothesis is dropped when its cost
+      exceeds that of the best one of the same step by more than
+      `absolute_threshold`.
+
+    The returned costs are divided by the length of the hypotheses to
+    the power `length_normalization`, so that the n-best hypotheses can
+    be chosen by sorting them.
+
+    When decoding with a shortlist, the word probabilities only span the
+    words of the shortlist, and the positions chosen in them are mapped
+    back to word indices, both for the next states and the hypotheses.
+
+    Parameters
+    ----------
+    beam_size : int
+        The size of the beam.
+    samples : Theano variable
+        The samples of the sequence generator, as for BeamSearch.
+    length_normalization : float
+        The exponent of the length the costs are divided by, 0 for the
+        raw costs.
+    early_stop : bool
+        Whether to stop once the best finished hypothesis is known.
+    shrink : bool
+        Whether to shrink the beam as hypotheses finish.
+    relative_threshold : float, optional
+        The ratio of word probabilities under which words are pruned.
+    absolute_threshold : float, optional
+        The cost difference over which hypotheses are pruned.
+
+    """
+    def __init__(self, beam_size, samples, length_normalization=0.,
+                 early_stop=False, shrink=False, relative_threshold=None,
+                 absolute_threshold=None):
+        super(PrunedBeamSearch, self).__init__(beam_size, samples)
+        self.length_normalization = length_normalization
+        self.early_stop = early_stop
+        self.shrink = shrink
+        self.relative_threshold = relative_threshold
+        self.absolute_threshold = absolute_threshold
+        self.words = None
+
+    @property
+    def pruned(self):
+        return (self.early_stop or self.shrink or
+                self.relative_threshold is not None or
+                self.absolute_threshold is not None)
+
+    def _normalize(self, costs, lengths):
+        return (numpy.asarray(costs, dtype='float64') /
+                numpy.asarray(lengths, dtype='float64') **
+                self.length_normalization)
+
+    def compute_next_states(self, contexts, states, outputs):
+        if self.words is not None:
+            outputs = self.words[outputs]
+        return super(PrunedBeamSearch, self).compute_next_states(
+            contexts, states, outputs)
+
+    def search(self, input_values, eol_symbol, max_length,
+               ignore_first_eol=False, words=None):
+        """Returns the hypotheses, with their end of line, and costs.
+
+        The input values must hold `beam_size` copies of the input, as
+        for BeamSearch. With a shortlist, `words` are its sorted word
+        indices, those of the columns of the word probabilities.
+
+        """
+        self.words = words
+        if words is None:
+            return self._search(input_values, eol_symbol, max_length,
+                                ignore_first_eol)
+        eol_position = numpy.searchsorted(words, eol_symbol)
+        if eol_position == len(words) or words[eol_position] != eol_symbol:
+            raise ValueError("The end of line is not in the shortlist")
+        outputs, costs = self._search(input_values, eol_position,
+                                      max_length, ignore_first_eol)
+        return [words[numpy.asarray(output, dtype='int64')].tolist()
+                for output in outputs], costs
+
+    def _search(self, input_values, eol_symbol, max_length,
+                ignore_first_eol):
+        if not self.pruned:
+            outputs, costs = super(PrunedBeamSearch, self).search(
+                input_values, eol_symbol, max_length,
+                ignore_first_eol=ignore_first_eol)
+            return outputs, self._normalize(
+                costs, [max(len(output), 1) for output in outputs])
+
+        if not self.compiled:
+            self.compile()
+
+        # The columns of the contexts are copies, the beam starts with one
+        contexts = self.compute_contexts(input_values)
+
+        def take(n):
+            return OrderedDict((name, value[:, :n])
+                               for name, value in contexts.items())
+        states = OrderedDict((name, value[:1]) for name, value
+                             in self.compute_initial_states(contexts).items())
+        live_outputs = numpy.zeros((0, 1), dtype='int64')
+        live_costs = numpy.zeros(1)
+        finished, finished_costs = [], []
+
+        for i in range(max_length):
+            word_costs = self.compute_logprobs(take(len(live_costs)), states)
+            if self.relative_threshold is not None:
+                word_costs = numpy.where(
+                    word_costs > word_costs.min(axis=1)[:, None] -
+                    numpy.log(self.relative_threshold),
+                    numpy.inf, word_costs)
+            next_costs = live_costs[:, None] + word_costs
+            if self.absolute_threshold is not None:
+                next_costs[next_costs > next_costs.min() +
+                           self.absolute_threshold] = numpy.inf
+
+            beam_size = self.beam_size
+            if self.shrink:
+                beam_size -= len(finished)
+            (indexes, outputs), chosen_costs = self._smallest(next_costs,
+                                                              beam_size)
+            chosen = numpy.isfinite(chosen_costs)
+            indexes, outputs = indexes[chosen], outputs[chosen]
+            chosen_costs = chosen_costs[chosen]
+            live_outputs = numpy.vstack([live_outputs[:, indexes],
+                                         outputs[None, :]])
+
+            # Finished hypotheses leave the beam
+            ended = outputs == eol_symbol
+            if ignore_first_eol and i == 0:
+                ended[:] = False
+            for j in numpy.where(ended)[0]:
+                finished.append(live_outputs[:, j].tolist())
+                finished_costs.append(chosen_costs[j])
+            live = ~ended
+            indexes, outputs = indexes[live], outputs[live]
+            live_outputs = live_outputs[:, live]
+            live_costs = chosen_costs[live]
+            if not len(live_costs) or len(finished) >= self.beam_size:
+                break
+            if self.early_stop and finished:
+                best = self._normalize(finished_costs,
+                                       map(len, finished)).min()
+                bound = live_costs.min() / max_length ** \
+                    self.length_normalization
+                if best <= bound:
+                    break
+
+            for name in states:
+                states[name] = states[name][indexes]
+            states.update(self.compute_next_states(take(len(indexes)),
+                                                   states, outputs))
+
+        # Without any finished hypothesis, the live ones are returned
+        if not finished:
+            finished = live_outputs.T.tolist()
+            finished_costs = live_costs.tolist()
+        return finished, self._normalize(finished_costs,
+                                         [max(len(hypothesis), 1)
+                                          for hypothesis in finished])
@@ -0,0 +1,1030 @@
+# Micro benchmarks for the expensive parts of the model, run e.g.
+#   python benchmark.py softmax --vocab-sizes 10000 40000 200000
+import argparse
+import cPickle
+import importlib
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy
+import theano
+from theano import tensor
+
+from blocks.bricks import Linear
+from blocks.bricks.lookup import LookupTable
+from blocks.bricks.parallel import Fork
+from blocks.bricks.sequence_generators import SoftmaxEmitter
+from blocks.graph import ComputationGraph, apply_noise
+from blocks.initialization import IsotropicGaussian, Constant, Orthogonal
+from blocks.model import Model
+from blocks.utils import shared_floatx_zeros
+
+from config import write_derived_config
+from embeddings import FactorizedLookupTable, HashedLookupTable
+from emitters import (build_word_classes, ClassSoftmaxEmitter,
+                      SampledSoftmaxEmitter, ShortlistLinear)
+from fork import FusedFork
+from subtensor_gradient import apply_sparse_noise
+
+logger = logging.getLogger(__name__)
+
+
+def import_model(proto='get_config_wmt15_fi_en_TEST'):
+    """Imports model, which parses the command line, with a clean one."""
+    argv = sys.argv
+    sys.argv = [argv[0], '--proto', proto]
+    try:
+        import model
+    finally:
+        sys.argv = argv
+    return model
+
+
+def time_function(function, inputs, n_calls):
+    """Average wall time of a compiled function, after one warm up call."""
+    function(*inputs)
+    start = time.time()
+    for _ in range(n_calls):
+        function(*inputs)
+    return (time.time() - start) / n_calls
+
+
+def zipf_indices(rng, vocab_size, shape, a=1.1):
+    """Word indices with the rank/frequency profile of natural text."""
+    return numpy.minimum(rng.zipf(a, shape) - 1, vocab_size - 1)
+
+
+def peak_memory():
+    """Peak resident memory of the process in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def sgd_function(inputs, cost, learning_rate=0.01):
+    """Compiles a plain gradient step, the cheapest full training step."""
+    params = ComputationGraph(cost).parameters
+    grads = tensor.grad(cost, params)
+    return theano.function(
+        inputs, cost,
+        updates=[(p, p - learning_rate * g) for p, g in zip(params, grads)])
+
+
+def _initialize(brick):
+    brick.weights_init = IsotropicGaussian(0.01)
+    brick.biases_init = Constant(0)
+    brick.initialize()
+
+
+def benchmark_softmax(args):
+    """Time per batch of the output layer for every emitter and vocab."""
+    rng = numpy.random.RandomState(1234)
+    readouts = tensor.tensor3('readouts')
+    outputs = tensor.lmatrix('outputs')
+
+    print "{:>10} {:>10} {:>12}".format('vocab', 'softmax', 'sec/batch')
+    for vocab_size in args.vocab_sizes:
+        readouts_value = rng.normal(
+            size=(args.seq_len, args.batch_size, args.embed)).astype(
+                theano.config.floatX)
+        outputs_value = zipf_indices(
+            rng, vocab_size, (args.seq_len, args.batch_size))
+        for softmax in args.softmax:
+            if softmax == 'full':
+                projection = Linear(input_dim=args.embed,
+                                    output_dim=vocab_size, name='softmax1')
+                _initialize(projection)
+                cost = SoftmaxEmitter().cost(
+                    projection.apply(readouts), outputs)
+            elif softmax == 'sampled':
+                emitter = SampledSoftmaxEmitter(vocab_size, args.samples)
+                emitter.readout_dim = args.embed
+                _initialize(emitter)
+                cost = emitter.cost(readouts, outputs)
+            elif softmax == 'class':
+                # Word indices are already sorted by frequency
+                emitter = ClassSoftmaxEmitter(build_word_classes(
+                    numpy.arange(vocab_size)[::-1]))
+                emitter.readout_dim = args.embed
+                _initialize(emitter)
+                cost = emitter.cost(readouts, outputs)
+            function = sgd_function([readouts, outputs], cost.mean())
+            print "{:>10} {:>10} {:>12.4f}".format(
+                vocab_size, softmax,
+                time_function(function, [readouts_value, outputs_value],
+                              args.n_calls))
+
+
+def benchmark_shortlist(args):
+    """Time per beam search step of the output layer versus shortlist."""
+    rng = numpy.random.RandomState(1234)
+    readouts = tensor.matrix('readouts')
+    readouts_value = rng.normal(size=(args.beam_size, args.embed)).astype(
+        theano.config.floatX)
+
+    projection = ShortlistLinear(use_shortlist=True, input_dim=args.embed,
+                                 output_dim=args.vocab_size, name='softmax1')
+    _initialize(projection)
+    full = theano.function(
+        [readouts], tensor.nnet.softmax(
+            tensor.dot(readouts, projection.W) + projection.b))
+    restricted = theano.function(
+        [readouts], tensor.nnet.softmax(projection.apply(readouts)))
+
+    print "{:>10} {:>12}".format('shortlist', 'sec/step')
+    print "{:>10} {:>12.6f}".format(
+        'full', time_function(full, [readouts_value], args.n_calls))
+    for size in args.shortlist_sizes:
+        projection.set_shortlist(numpy.sort(rng.choice(
+            args.vocab_size, size, replace=False)).astype('int64'))
+        print "{:>10} {:>12.6f}".format(
+            size, time_function(restricted, [readouts_value], args.n_calls))
+
+
+def benchmark_subtensor(args):
+    """Merging of repeated lookup gradients, dense buffer versus compact.
+
+    The compact merge runs first, since only the growth of the peak
+    resident memory of the process can be attributed to a method.
+    """
+    rng = numpy.random.RandomState(1234)
+    indices = tensor.lvector('indices')
+    gradients = tensor.matrix('gradients')
+    indices_value = zipf_indices(rng, args.vocab_size, (args.n_indices,))
+    gradients_value = rng.normal(size=(args.n_indices, args.embed)).astype(
+        theano.config.floatX)
+
+    canonized, positions = tensor.extra_ops.Unique(return_inverse=True)(
+        indices)
+    compact = tensor.inc_subtensor(
+        tensor.zeros((canonized.shape[0], args.embed),
+                     dtype=theano.config.floatX)[positions], gradients)
+    buffer_ = shared_floatx_zeros((args.vocab_size, args.embed))
+    dense = tensor.inc_subtensor(buffer_[indices], gradients)[canonized]
+
+    print "{:>10} {:>12} {:>14}".format('merge', 'sec/step', 'peak MB +')
+    for name, merged in [('compact', compact), ('dense', dense)]:
+        function = theano.function([indices, gradients], merged.norm(2))
+        before = peak_memory()
+        seconds = time_function(function, [indices_value, gradients_value],
+                                args.n_calls)
+        print "{:>10} {:>12.6f} {:>14.1f}".format(
+            name, seconds, peak_memory() - before)
+
+
+def benchmark_noise(args):
+    """Training step of an embedding table with dense or sparse noise."""
+    rng = numpy.random.RandomState(1234)
+    indices = tensor.lmatrix('indices')
+    indices_value = zipf_indices(rng, args.vocab_size,
+                                 (args.seq_len, args.batch_size))
+
+    print "{:>10} {:>12}".format('noise', 'sec/step')
+    for noise in ['none', 'dense', 'sparse']:
+        lookup = LookupTable(args.vocab_size, args.embed, name='embeddings')
+        _initialize(lookup)
+        cg = ComputationGraph(tensor.sqr(lookup.apply(indices)).mean())
+        if noise == 'dense':
+            cg = apply_noise(cg, [lookup.W], args.level)
+        elif noise == 'sparse':
+            cg = apply_sparse_noise(cg, [lookup], args.level)
+        function = sgd_function([indices], cg.outputs[0])
+        print "{:>10} {:>12.6f}".format(
+            noise, time_function(function, [indices_value], args.n_calls))
+
+
+def benchmark_encoder(args):
+    """Encoder time per batch versus source length, two scans or one.
+
+    The fused encoder gets the parameters of the unfused one, and both
+    must give the same representations and gradients, for sentences of
+    random lengths, before they are timed.
+
+    """
+    model = import_model()
+    rng = numpy.random.RandomState(1234)
+    source = tensor.lmatrix('source')
+    source_mask = tensor.matrix('source_mask')
+
+    encoders = {}
+    checks = {}
+    for fused in [False, True]:
+        encoder = model.BidirectionalEncoder(
+            args.vocab_size, args.embed, args.nhids, fused=fused)
+        encoder.weights_init = IsotropicGaussian(0.01)
+        encoder.biases_init = Constant(0)
+        encoder.push_initialization_config()
+        encoder.bidir.prototype.weights_init = Orthogonal()
+        encoder.initialize()
+        representation = encoder.apply(source, source_mask)
+        params = Model(representation).get_params()
+        if fused:
+            for name, param in params.items():
+                param.set_value(unfused_params[name].get_value())
+        else:
+            unfused_params = params
+        names = sorted(params)
+        checks[fused] = theano.function(
+            [source, source_mask],
+            [representation] + tensor.grad(representation.mean(),
+                                           [params[name] for name in names]))
+        encoders[fused] = (
+            theano.function([source, source_mask], representation),
+            sgd_function([source, source_mask], representation.mean()))
+
+    for length in args.lengths:
+        source_value = zipf_indices(rng, args.vocab_size,
+                                    (args.batch_size, length))
+        mask_value = (numpy.arange(length)[None, :] < rng.randint(
+            1, length + 1, size=(args.batch_size, 1))).astype(
+                theano.config.floatX)
+        outputs = [checks[fused](source_value, mask_value)
+                   for fused in [False, True]]
+        for name, unfused, fused in zip(['representation'] + names,
+                                        *outputs):
+            if not numpy.allclose(unfused, fused, atol=1e-6):
+                raise ValueError(
+                    "The fused encoder differs on {} for length {}, by up "
+                    "to {}".format(name, length,
+                                   numpy.abs(unfused - fused).max()))
+
+    print "{:>8} {:>8} {:>12} {:>12}".format(
+        'length', 'fused', 'sec/forward', 'sec/step')
+    for length in args.lengths:
+        source_value = zipf_indices(rng, args.vocab_size,
+                                    (args.batch_size, length))
+        mask_value = numpy.ones((args.batch_size, length),
+                                dtype=theano.config.floatX)
+        for fused in [False, True]:
+            forward, step = encoders[fused]
+            print "{:>8} {:>8} {:>12.6f} {:>12.6f}".format(
+                length, fused,
+                time_function(forward, [source_value, mask_value],
+                              args.n_calls),
+                time_function(step, [source_value, mask_value],
+                              args.n_calls))
+
+
+def benchmark_fork(args):
+    """Training step of the GRU input projections, Fork or FusedFork."""
+    rng = numpy.random.RandomState(1234)
+    embeddings = tensor.tensor3('embeddings')
+    embeddings_value = rng.normal(
+        size=(args.seq_len, args.batch_size, args.embed)).astype(
+            theano.config.floatX)
+    names = ['inputs', 'update_inputs', 'reset_inputs']
+
+    print "{:>10} {:>12}".format('fork', 'sec/step')
+    for fork in [Fork(names, prototype=Linear()), FusedFork(names)]:
+        fork.input_dim = args.embed
+        fork.output_dims = [args.nhids for _ in names]
+        _initialize(fork)
+        cost = sum(output.mean() for output in fork.apply(embeddings))
+        function = sgd_function([embeddings], cost)
+        print "{:>10} {:>12.6f}".format(
+            fork.__class__.__name__,
+            time_function(function, [embeddings_value], args.n_calls))
+
+
+def readout_flops(vocab_size, embed, enc_nhids, dec_nhids):
+    """Floating point operations of the readout stage per target position.
+
+    Counts the merge of the decoder states, feedback and glimpses, the
+    maxout, the two output projections and the softmax.
+    """
+    merge = 2 * (dec_nhids + embed + 2 * enc_nhids) * dec_nhids
+    maxout = 2 * dec_nhids
+    softmax0 = 2 * (dec_nhids / 2) * embed
+    softmax1 = 2 * embed * vocab_size
+    return merge + maxout + softmax0 + softmax1 + 3 * vocab_size
+
+
+def batch_lengths(args, rng):
+    """Target lengths of sorted batches, as built by stream_fi_en."""
+    if args.trg_data:
+        lengths = [len(line.split()) + 1 for line in open(args.trg_data)]
+        lengths = numpy.asarray(
+            [length for length in lengths if length <= args.seq_len + 1])
+    else:
+        lengths = numpy.minimum(
+            rng.lognormal(3., .5, size=args.n_sentences).astype('int64') + 1,
+            args.seq_len)
+    window = args.batch_size * args.sort_k_batches
+    for start in range(0, len(lengths) - window + 1, window):
+        sorted_lengths = numpy.sort(lengths[start:start + window])
+        for batch in range(args.sort_k_batches):
+            yield sorted_lengths[batch * args.batch_size:
+                                 (batch + 1) * args.batch_size]
+
+
+def benchmark_packing(args):
+    """Readout FLOPs saved by packing, versus the padding ratio."""
+    rng = numpy.random.RandomState(1234)
+    flops = readout_flops(args.vocab_size, args.embed, args.nhids, args.nhids)
+    ratios = []
+    print "{:>8} {:>8} {:>14} {:>14}".format(
+        'maxlen', 'padding', 'GFLOP padded', 'GFLOP packed')
+    for i, lengths in enumerate(batch_lengths(args, rng)):
+        padded = lengths.max() * len(lengths)
+        ratios.append(1. - lengths.sum() / float(padded))
+        if i < args.n_print:
+            print "{:>8} {:>8.3f} {:>14.2f} {:>14.2f}".format(
+                lengths.max(), ratios[-1], flops * padded / 1e9,
+                flops * lengths.sum() / 1e9)
+    print "Mean padding ratio over {} batches: {:.3f}".format(
+        len(ratios), numpy.mean(ratios))
+
+
+def attention_step(args):
+    """Times one decoder training step, in this process."""
+    model = import_model()
+    rng = numpy.random.RandomState(1234)
+    representation = tensor.tensor3('representation')
+    source_mask = tensor.matrix('source_mask')
+    target = tensor.lmatrix('target')
+    target_mask = tensor.matrix('target_mask')
+
+    decoder = model.Decoder(args.vocab_size, args.embed, args.nhids,
+                            2 * args.nhids, attention=args.attention[0],
+                            attention_window=args.window)
+    decoder.weights_init = IsotropicGaussian(0.01)
+    decoder.biases_init = Constant(0)
+    decoder.push_initialization_config()
+    decoder.transition.weights_init = Orthogonal()
+    decoder.initialize()
+    inputs = [representation, source_mask, target, target_mask]
+    function = sgd_function(inputs, decoder.cost(*inputs))
+
+    shape = (args.batch_size, args.length)
+    values = [rng.normal(size=(args.length, args.batch_size,
+                               2 * args.nhids)).astype(theano.config.floatX),
+              numpy.ones(shape, dtype=theano.config.floatX),
+              zipf_indices(rng, args.vocab_size, shape),
+              numpy.ones(shape, dtype=theano.config.floatX)]
+    print "{:>8} {:>8} {:>12.6f} {:>12.1f}".format(
+        args.length, args.attention[0],
+        time_function(function, values, args.n_calls), peak_memory())
+
+
+def benchmark_attention(args):
+    """Decoder step time and memory versus length, global or local."""
+    if args.length:
+        attention_step(args)
+        return
+
+    # Every step runs in its own process for its peak memory
+    print "{:>8} {:>8} {:>12} {:>12}".format(
+        'length', 'mode', 'sec/step', 'peak MB')
+    sys.stdout.flush()
+    for length in args.lengths:
+        for attention in args.attention:
+            subprocess.check_call(
+                [sys.executable, sys.argv[0], 'attention',
+                 '--length', str(length), '--attention', attention,
+                 '--window', str(args.window),
+                 '--vocab-size', str(args.vocab_size),
+                 '--embed', str(args.embed), '--nhids', str(args.nhids),
+                 '--batch-size', str(args.batch_size),
+                 '--n-calls', str(args.n_calls)])
+
+
+def benchmark_embeddings(args):
+    """Size and training step of the source embeddings of a config.
+
+    The step is a plain dense gradient step on the embeddings of a batch,
+    as without the subtensor fix. AdaDelta keeps two more copies of the
+    parameters and dumps one.
+    """
+    config = import_model(args.proto).config
+    rng = numpy.random.RandomState(1234)
+    vocab_size, embed = config['src_vocab_size'], config['enc_embed']
+    indices = tensor.lmatrix('indices')
+    indices_value = zipf_indices(rng, vocab_size,
+                                 (config['seq_len'], config['batch_size']))
+    bricks = {
+        'full': LookupTable(name='embeddings'),
+        'hashed': HashedLookupTable(
+            n_buckets=config['enc_embed_buckets'],
+            n_hashes=config['enc_embed_hashes'],
+            n_frequent=config['enc_embed_frequent'], name='embeddings'),
+        'factorized': FactorizedLookupTable(
+            rank=config['enc_embed_rank'], name='embeddings')}
+
+    print "{:>12} {:>12} {:>10} {:>12}".format(
+        'embeddings', 'parameters', 'MB', 'sec/step')
+    for name in args.embeddings:
+        lookup = bricks[name]
+        lookup.length = vocab_size
+        lookup.dim = embed
+        _initialize(lookup)
+        cost = tensor.sqr(lookup.apply(indices)).mean()
+        params = ComputationGraph(cost).parameters
+        size = sum(param.get_value().size for param in params)
+        function = sgd_function([indices], cost)
+        print "{:>12} {:>12} {:>10.1f} {:>12.6f}".format(
+            name, size, size * numpy.dtype(theano.config.floatX).itemsize /
+            2. ** 20, time_function(function, [indices_value], args.n_calls))
+
+
+def synthetic_corpus(directory, config, n_sentences, n_dev, rng):
+    """Writes Zipfian parallel text and vocabularies for a config.
+
+    Words are named by their frequency rank, ranks are drawn from a Zipf
+    distribution over 20% more words than the vocabulary, so that some
+    of them are unknown, and source lengths are lognormal with target
+    lengths about 10% longer. Returns the config entries of the files.
+    """
+    paths = {}
+    for side in ['src', 'trg']:
+        vocab_size = config[side + '_vocab_size']
+        vocab = {'<S>': 0, '</S>': 0, '<UNK>': 1}
+        vocab.update(('w{}'.format(i), i) for i in range(2, vocab_size - 1))
+        paths[side + '_vocab'] = os.path.join(directory,
+                                              'vocab.{}.pkl'.format(side))
+        cPickle.dump(vocab, open(paths[side + '_vocab'], 'wb'),
+                     protocol=cPickle.HIGHEST_PROTOCOL)
+
+    def write(path, lengths, vocab_size):
+        with open(path, 'w') as text:
+            for length in lengths:
+                words = zipf_indices(rng, int(1.2 * vocab_size), (length,))
+                print >> text, ' '.join('w{}'.format(word + 2)
+                                        for word in words)
+
+    for name, n in [('data', n_sentences), ('dev', n_dev)]:
+        src_lengths = numpy.clip(
+            rng.lognormal(2.8, .5, size=n).astype('int64'), 1, 80)
+        trg_lengths = numpy.maximum(
+            1, (src_lengths * rng.normal(1.1, .1, size=n)).astype('int64'))
+        for side, lengths in [('src', src_lengths), ('trg', trg_lengths)]:
+            path = os.path.join(directory, '{}.{}'.format(name, side))
+            write(path, lengths, config[side + '_vocab_size'])
+            paths[side + '_' + name] = path
+    return {'src_vocab': paths['src_vocab'], 'trg_vocab': paths['trg_vocab'],
+            'src_data': paths['src_data'], 'trg_data': paths['trg_data'],
+            'val_set': paths['src_dev'],
+            'val_set_grndtruth': paths['trg_dev']}
+
+
+def run_suite(args, proto):
+    """Times every stage of training on synthetic data with a config."""
+    from sampling import BleuValidator
+    model = import_model(proto)
+    config = model.config
+    rng = numpy.random.RandomState(1234)
+    directory = os.path.join(args.workdir or tempfile.mkdtemp(), proto)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    logger.info("Writing synthetic data to {}".format(directory))
+
+    # The validator only runs when called below, the loop ends with a dump
+    config.update(synthetic_corpus(directory, config, args.n_sentences,
+                                   args.n_dev, rng))
+    config.update({
+        'src_eos_idx': config['src_vocab_size'] - 1,
+        'trg_eos_idx': config['trg_vocab_size'] - 1,
+        'saveto': os.path.join(directory, 'model'),
+        'val_set_out': os.path.join(directory, 'dev.out'),
+        'reload': False, 'finish_after': args.n_batches,
+        'sampling_freq': 1, 'save_freq': args.n_batches,
+        'bleu_val_freq': args.n_batches + 1, 'val_burn_in': 0,
+        'profile_freq': args.n_batches})
+    if args.bleu_script:
+        config['bleu_script'] = args.bleu_script
+    stream = importlib.import_module(config['stream'])
+    results = {}
+
+    iterator = stream.masked_stream.get_epoch_iterator()
+    start = time.time()
+    for _ in range(args.n_batches):
+        next(iterator)
+    results['stream_batch_sec'] = (time.time() - start) / args.n_batches
+
+    # Training, sampling and dumping times are recorded by the profiler,
+    # the first batch is left out
+    main_loop = model.main(config, stream.masked_stream, stream.dev_stream)
+    rows = [main_loop.log[i] for i in range(2, args.n_batches + 1)]
+    for name, entry, reduction in [
+            ('train_step_sec', 'profile_compute', numpy.mean),
+            ('data_sec', 'profile_data', numpy.mean),
+            ('sampler_sec', 'profile_Sampler', numpy.mean),
+            ('dump_sec', 'profile_DumpWMT15', numpy.max),
+            ('words_per_sec', 'profile_words_per_sec', numpy.mean)]:
+        results[name] = float(reduction([row[entry] for row in rows]))
+
+    start = time.time()
+    model.MainLoopDumpManagerWMT15(config['saveto']).load_to(main_loop,
+                                                             strict=True)
+    results['load_sec'] = time.time() - start
+
+    # Beam search of the validator, per sentence
+    validator, = [extension for extension in main_loop.extensions
+                  if isinstance(extension, BleuValidator)]
+    iterator = stream.dev_stream.get_epoch_iterator()
+    start = time.time()
+    for _ in range(args.n_beam):
+        line = next(iterator)
+        line[0][-1] = config['src_eos_idx']
+        validator._search(validator._oov_to_unk(line[0]))
+    results['beam_search_sec'] = (time.time() - start) / args.n_beam
+
+    # Scoring of the whole dev set with multi-bleu.perl
+    results['bleu_sec'] = None
+    if os.path.isfile(config['bleu_script']):
+        start = time.time()
+        subprocess.check_output(
+            ['perl', config['bleu_script'], config['val_set_grndtruth']],
+            stdin=open(config['val_set_grndtruth']))
+        results['bleu_sec'] = time.time() - start
+    return results
+
+
+def benchmark_suite(args):
+    """Times the stages of training on synthetic corpora, into JSON.
+
+    Every config runs in its own process, since the model and stream
+    modules are configured when they are imported.
+    """
+    if len(args.protos) == 1:
+        results = {args.protos[0]: run_suite(args, args.protos[0])}
+    else:
+        results = {}
+        for proto in args.protos:
+            handle, output = tempfile.mkstemp(suffix='.json')
+            os.close(handle)
+            command = [sys.executable, sys.argv[0], 'suite',
+                       '--protos', proto, '--output', output,
+                       '--n-batches', str(args.n_batches),
+                       '--n-sentences', str(args.n_sentences),
+                       '--n-dev', str(args.n_dev),
+                       '--n-beam', str(args.n_beam)]
+            for option in ['bleu_script', 'workdir']:
+                if getattr(args, option):
+                    command += ['--' + option.replace('_', '-'),
+                                getattr(args, option)]
+            subprocess.check_call(command)
+            results.update(json.load(open(output)))
+            os.remove(output)
+    json.dump(results, open(args.output, 'w'), indent=2, sort_keys=True)
+    logger.info("Results written to {}".format(args.output))
+
+
+def benchmark_compare(args):
+    """Flags the stages of a suite run slower than in a previous one."""
+    old = json.load(open(args.old))
+    new = json.load(open(args.new))
+    regressions = 0
+    print "{:>32} {:>20} {:>12} {:>12} {:>8}".format(
+        'proto', 'stage', 'old', 'new', 'change')
+    for proto in sorted(set(old) & set(new)):
+        for stage in sorted(set(old[proto]) & set(new[proto])):
+            before, after = old[proto][stage], new[proto][stage]
+            if not before or after is None:
+                continue
+            change = after / before - 1
+            # Throughputs regress when they decrease, times when they grow
+            slower = -change if stage.endswith('per_sec') else change
+            flag = ''
+            if slower > args.threshold:
+                regressions += 1
+                flag = ' REGRESSION'
+            print "{:>32} {:>20} {:>12.6g} {:>12.6g} {:>+7.1%}{}".format(
+                proto, stage, before, after, change, flag)
+    print "{} regressions over {:.0%}".format(regressions, args.threshold)
+    sys.exit(1 if regressions else 0)
+
+
+def benchmark_record(args):
+    """Records the training batches of a config for replay."""
+    from replay import record_batches
+    config = import_model(args.proto).config
+    stream = importlib.import_module(config['stream'])
+    start = time.time()
+    n_batches = record_batches(
+        stream.masked_stream, args.output,
+        max(config['src_vocab_size'], config['trg_vocab_size']),
+        n_batches=args.n_batches)
+    print "{} batches, {:.1f} MB, recorded in {:.1f} sec".format(
+        n_batches, os.path.getsize(args.output) / 2. ** 20,
+        time.time() - start)
+
+
+def benchmark_replay(args):
+    """Times training steps on recorded batches, without text pipeline.
+
+    Sampling, validation and dumps are disabled, so that the times are
+    those of the model and the optimizer only.
+    """
+    from replay import BatchReplay
+    model = import_model(args.proto)
+    config = model.config
+    n_batches = len(BatchReplay(args.batches).index)
+    if args.n_batches:
+        n_batches = min(n_batches, args.n_batches)
+    config.update({
+        'replay_batches': args.batches, 'saveto': tempfile.mkdtemp(),
+        'reload': False, 'finish_after': n_batches,
+        'sampling_freq': n_batches + 1, 'bleu_val_freq': n_batches + 1,
+        'save_freq': n_batches + 1, 'ppl_val_freq': None,
+        'profile_freq': n_batches})
+    stream = importlib.import_module(config['stream'])
+    main_loop = model.main(config, stream.masked_stream, stream.dev_stream)
+
+    # The first batch, which includes the compilation, is left out
+    rows = [main_loop.log[i] for i in range(2, n_batches + 1)]
+    for name, entry in [('train step sec', 'profile_compute'),
+                        ('data sec', 'profile_data'),
+                        ('words per sec', 'profile_words_per_sec')]:
+        values = [row[entry] for row in rows]
+        print "{:>16} {:>12.6g} +- {:.3g}".format(
+            name, numpy.mean(values), numpy.std(values))
+
+
+def autotune_setting(args):
+    """Training throughput and peak memory of the setting of `args`.
+
+    The peak is that of a training step on a batch of `batch_size`
+    sentences of the maximum length, as estimated by the memory profiler
+    of Theano, instead of that of the whole process, which includes the
+    compilation and is never reset.
+    """
+    from memory_profile import profile_memory
+    model = import_model(args.proto)
+    config = model.config
+    directory = tempfile.mkdtemp()
+    if not args.real_data:
+        config.update(synthetic_corpus(directory, config, args.n_sentences,
+                                       1, numpy.random.RandomState(1234)))
+        config.update({'src_eos_idx': config['src_vocab_size'] - 1,
+                       'trg_eos_idx': config['trg_vocab_size'] - 1})
+    config.update({
+        'batch_size': args.batch_size, 'sort_k_batches': args.sort_k_batches,
+        'saveto': os.path.join(directory, 'model'), 'reload': False,
+        'finish_after': args.n_batches,
+        'sampling_freq': args.n_batches + 1,
+        'bleu_val_freq': args.n_batches + 1,
+        'save_freq': args.n_batches + 1, 'ppl_val_freq': None,
+        'profile_freq': args.n_batches})
+    stream = importlib.import_module(config['stream'])
+    main_loop = model.main(config, stream.masked_stream, stream.dev_stream)
+
+    # The first batch, which includes the compilation, is left out
+    rows = [main_loop.log[i] for i in range(2, args.n_batches + 1)]
+    (_, _, _, peak), = profile_memory(
+        main_loop.algorithm,
+        [(args.batch_size, config['seq_len'], config['seq_len'])],
+        config['src_vocab_size'], config['trg_vocab_size'])
+    return {'words_per_sec': float(numpy.mean(
+                [row['profile_words_per_sec'] for row in rows])),
+            'peak_mb': peak}
+
+
+def benchmark_autotune(args):
+    """Sweeps the batch size and sort buffer, writes the best as a config.
+
+    Every setting is trained for `n_batches` in its own process, on
+    synthetic data by default or on the corpus of the config, and the
+    fastest setting whose peak step memory fits in the budget is written as
+    the derived config ``<proto>_autotuned``.
+    """
+    if args.batch_size:
+        json.dump(autotune_setting(args), open(args.output, 'w'))
+        return
+
+    results = []
+    print "{:>10} {:>14} {:>14} {:>10}".format(
+        'batch', 'sort_k', 'words/sec', 'peak MB')
+    for batch_size in args.batch_sizes:
+        for sort_k_batches in args.sort_k_batches_list:
+            handle, output = tempfile.mkstemp(suffix='.json')
+            os.close(handle)
+            command = [sys.executable, sys.argv[0], 'autotune',
+                       '--proto', args.proto, '--output', output,
+                       '--batch-size', str(batch_size),
+                       '--sort-k-batches', str(sort_k_batches),
+                       '--n-batches', str(args.n_batches),
+                       '--n-sentences', str(args.n_sentences)]
+            if args.real_data:
+                command.append('--real-data')
+            if subprocess.call(command):
+                logger.warning("Batch size {}, sort buffer {} failed".format(
+                    batch_size, sort_k_batches))
+                os.remove(output)
+                continue
+            result = json.load(open(output))
+            os.remove(output)
+            print "{:>10} {:>14} {:>14.1f} {:>10.0f}".format(
+                batch_size, sort_k_batches, result['words_per_sec'],
+                result['peak_mb'])
+            results.append((result, {'batch_size': batch_size,
+                                     'sort_k_batches': sort_k_batches}))
+
+    fitting = [(result, changes) for result, changes in results
+               if not args.memory_budget or
+               result['peak_mb'] <= args.memory_budget]
+    if not fitting:
+        logger.error("No setting fits in {} MB".format(args.memory_budget))
+        sys.exit(1)
+    result, changes = max(fitting, key=lambda pair: pair[0]['words_per_sec'])
+    name = args.proto + '_autotuned'
+    path = write_derived_config(name, args.proto, changes)
+    print "Best: {}, written to {}, use --proto {}".format(
+        changes, path, name)
+
+
+def benchmark_memory(args):
+    """Fits the memory model of a config and prints its fit.
+
+    The measurements are those of the Theano memory profiler, on random
+    batches of shapes up to the batch size and length of the config.
+    """
+    model = import_model(args.proto)
+    config = model.config
+    config.update({'memory_profile': args.output,
+                   'saveto': tempfile.mkdtemp(), 'reload': False})
+    stream = importlib.import_module(config['stream'])
+    memory_model = model.main(config, stream.masked_stream,
+                              stream.dev_stream)
+    print "{:>8} {:>8} {:>8} {:>12} {:>12}".format(
+        'batch', 'source', 'target', 'MB', 'predicted')
+    for batch_size, source_length, target_length, peak in json.load(
+            open(args.output))['measurements']:
+        print "{:>8} {:>8} {:>8} {:>12.1f} {:>12.1f}".format(
+            batch_size, source_length, target_length, peak,
+            memory_model.predict(batch_size, source_length, target_length))
+    if args.budget:
+        print "Largest batch within {} MB by length:".format(args.budget)
+        for length in args.lengths:
+            print "{:>8} {:>8}".format(length, memory_model.max_batch_size(
+                length, length, args.budget))
+
+
+def benchmark_beam(args):
+    """Decoding time and BLEU of the dev set by beam search policy.
+
+    The model is trained for one batch, in a temporary directory, to
+    build the main loop, then the dump of `args.model`, the saveto
+    directory of the config by default, is loaded into it. BLEU is
+    computed like multi-bleu.perl, the agreement is the fraction of best
+    translations equal to those of the plain beam search.
+    """
+    from sampling import BleuValidator, _bleu_statistics, _corpus_bleu
+    model = import_model(args.proto)
+    config = model.config
+    model_dir = args.model or config['saveto']
+    config.update({
+        'saveto': tempfile.mkdtemp(), 'reload': False, 'finish_after': 1,
+        'sampling_freq': 2, 'bleu_val_freq': 2, 'save_freq': 2,
+        'ppl_val_freq': None, 'profile_freq': None, 'log_window': None})
+    stream = importlib.import_module(config['stream'])
+    main_loop = model.main(config, stream.masked_stream, stream.dev_stream)
+    model.MainLoopDumpManagerWMT15(model_dir).load_parameters_to(
+        main_loop.model, strict=True)
+
+    validator, = [extension for extension in main_loop.extensions
+                  if isinstance(extension, BleuValidator)]
+    trg_vocab = cPickle.load(open(config['trg_vocab']))
+    validator.trg_ivocab = {v: k for k, v in trg_vocab.items()}
+    sources = validator._sources()[:args.n_sentences]
+    with open(config['val_set_grndtruth']) as grndtruth:
+        references = [reference.split() for reference in grndtruth]
+
+    policies = [
+        ('baseline', {}),
+        ('early_stop', {'early_stop': True}),
+        ('shrink', {'shrink': True}),
+        ('early_stop+shrink', {'early_stop': True, 'shrink': True}),
+        ('relative', {'relative_threshold': args.relative_threshold}),
+        ('absolute', {'absolute_threshold': args.absolute_threshold}),
+        ('all', {'early_stop': True, 'shrink': True,
+                 'relative_threshold': args.relative_threshold,
+                 'absolute_threshold': args.absolute_threshold})]
+    search = validator.beam_search
+    baseline = None
+    print "{:>20} {:>12} {:>8} {:>10}".format(
+        'policy', 'sec/sent', 'BLEU', 'agreement')
+    for name, policy in policies:
+        search.length_normalization = args.length_norm
+        search.early_stop = policy.get('early_stop', False)
+        search.shrink = policy.get('shrink', False)
+        search.relative_threshold = policy.get('relative_threshold')
+        search.absolute_threshold = policy.get('absolute_threshold')
+        translations = []
+        start = time.time()
+        for seq in sources:
+            trans, costs = validator._search(seq)
+            translations.append(trans[numpy.argmin(costs)][:-1])
+        seconds = (time.time() - start) / len(sources)
+        if baseline is None:
+            baseline = translations
+        bleu = _corpus_bleu(numpy.sum(
+            [_bleu_statistics(
+                validator._idx_to_word(translation,
+                                       validator.trg_ivocab).split(),
+                reference)
+             for translation, reference in zip(translations, references)],
+            axis=0))
+        agreement = numpy.mean([list(translation) == list(best)
+                                for translation, best
+                                in zip(translations, baseline)])
+        print "{:>20} {:>12.4f} {:>8.2f} {:>10.1%}".format(
+            name, seconds, bleu, agreement)
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers()
+
+softmax_parser = subparsers.add_parser(
+    'softmax', help="Output layer time per batch versus vocabulary size")
+softmax_parser.add_argument("--vocab-sizes", type=int, nargs='+',
+                            default=[501, 10000, 40001, 100000])
+softmax_parser.add_argument("--softmax", nargs='+',
+                            default=['full', 'sampled', 'class'])
+softmax_parser.add_argument("--samples", type=int, default=5000)
+softmax_parser.add_argument("--embed", type=int, default=620,
+                            help="62 for the TEST config")
+softmax_parser.add_argument("--seq-len", type=int, default=50)
+softmax_parser.add_argument("--batch-size", type=int, default=80)
+softmax_parser.add_argument("--n-calls", type=int, default=10)
+softmax_parser.set_defaults(func=benchmark_softmax)
+
+shortlist_parser = subparsers.add_parser(
+    'shortlist', help="Decoding step time of the output layer by shortlist")
+shortlist_parser.add_argument("--vocab-size", type=int, default=40001)
+shortlist_parser.add_argument("--shortlist-sizes", type=int, nargs='+',
+                              default=[1000, 2000, 5000, 10000])
+shortlist_parser.add_argument("--embed", type=int, default=620)
+shortlist_parser.add_argument("--beam-size", type=int, default=20)
+shortlist_parser.add_argument("--n-calls", type=int, default=100)
+shortlist_parser.set_defaults(func=benchmark_shortlist)
+
+subtensor_parser = subparsers.add_parser(
+    'subtensor', help="Lookup gradient merge of the subtensor fix")
+subtensor_parser.add_argument("--vocab-size", type=int, default=200000)
+subtensor_parser.add_argument("--n-indices", type=int, default=4000)
+subtensor_parser.add_argument("--embed", type=int, default=620)
+subtensor_parser.add_argument("--n-calls", type=int, default=20)
+subtensor_parser.set_defaults(func=benchmark_subtensor)
+
+noise_parser = subparsers.add_parser(
+    'noise', help="Embedding training step with dense or sparse weight noise")
+noise_parser.add_argument("--vocab-size", type=int, default=40001)
+noise_parser.add_argument("--level", type=float, default=0.01)
+noise_parser.add_argument("--embed", type=int, default=620)
+noise_parser.add_argument("--seq-len", type=int, default=50)
+noise_parser.add_argument("--batch-size", type=int, default=80)
+noise_parser.add_argument("--n-calls", type=int, default=20)
+noise_parser.set_defaults(func=benchmark_noise)
+
+encoder_parser = subparsers.add_parser(
+    'encoder', help="Bidirectional encoder time with separate or fused scans")
+encoder_parser.add_argument("--lengths", type=int, nargs='+',
+                            default=[10, 20, 30, 50])
+encoder_parser.add_argument("--vocab-size", type=int, default=40001)
+encoder_parser.add_argument("--embed", type=int, default=620)
+encoder_parser.add_argument("--nhids", type=int, default=1000)
+encoder_parser.add_argument("--batch-size", type=int, default=80)
+encoder_parser.add_argument("--n-calls", type=int, default=10)
+encoder_parser.set_defaults(func=benchmark_encoder)
+
+fork_parser = subparsers.add_parser(
+    'fork', help="GRU input projections with separate or fused products")
+fork_parser.add_argument("--embed", type=int, default=620)
+fork_parser.add_argument("--nhids", type=int, default=1000)
+fork_parser.add_argument("--seq-len", type=int, default=50)
+fork_parser.add_argument("--batch-size", type=int, default=80)
+fork_parser.add_argument("--n-calls", type=int, default=20)
+fork_parser.set_defaults(func=benchmark_fork)
+
+packing_parser = subparsers.add_parser(
+    'packing', help="Readout FLOPs saved by skipping padded positions")
+packing_parser.add_argument("--trg-data", default=None,
+                            help="Target text, lognormal lengths if not given")
+packing_parser.add_argument("--n-sentences", type=int, default=96000)
+packing_parser.add_argument("--vocab-size", type=int, default=40001)
+packing_parser.add_argument("--embed", type=int, default=620)
+packing_parser.add_argument("--nhids", type=int, default=1000)
+packing_parser.add_argument("--seq-len", type=int, default=50)
+packing_parser.add_argument("--batch-size", type=int, default=80)
+packing_parser.add_argument("--sort-k-batches", type=int, default=12)
+packing_parser.add_argument("--n-print", type=int, default=24)
+packing_parser.set_defaults(func=benchmark_packing)
+
+attention_parser = subparsers.add_parser(
+    'attention', help="Decoder time and host memory per batch by length")
+attention_parser.add_argument("--lengths", type=int, nargs='+',
+                              default=[25, 50, 100, 200])
+attention_parser.add_argument("--attention", nargs='+',
+                              default=['global', 'local'])
+attention_parser.add_argument("--window", type=int, default=10)
+attention_parser.add_argument("--vocab-size", type=int, default=30000)
+attention_parser.add_argument("--embed", type=int, default=620)
+attention_parser.add_argument("--nhids", type=int, default=1000)
+attention_parser.add_argument("--batch-size", type=int, default=80)
+attention_parser.add_argument("--n-calls", type=int, default=5)
+attention_parser.add_argument("--length", type=int, default=None,
+                              help=argparse.SUPPRESS)
+attention_parser.set_defaults(func=benchmark_attention)
+
+embeddings_parser = subparsers.add_parser(
+    'embeddings', help="Source embeddings size and step time by type")
+embeddings_parser.add_argument("--proto",
+                               default="get_config_de_en_50k_refMultiCG")
+embeddings_parser.add_argument("--embeddings", nargs='+',
+                               default=['full', 'hashed', 'factorized'])
+embeddings_parser.add_argument("--n-calls", type=int, default=10)
+embeddings_parser.set_defaults(func=benchmark_embeddings)
+
+suite_parser = subparsers.add_parser(
+    'suite', help="Time every training stage on synthetic data, to JSON")
+suite_parser.add_argument("--protos", nargs='+',
+                          default=['get_config_wmt15_fi_en_TEST',
+                                   'get_config_wmt15_fi_en_40k'])
+suite_parser.add_argument("--output", default="benchmark.json")
+suite_parser.add_argument("--workdir", default=None,
+                          help="Where to write the data, a temporary "
+                               "directory by default")
+suite_parser.add_argument("--bleu-script", default=None,
+                          help="multi-bleu.perl, BLEU is not timed if the "
+                               "one of the config is not found")
+suite_parser.add_argument("--n-batches", type=int, default=20)
+suite_parser.add_argument("--n-sentences", type=int, default=20000)
+suite_parser.add_argument("--n-dev", type=int, default=200)
+suite_parser.add_argument("--n-beam", type=int, default=10)
+suite_parser.set_defaults(func=benchmark_suite)
+
+compare_parser = subparsers.add_parser(
+    'compare', help="Flag regressions between two suite results")
+compare_parser.add_argument("old")
+compare_parser.add_argument("new")
+compare_parser.add_argument("--threshold", type=float, default=0.1,
+                            help="Relative slow down flagged")
+compare_parser.set_defaults(func=benchmark_compare)
+
+record_parser = subparsers.add_parser(
+    'record', help="Record the training batches of a config to a file")
+record_parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k")
+record_parser.add_argument("--output", default="batches.bin")
+record_parser.add_argument("--n-batches", type=int, default=1000)
+record_parser.set_defaults(func=benchmark_record)
+
+replay_parser = subparsers.add_parser(
+    'replay', help="Time training steps on recorded batches")
+replay_parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k")
+replay_parser.add_argument("--batches", default="batches.bin")
+replay_parser.add_argument("--n-batches", type=int, default=None,
+                           help="All the recorded batches by default")
+replay_parser.set_defaults(func=benchmark_replay)
+
+autotune_parser = subparsers.add_parser(
+    'autotune', help="Sweep batch sizes and sort buffers, write the best")
+autotune_parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k")
+autotune_parser.add_argument("--batch-sizes", type=int, nargs='+',
+                             default=[40, 80, 120, 160])
+autotune_parser.add_argument("--sort-k-batches-list", type=int, nargs='+',
+                             default=[1, 12, 50])
+autotune_parser.add_argument("--memory-budget", type=float, default=None,
+                             help="Peak MB a setting may use")
+autotune_parser.add_argument("--real-data", action='store_true',
+                             help="Train on the corpus of the config "
+                                  "instead of synthetic data")
+autotune_parser.add_argument("--n-batches", type=int, default=20)
+autotune_parser.add_argument("--n-sentences", type=int, default=20000)
+autotune_parser.add_argument("--output", default=None,
+                             help=argparse.SUPPRESS)
+autotune_parser.add_argument("--batch-size", type=int, default=None,
+                             help=argparse.SUPPRESS)
+autotune_parser.add_argument("--sort-k-batches", type=int, default=None,
+                             help=argparse.SUPPRESS)
+autotune_parser.set_defaults(func=benchmark_autotune)
+
+memory_parser = subparsers.add_parser(
+    'memory', help="Fit the peak memory of training steps by batch shape")
+memory_parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k")
+memory_parser.add_argument("--output", default="memory_model.json")
+memory_parser.add_argument("--budget", type=float, default=None,
+                           help="Megabytes, to print the batch size caps")
+memory_parser.add_argument("--lengths", type=int, nargs='+',
+                           default=[10, 20, 30, 40, 50])
+memory_parser.set_defaults(func=benchmark_memory)
+
+beam_parser = subparsers.add_parser(
+    'beam', help="Dev set decoding time and BLEU by beam search policy")
+beam_parser.add_argument("--proto", default="get_config_wmt15_fi_en_40k")
+beam_parser.add_argument("--model", default=None,
+                         help="Dump directory, saveto of the config by "
+                              "default")
+beam_parser.add_argument("--n-sentences", type=int, default=200)
+beam_parser.add_argument("--length-norm", type=float, default=0.)
+beam_parser.add_argument("--relative-threshold", type=float, default=0.01)
+beam_parser.add_argument("--absolute-threshold", type=float, default=5.)
+beam_parser.set_defaults(func=benchmark_beam)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    args.func(args)
@@ -1,3 +1,10 @@
+import json
+import os
+
+# Configs written by `benchmark.py autotune`, as changes to a prototype
+DERIVED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'derived_configs')
+
 
 class ReadOnlyDict(dict):
 
@@ -19,24 +26,51 @@ def get_config_wmt15_fi_en_40k():
     config['enc_nhids'] = 1000
     config['dec_nhids'] = 1000
     config['enc_embed'] = 620
+    config['enc_embeddings'] = 'full'  # 'full', 'hashed' or 'factorized'
+    config['enc_embed_buckets'] = 50000
+    config['enc_embed_hashes'] = 2
+    config['enc_embed_frequent'] = 20000
+    config['enc_embed_rank'] = 128
     config['dec_embed'] = 620
+    config['fused_encoder'] = False
+    config['fused_forks'] = False
+    config['packed_cost'] = False
+    config['checkpoint_every'] = None  # decoder steps between stored states
     config['saveto'] = 'refBlocks3'
 
+    # Attention related, 'global' or 'local' to a window around a
+    # predicted source position
+    config['attention'] = 'global'
+    config['attention_window'] = 10
+
     # Optimization related
     config['batch_size'] = 80
     config['sort_k_batches'] = 12
-    config['step_rule'] = 'AdaDelta'
+    config['memory_profile'] = None  # memory model to write instead of training
+    config['memory_model'] = None  # memory model of batch shapes
+    config['memory_budget'] = None  # megabytes a batch may use
+    config['memory_cap_batches'] = False  # smaller batches of long sentences
+    config['accumulate_gradients'] = 1  # batches per update
+    config['step_rule'] = 'AdaDelta'  # Scale, Momentum, RMSProp, Adam or AdaDelta
     config['step_clipping'] = 10
     config['weight_scale'] = 0.01
+    config['float16_state'] = False  # step rule state in float16
+
+    # Output layer related, softmax is one of 'full', 'sampled' or 'class'
+    config['softmax'] = 'full'
+    config['softmax_samples'] = 5000
+    config['softmax_classes'] = None
 
     # Regularization related
     config['weight_noise_ff'] = 0.01
+    config['weight_noise_sparse'] = False
     config['weight_noise_rec'] = False
     config['dropout'] = 0.5
 
     # Vocabulary/dataset related
     basedir = '/data/lisatmp3/firatorh/nmt/wmt15/data/fi-en/processed/'
     config['stream'] = 'stream_fi_en'
+    config['replay_batches'] = None  # recorded batches to train on instead
     config['src_vocab'] = basedir + 'vocab.fi.pkl'
     config['trg_vocab'] = basedir + 'vocab.en.pkl'
     config['src_data'] = basedir + 'all.tok.clean.shuf.seg1.fi-en.fi'
@@ -55,13 +89,38 @@ def get_config_wmt15_fi_en_40k():
     config['val_set_out'] = 'refBlocks3/adadelta_40k_out.txt'
     config['output_val_set'] = True
     config['beam_size'] = 20
+    config['beam_length_norm'] = 0.  # exponent of the length costs are divided by
+    config['beam_early_stop'] = False  # stop once the best hypothesis is known
+    config['beam_shrink'] = False  # one place less per finished hypothesis
+    config['beam_relative_threshold'] = None  # min word prob. ratio to the best
+    config['beam_absolute_threshold'] = None  # max cost gap to the best
+
+    # Vocabulary shortlist related, used when decoding only
+    config['shortlist'] = None
+    config['shortlist_top_k'] = 2000
+    config['shortlist_translations'] = 20
 
     # Timing related
     config['reload'] = True
+    config['finish_after'] = 1000000  # batches
     config['save_freq'] = 50
+    config['float16_dump'] = False  # dumped parameters in float16
+    config['profile_freq'] = None  # batches between time summaries
+    config['log_window'] = None  # batches of log kept in memory, None for all
     config['sampling_freq'] = 1
+    config['sampling_background'] = False  # sample in a worker process
+    config['sampling_interval'] = 60  # min seconds between background samples
+    config['sampling_greedy'] = False  # argmax samples instead of random ones
     config['bleu_val_freq'] = 2000
+    config['val_subset_size'] = None  # sentences scored between full BLEUs
+    config['val_full_every'] = 5  # validations between full set BLEUs
+    config['val_full_margin'] = 0.5  # subset BLEU gain forcing a full BLEU
+    config['val_bootstrap'] = 1000  # resamples of the subset BLEU interval
+    config['val_beam_every'] = 1  # validations between beam searches, greedy otherwise
+    config['val_greedy_batch_size'] = 80  # sentences decoded at once
     config['val_burn_in'] = 50000
+    config['ppl_val_freq'] = None  # batches between dev set perplexities
+    config['bleu_on_ppl_improvement'] = False  # BLEU only when ppl improves
 
     # Monitoring related
     config['hook_samples'] = 1
@@ -78,24 +137,51 @@ def get_config_wmt15_fi_en_TEST():
     config['enc_nhids'] = 100
     config['dec_nhids'] = 100
     config['enc_embed'] = 62
+    config['enc_embeddings'] = 'full'  # 'full', 'hashed' or 'factorized'
+    config['enc_embed_buckets'] = 500
+    config['enc_embed_hashes'] = 2
+    config['enc_embed_frequent'] = 100
+    config['enc_embed_rank'] = 16
     config['dec_embed'] = 62
+    config['fused_encoder'] = False
+    config['fused_forks'] = False
+    config['packed_cost'] = False
+    config['checkpoint_every'] = None  # decoder steps between stored states
     config['saveto'] = 'refBlocks3_TEST'
 
+    # Attention related, 'global' or 'local' to a window around a
+    # predicted source position
+    config['attention'] = 'global'
+    config['attention_window'] = 10
+
     # Optimization related
     config['batch_size'] = 8
     config['sort_k_batches'] = 12
-    config['step_rule'] = 'AdaDelta'
+    config['memory_profile'] = None  # memory model to write instead of training
+    config['memory_model'] = None  # memory model of batch shapes
+    config['memory_budget'] = None  # megabytes a batch may use
+    config['memory_cap_batches'] = False  # smaller batches of long sentences
+    config['accumulate_gradients'] = 1  # batches per update
+    config['step_rule'] = 'AdaDelta'  # Scale, Momentum, RMSProp, Adam or AdaDelta
     config['step_clipping'] = 10
     config['weight_scale'] = 0.01
+    config['float16_state'] = False  # step rule state in float16
+
+    # Output layer related, softmax is one of 'full', 'sampled' or 'class'
+    config['softmax'] = 'full'
+    config['softmax_samples'] = 100
+    config['softmax_classes'] = None
 
     # Regularization related
     config['weight_noise_ff'] = False
+    config['weight_noise_sparse'] = False
     config['weight_noise_rec'] = False
     config['dropout'] = 1.0
 
     # Vocabulary/dataset related
     basedir = '/data/lisatmp3/firatorh/nmt/wmt15/data/fi-en/processed/'
     config['stream'] = 'stream_fi_en'
+    config['replay_batches'] = None  # recorded batches to train on instead
     config['src_vocab'] = basedir + 'vocab.fi.pkl'
     config['trg_vocab'] = basedir + 'vocab.en.pkl'
     config['src_data'] = basedir + 'all.tok.clean.shuf.seg1.fi-en.fi'
@@ -112,13 +198,38 @@ def get_config_wmt15_fi_en_TEST():
     config['val_set_out'] = 'refBlocks3_TEST/validation_out.txt'
     config['output_val_set'] = True
     config['beam_size'] = 2
+    config['beam_length_norm'] = 0.  # exponent of the length costs are divided by
+    config['beam_early_stop'] = False  # stop once the best hypothesis is known
+    config['beam_shrink'] = False  # one place less per finished hypothesis
+    config['beam_relative_threshold'] = None  # min word prob. ratio to the best
+    config['beam_absolute_threshold'] = None  # max cost gap to the best
+
+    # Vocabulary shortlist related, used when decoding only
+    config['shortlist'] = None
+    config['shortlist_top_k'] = 100
+    config['shortlist_translations'] = 20
 
     # Timing related
     config['reload'] = True
+    config['finish_after'] = 1000000  # batches
     config['save_freq'] = 1
+    config['float16_dump'] = False  # dumped parameters in float16
+    config['profile_freq'] = None  # batches between time summaries
+    config['log_window'] = None  # batches of log kept in memory, None for all
     config['sampling_freq'] = 5
+    config['sampling_background'] = False  # sample in a worker process
+    config['sampling_interval'] = 60  # min seconds between background samples
+    config['sampling_greedy'] = False  # argmax samples instead of random ones
     config['bleu_val_freq'] = 10
+    config['val_subset_size'] = None  # sentences scored between full BLEUs
+    config['val_full_every'] = 5  # validations between full set BLEUs
+    config['val_full_margin'] = 0.5  # subset BLEU gain forcing a full BLEU
+    config['val_bootstrap'] = 1000  # resamples of the subset BLEU interval
+    config['val_beam_every'] = 1  # validations between beam searches, greedy otherwise
+    config['val_greedy_batch_size'] = 80  # sentences decoded at once
     config['val_burn_in'] = 0
+    config['ppl_val_freq'] = None  # batches between dev set perplexities
+    config['bleu_on_ppl_improvement'] = False  # BLEU only when ppl improves
 
     # Monitoring related
     config['hook_samples'] = 1
@@ -135,24 +246,51 @@ def get_config_wmt15_fi_en_40k_refMultiCG():
     config['enc_nhids'] = 1000
     config['dec_nhids'] = 1000
     config['enc_embed'] = 620
+    config['enc_embeddings'] = 'full'  # 'full', 'hashed' or 'factorized'
+    config['enc_embed_buckets'] = 50000
+    config['enc_embed_hashes'] = 2
+    config['enc_embed_frequent'] = 20000
+    config['enc_embed_rank'] = 128
     config['dec_embed'] = 620
+    config['fused_encoder'] = False
+    config['fused_forks'] = False
+    config['packed_cost'] = False
+    config['checkpoint_every'] = None  # decoder steps between stored states
     config['saveto'] = 'refMultiCG'
 
+    # Attention related, 'global' or 'local' to a window around a
+    # predicted source position
+    config['attention'] = 'global'
+    config['attention_window'] = 10
+
     # Optimization related
     config['batch_size'] = 80
     config['sort_k_batches'] = 12
-    config['step_rule'] = 'AdaDelta'
+    config['memory_profile'] = None  # memory model to write instead of training
+    config['memory_model'] = None  # memory model of batch shapes
+    config['memory_budget'] = None  # megabytes a batch may use
+    config['memory_cap_batches'] = False  # smaller batches of long sentences
+    config['accumulate_gradients'] = 1  # batches per update
+    config['step_rule'] = 'AdaDelta'  # Scale, Momentum, RMSProp, Adam or AdaDelta
     config['step_clipping'] = 10
     config['weight_scale'] = 0.01
+    config['float16_state'] = False  # step rule state in float16
+
+    # Output layer related, softmax is one of 'full', 'sampled' or 'class'
+    config['softmax'] = 'full'
+    config['softmax_samples'] = 5000
+    config['softmax_classes'] = None
 
     # Regularization related
     config['weight_noise_ff'] = 0.01
+    config['weight_noise_sparse'] = False
     config['weight_noise_rec'] = False
     config['dropout'] = 0.5
 
     # Vocabulary/dataset related
     basedir = '/data/lisatmp3/firatorh/nmt/wmt15/data/fi-en/processed/'
     config['stream'] = 'stream_fi_en'
+    config['replay_batches'] = None  # recorded batches to train on instead
     config['src_vocab'] = basedir + 'vocab.fi.pkl'
     config['trg_vocab'] = basedir + 'vocab.en.pkl'
     config['src_data'] = basedir + 'all.tok.clean.shuf.seg1.fi-en.fi'
@@ -171,13 +309,38 @@ def get_config_wmt15_fi_en_40k_refMultiCG():
     config['val_set_out'] = config['saveto'] + '/adadelta_40k_out.txt'
     config['output_val_set'] = True
     config['beam_size'] = 20
+    config['beam_length_norm'] = 0.  # exponent of the length costs are divided by
+    config['beam_early_stop'] = False  # stop once the best hypothesis is known
+    config['beam_shrink'] = False  # one place less per finished hypothesis
+    config['beam_relative_threshold'] = None  # min word prob. ratio to the best
+    config['beam_absolute_threshold'] = None  # max cost gap to the best
+
+    # Vocabulary shortlist related, used when decoding only
+    config['shortlist'] = None
+    config['shortlist_top_k'] = 2000
+    config['shortlist_translations'] = 20
 
     # Timing related
     config['reload'] = True
+    config['finish_after'] = 1000000  # batches
     config['save_freq'] = 1000
+    config['float16_dump'] = False  # dumped parameters in float16
+    config['profile_freq'] = None  # batches between time summaries
+    config['log_window'] = None  # batches of log kept in memory, None for all
     config['sampling_freq'] = 13
+    config['sampling_background'] = False  # sample in a worker process
+    config['sampling_interval'] = 60  # min seconds between background samples
+    config['sampling_greedy'] = False  # argmax samples instead of random ones
     config['bleu_val_freq'] = 5000
+    config['val_subset_size'] = None  # sentences scored between full BLEUs
+    config['val_full_every'] = 5  # validations between full set BLEUs
+    config['val_full_margin'] = 0.5  # subset BLEU gain forcing a full BLEU
+    config['val_bootstrap'] = 1000  # resamples of the subset BLEU interval
+    config['val_beam_every'] = 1  # validations between beam searches, greedy otherwise
+    config['val_greedy_batch_size'] = 80  # sentences decoded at once
     config['val_burn_in'] = 20000
+    config['ppl_val_freq'] = None  # batches between dev set perplexities
+    config['bleu_on_ppl_improvement'] = False  # BLEU only when ppl improves
 
     # Monitoring related
     config['hook_samples'] = 2
@@ -193,18 +356,44 @@ def get_config_de_en_50k_refMultiCG():
     config['enc_nhids'] = 1000
     config['dec_nhids'] = 1000
     config['enc_embed'] = 620
+    config['enc_embeddings'] = 'full'  # 'full', 'hashed' or 'factorized'
+    config['enc_embed_buckets'] = 50000
+    config['enc_embed_hashes'] = 2
+    config['enc_embed_frequent'] = 20000
+    config['enc_embed_rank'] = 128
     config['dec_embed'] = 620
+    config['fused_encoder'] = False
+    config['fused_forks'] = False
+    config['packed_cost'] = False
+    config['checkpoint_every'] = None  # decoder steps between stored states
     config['saveto'] = 'refMultiCG_DEEN'
 
+    # Attention related, 'global' or 'local' to a window around a
+    # predicted source position
+    config['attention'] = 'global'
+    config['attention_window'] = 10
+
     # Optimization related
     config['batch_size'] = 80
     config['sort_k_batches'] = 12
-    config['step_rule'] = 'AdaDelta'
+    config['memory_profile'] = None  # memory model to write instead of training
+    config['memory_model'] = None  # memory model of batch shapes
+    config['memory_budget'] = None  # megabytes a batch may use
+    config['memory_cap_batches'] = False  # smaller batches of long sentences
+    config['accumulate_gradients'] = 1  # batches per update
+    config['step_rule'] = 'AdaDelta'  # Scale, Momentum, RMSProp, Adam or AdaDelta
     config['step_clipping'] = 10
     config['weight_scale'] = 0.01
+    config['float16_state'] = False  # step rule state in float16
+
+    # Output layer related, softmax is one of 'full', 'sampled' or 'class'
+    config['softmax'] = 'full'
+    config['softmax_samples'] = 5000
+    config['softmax_classes'] = None
 
     # Regularization related
     config['weight_noise_ff'] = 0.01
+    config['weight_noise_sparse'] = False
     config['weight_noise_rec'] = False
     config['dropout'] = 0.5
 
@@ -212,6 +401,7 @@ def get_config_de_en_50k_refMultiCG():
 
     basedir = '/data/lisatmp3/firatorh/nmt/wmt15/data/fideen-en/'
     config['stream'] = 'stream_fi_en'
+    config['replay_batches'] = None  # recorded batches to train on instead
     config['src_vocab'] = basedir + 'de2en/vocab.de.pkl'
     config['trg_vocab'] = basedir + 'joint_vocab.sub.en.52k.pkl'
     config['src_data'] = basedir + 'de2en/all.tok.clean.shuf.split.de-en.de'
@@ -230,15 +420,61 @@ def get_config_de_en_50k_refMultiCG():
     config['val_set_out'] = config['saveto'] + '/adadelta_50k_out.txt'
     config['output_val_set'] = True
     config['beam_size'] = 20
+    config['beam_length_norm'] = 0.  # exponent of the length costs are divided by
+    config['beam_early_stop'] = False  # stop once the best hypothesis is known
+    config['beam_shrink'] = False  # one place less per finished hypothesis
+    config['beam_relative_threshold'] = None  # min word prob. ratio to the best
+    config['beam_absolute_threshold'] = None  # max cost gap to the best
+
+    # Vocabulary shortlist related, used when decoding only
+    config['shortlist'] = None
+    config['shortlist_top_k'] = 2000
+    config['shortlist_translations'] = 20
 
     # Timing related
     config['reload'] = True
+    config['finish_after'] = 1000000  # batches
     config['save_freq'] = 1000
+    config['float16_dump'] = False  # dumped parameters in float16
+    config['profile_freq'] = None  # batches between time summaries
+    config['log_window'] = None  # batches of log kept in memory, None for all
     config['sampling_freq'] = 17
+    config['sampling_background'] = False  # sample in a worker process
+    config['sampling_interval'] = 60  # min seconds between background samples
+    config['sampling_greedy'] = False  # argmax samples instead of random ones
     config['bleu_val_freq'] = 2000
+    config['val_subset_size'] = None  # sentences scored between full BLEUs
+    config['val_full_every'] = 5  # validations between full set BLEUs
+    config['val_full_margin'] = 0.5  # subset BLEU gain forcing a full BLEU
+    config['val_bootstrap'] = 1000  # resamples of the subset BLEU interval
+    config['val_beam_every'] = 1  # validations between beam searches, greedy otherwise
+    config['val_greedy_batch_size'] = 80  # sentences decoded at once
     config['val_burn_in'] = 80000
+    config['ppl_val_freq'] = None  # batches between dev set perplexities
+    config['bleu_on_ppl_improvement'] = False  # BLEU only when ppl improves
 
     # Monitoring related
     config['hook_samples'] = 2
 
     return config
+
+
+def get_config(proto):
+    """The config of a prototype, or of a derived config of DERIVED_DIR."""
+    path = os.path.join(DERIVED_DIR, proto + '.json')
+    if proto not in globals() and os.path.isfile(path):
+        derived = json.load(open(path))
+        config = get_config(derived['proto'])
+        config.update(derived['changes'])
+        return config
+    return globals()[proto]()
+
+
+def write_derived_config(name, proto, changes):
+    """Writes a derived config, which `--proto name` then selects."""
+    if not os.path.exists(DERIVED_DIR):
+        os.makedirs(DERIVED_DIR)
+    path = os.path.join(DERIVED_DIR, name + '.json')
+    json.dump({'proto': proto, 'changes': changes}, open(path, 'w'),
+              indent=2, sort_keys=True)
+    return path
@@ -0,0 +1,116 @@
+# Word embeddings with fewer parameters than a full lookup table
+import logging
+import numpy
+import theano
+from theano import tensor
+
+from blocks.bricks import Initializable, Linear
+from blocks.bricks.base import application, lazy
+from blocks.bricks.lookup import LookupTable
+
+logger = logging.getLogger(__name__)
+
+
+class HashedLookupTable(Initializable):
+    """Embeddings of words hashed into a smaller table.
+
+    The `n_frequent` most frequent words, i.e. the smallest indices of a
+    frequency sorted vocabulary, have rows of their own. Every other word
+    is hashed by `n_hashes` fixed random functions into `n_buckets` shared
+    rows, and its embedding is the sum of these rows, so that rare words
+    share capacity but two of them rarely share all their rows.
+
+    The rows are those of the ``table`` child, a LookupTable, so that the
+    subtensor fix and sparse weight noise can be applied to it.
+
+    Parameters
+    ----------
+    length : int
+        The size of the vocabulary.
+    dim : int
+        The dimension of the embeddings.
+    n_buckets : int
+        The number of rows shared by the rare words.
+    n_hashes : int
+        The number of rows summed for a rare word.
+    n_frequent : int
+        The number of words with a row of their own.
+    hash_seed : int
+        The seed of the hash functions, which must not change between
+        the training and the use of a model.
+
+    """
+    @lazy(allocation=['length', 'dim'])
+    def __init__(self, length, dim, n_buckets, n_hashes=2, n_frequent=0,
+                 hash_seed=1234, **kwargs):
+        super(HashedLookupTable, self).__init__(**kwargs)
+        self.length = length
+        self.dim = dim
+        self.n_buckets = n_buckets
+        self.n_hashes = n_hashes
+        self.n_frequent = n_frequent
+        self.hash_seed = hash_seed
+
+        self.table = LookupTable(name='table')
+        self.children = [self.table]
+
+    def _push_allocation_config(self):
+        self.table.length = min(self.n_frequent, self.length) + self.n_buckets
+        self.table.dim = self.dim
+
+        # Frequent words use their first hash only, with a weight of one
+        rng = numpy.random.RandomState(self.hash_seed)
+        hashes = self.n_frequent + rng.randint(
+            self.n_buckets, size=(self.length, self.n_hashes))
+        weights = numpy.ones((self.length, self.n_hashes),
+                             dtype=theano.config.floatX)
+        frequent = numpy.arange(min(self.n_frequent, self.length))
+        hashes[frequent, 0] = frequent
+        weights[frequent, 1:] = 0
+        self.hashes = hashes.astype('int64')
+        self.hash_weights = weights
+
+    @application(inputs=['indices'], outputs=['output'])
+    def apply(self, indices):
+        rows = self.table.apply(tensor.constant(self.hashes)[indices])
+        weights = tensor.constant(self.hash_weights)[indices]
+        return (rows * tensor.shape_padright(weights)).sum(axis=indices.ndim)
+
+
+class FactorizedLookupTable(Initializable):
+    """Embeddings given by a low rank lookup table and a projection.
+
+    The (length x dim) table is factored into the (length x rank) table
+    ``table``, a LookupTable, and the (rank x dim) matrix of the linear
+    transformation ``projection``.
+
+    Parameters
+    ----------
+    length : int
+        The size of the vocabulary.
+    dim : int
+        The dimension of the embeddings.
+    rank : int
+        The dimension of the rows of the table.
+
+    """
+    @lazy(allocation=['length', 'dim'])
+    def __init__(self, length, dim, rank, **kwargs):
+        super(FactorizedLookupTable, self).__init__(**kwargs)
+        self.length = length
+        self.dim = dim
+        self.rank = rank
+
+        self.table = LookupTable(name='table')
+        self.projection = Linear(use_bias=False, name='projection')
+        self.children = [self.table, self.projection]
+
+    def _push_allocation_config(self):
+        self.table.length = self.length
+        self.table.dim = self.rank
+        self.projection.input_dim = self.rank
+        self.projection.output_dim = self.dim
+
+    @application(inputs=['indices'], outputs=['output'])
+    def apply(self, indices):
+        return self.projection.apply(self.table.apply(indices))
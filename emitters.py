@@ -0,0 +1,366 @@
+# Output layers for large target vocabularies
+import logging
+import numpy
+import theano
+from theano import tensor
+from theano.sandbox.blocksparse import sparse_block_dot
+
+from blocks.bricks import Linear
+from blocks.bricks.base import application
+from blocks.bricks.sequence_generators import SoftmaxEmitter
+from blocks.roles import add_role, WEIGHT, BIAS
+from blocks.utils import shared_floatx, shared_floatx_nans
+
+logger = logging.getLogger(__name__)
+
+
+class ShortlistLinear(Linear):
+    """Output projection which can be restricted to a list of words.
+
+    When `use_shortlist` is set, single step inputs (as in sampling and
+    beam search) are only multiplied with the columns of the words given
+    to :meth:`set_shortlist`, which are gathered once into separate
+    shared variables. The output then only has the energies of the words
+    of the shortlist, in its order, so a decoding step costs O(shortlist)
+    instead of O(vocabulary); :class:`ShortlistSoftmaxEmitter` maps the
+    positions in the shortlist back to word indices. Sequences (training)
+    always use the full matrix.
+
+    Parameters
+    ----------
+    use_shortlist : bool
+        Whether to restrict single step outputs to the shortlist.
+
+    """
+    def __init__(self, use_shortlist=False, **kwargs):
+        super(ShortlistLinear, self).__init__(**kwargs)
+        self.use_shortlist = use_shortlist
+        self._gather = None
+
+    def _allocate(self):
+        super(ShortlistLinear, self)._allocate()
+        self.shortlist = theano.shared(numpy.zeros(0, dtype='int64'),
+                                       name='shortlist')
+        self.shortlist_W = shared_floatx(
+            numpy.zeros((self.input_dim, 0)), name='shortlist_W')
+        self.shortlist_b = shared_floatx(numpy.zeros(0), name='shortlist_b')
+
+    def set_shortlist(self, shortlist):
+        """Gathers the columns of the given sorted word indices."""
+        if self._gather is None:
+            indices = tensor.lvector('shortlist')
+            updates = [(self.shortlist, indices),
+                       (self.shortlist_W, self.W.T[indices].T)]
+            if self.use_bias:
+                updates.append((self.shortlist_b, self.b[indices]))
+            self._gather = theano.function([indices], [], updates=updates)
+        self._gather(shortlist)
+
+    def restricts(self, input_):
+        """Whether the output for `input_` only spans the shortlist."""
+        return self.use_shortlist and input_.ndim == 2
+
+    @application(inputs=['input_'], outputs=['output'])
+    def apply(self, input_):
+        if self.restricts(input_):
+            output = tensor.dot(input_, self.shortlist_W)
+            if self.use_bias:
+                output += self.shortlist_b
+            return output
+
+        output = tensor.dot(input_, self.W)
+        if self.use_bias:
+            output += self.b
+        return output
+
+
+class ShortlistSoftmaxEmitter(SoftmaxEmitter):
+    """Softmax emitter whose energies may only span a shortlist.
+
+    When a :class:`ShortlistLinear` restricts single step energies to its
+    shortlist, the probabilities are those of the words of the shortlist,
+    in its order. Emitted positions are then mapped to word indices, and
+    the word indices whose costs are asked for to positions, so that the
+    feedback and the outputs of the sequence generator stay word indices.
+    Words out of the shortlist have a probability of zero, i.e. an
+    infinite cost.
+
+    Parameters
+    ----------
+    projection : ShortlistLinear
+        The projection which computes the energies of the words.
+
+    """
+    def __init__(self, projection, **kwargs):
+        super(ShortlistSoftmaxEmitter, self).__init__(**kwargs)
+        self.projection = projection
+
+    def words(self, readouts, positions):
+        """The word indices of positions in the probabilities of readouts."""
+        if self.projection.restricts(readouts):
+            return self.projection.shortlist[positions]
+        return positions
+
+    @application
+    def emit(self, readouts):
+        return self.words(
+            readouts, super(ShortlistSoftmaxEmitter, self).emit(readouts))
+
+    @application
+    def cost(self, readouts, outputs):
+        if not self.projection.restricts(readouts):
+            return super(ShortlistSoftmaxEmitter, self).cost(readouts,
+                                                             outputs)
+        found = tensor.eq(outputs[:, None],
+                          self.projection.shortlist[None, :])
+        costs = super(ShortlistSoftmaxEmitter, self).cost(
+            readouts, found.argmax(axis=1))
+        return tensor.switch(
+            found.any(axis=1), costs,
+            numpy.asarray(numpy.inf, dtype=theano.config.floatX))
+
+
+class SampledSoftmaxEmitter(ShortlistSoftmaxEmitter):
+    """Softmax emitter trained on a sampled subset of the vocabulary.
+
+    Unlike SoftmaxEmitter, this brick owns the output projection
+    (``softmax1``), so the readouts it receives are the `embedding_dim`
+    outputs of ``softmax0``. When the cost of whole target sequences is
+    computed (training), the softmax is restricted to the words of the
+    batch plus `num_samples` negatives drawn uniformly from the
+    vocabulary, as in Jean et al. (2015). Since the proposal distribution
+    is uniform over the candidate set, the importance weights are constant
+    and the approximation reduces to a softmax over the candidates.
+
+    Single step costs and probabilities, as used by sampling and beam
+    search, are computed over the full vocabulary, or its shortlist, as
+    are the costs of sequences while `full_cost` is set, e.g. to build
+    the graph of the validation perplexity.
+
+    Parameters
+    ----------
+    vocab_size : int
+        The size of the target vocabulary.
+    num_samples : int
+        The number of negative words sampled for every batch.
+    shortlist : bool
+        Whether to decode with a vocabulary shortlist, see
+        :class:`ShortlistLinear`.
+
+    """
+    def __init__(self, vocab_size, num_samples, shortlist=False, **kwargs):
+        super(SampledSoftmaxEmitter, self).__init__(
+            ShortlistLinear(use_shortlist=shortlist, name='softmax1'),
+            **kwargs)
+        self.vocab_size = vocab_size
+        self.num_samples = num_samples
+        self.full_cost = False
+        self.children = [self.projection]
+
+    def _push_allocation_config(self):
+        self.projection.input_dim = self.readout_dim
+        self.projection.output_dim = self.vocab_size
+
+    def _softmax(self, energies):
+        shape = energies.shape
+        return tensor.nnet.softmax(energies.reshape(
+            (tensor.prod(shape[:-1]), shape[-1]))).reshape(shape)
+
+    @application
+    def probs(self, readouts):
+        return self._softmax(self.projection.apply(readouts))
+
+    @application
+    def cost(self, readouts, outputs):
+        if readouts.ndim < 3 or self.full_cost:
+            return super(SampledSoftmaxEmitter, self).cost(readouts, outputs)
+
+        flat_readouts = readouts.reshape(
+            (tensor.prod(readouts.shape[:-1]), readouts.shape[-1]))
+        flat_outputs = outputs.flatten()
+
+        # Candidate set: batch targets plus uniform negatives, sorted
+        negatives = tensor.cast(
+            self.theano_rng.uniform((self.num_samples,)) * self.vocab_size,
+            'int64')
+        negatives = tensor.minimum(negatives, self.vocab_size - 1)
+        candidates = tensor.extra_ops.Unique()(
+            tensor.concatenate([flat_outputs, negatives]))
+
+        # Position of every target word in the candidate set
+        positions = tensor.zeros((self.vocab_size,), dtype='int64')
+        positions = tensor.set_subtensor(
+            positions[candidates], tensor.arange(candidates.shape[0]))
+
+        energies = (tensor.dot(flat_readouts,
+                               self.projection.W.T[candidates].T) +
+                    self.projection.b[candidates])
+        costs = tensor.nnet.categorical_crossentropy(
+            tensor.nnet.softmax(energies), positions[flat_outputs])
+        return costs.reshape(outputs.shape)
+
+
+class ClassSoftmaxEmitter(SoftmaxEmitter):
+    """Two-level softmax emitter over classes of words.
+
+    The probability of a word is factored into the probability of its
+    class and the probability of the word within that class, so the cost
+    of a word only involves the class softmax and the softmax over the
+    members of its class, i.e. O(sqrt(V)) operations for about sqrt(V)
+    classes of equal size. Word weights are stored by class in a
+    (classes, readout_dim, class_size) tensor and multiplied with
+    :func:`~theano.sandbox.blocksparse.sparse_block_dot`. Probabilities
+    over the whole vocabulary (sampling and beam search) are exact but
+    O(V).
+
+    Like SampledSoftmaxEmitter, this brick replaces ``softmax1`` and
+    receives the outputs of ``softmax0`` as readouts.
+
+    Parameters
+    ----------
+    word_classes : :class:`numpy.ndarray`
+        The class of every word of the vocabulary, see
+        :func:`build_word_classes`.
+
+    """
+    def __init__(self, word_classes, **kwargs):
+        super(ClassSoftmaxEmitter, self).__init__(**kwargs)
+        word_classes = numpy.asarray(word_classes, dtype='int64')
+        self.vocab_size = len(word_classes)
+        self.num_classes = word_classes.max() + 1
+        class_sizes = numpy.bincount(word_classes,
+                                     minlength=self.num_classes)
+        self.class_size = class_sizes.max()
+
+        # Slot of every word in its class, in vocabulary order
+        word_slots = numpy.zeros_like(word_classes)
+        next_slot = numpy.zeros(self.num_classes, dtype='int64')
+        for word, word_class in enumerate(word_classes):
+            word_slots[word] = next_slot[word_class]
+            next_slot[word_class] += 1
+        self.word_classes = word_classes
+        self.word_slots = word_slots
+
+        # Unused slots of the smaller classes are never emitted
+        self.slot_penalty = numpy.where(
+            numpy.arange(self.class_size)[None, :] < class_sizes[:, None],
+            0, -1e20).astype(theano.config.floatX)
+
+        self.class_projection = Linear(name='softmax_classes')
+        self.children = [self.class_projection]
+
+    def _push_allocation_config(self):
+        self.class_projection.input_dim = self.readout_dim
+        self.class_projection.output_dim = self.num_classes
+
+    def _allocate(self):
+        W = shared_floatx_nans((self.num_classes, self.readout_dim,
+                                self.class_size), name='W_words')
+        add_role(W, WEIGHT)
+        b = shared_floatx_nans((self.num_classes, self.class_size),
+                               name='b_words')
+        add_role(b, BIAS)
+        self.params = [W, b]
+
+    def _initialize(self):
+        W, b = self.params
+        self.weights_init.initialize(W, self.rng)
+        self.biases_init.initialize(b, self.rng)
+
+    @application
+    def probs(self, readouts):
+        W, b = self.params
+        flat_readouts = readouts.reshape(
+            (tensor.prod(readouts.shape[:-1]), readouts.shape[-1]))
+
+        class_probs = tensor.nnet.softmax(
+            self.class_projection.apply(flat_readouts))
+        energies = (tensor.dot(flat_readouts, W.dimshuffle(1, 0, 2).reshape(
+            (self.readout_dim, self.num_classes * self.class_size))) +
+            (b + self.slot_penalty).flatten())
+        word_probs = tensor.nnet.softmax(
+            energies.reshape((-1, self.class_size))).reshape(
+                (-1, self.num_classes, self.class_size))
+        probs = (class_probs[:, :, None] * word_probs).reshape(
+            (-1, self.num_classes * self.class_size))
+        probs = probs.T[self.word_classes * self.class_size +
+                        self.word_slots].T
+        return probs.reshape(
+            [readouts.shape[i] for i in range(readouts.ndim - 1)] +
+            [self.vocab_size], ndim=readouts.ndim)
+
+    @application
+    def cost(self, readouts, outputs):
+        W, b = self.params
+        flat_readouts = readouts.reshape(
+            (tensor.prod(readouts.shape[:-1]), readouts.shape[-1]))
+        flat_outputs = outputs.flatten()
+        classes = tensor.constant(self.word_classes)[flat_outputs]
+        slots = tensor.constant(self.word_slots)[flat_outputs]
+
+        class_costs = tensor.nnet.categorical_crossentropy(
+            tensor.nnet.softmax(self.class_projection.apply(flat_readouts)),
+            classes)
+
+        # Only the words of the target class are computed
+        energies = sparse_block_dot(
+            W[None, :, :, :], flat_readouts[:, None, :],
+            tensor.zeros((flat_readouts.shape[0], 1), dtype='int32'),
+            b + self.slot_penalty,
+            tensor.cast(classes, 'int32')[:, None])
+        word_costs = tensor.nnet.categorical_crossentropy(
+            tensor.nnet.softmax(energies[:, 0, :]), slots)
+        return (class_costs + word_costs).reshape(outputs.shape)
+
+
+def count_words(data, vocab, vocab_size, unk_id, eos_idx):
+    """Counts the word indices of a tokenized text file."""
+    counts = numpy.zeros(vocab_size, dtype='int64')
+    for line in open(data):
+        for word in line.split():
+            idx = vocab.get(word, unk_id)
+            counts[idx if idx < vocab_size else unk_id] += 1
+        counts[eos_idx] += 1
+    return counts
+
+
+def build_word_classes(counts, num_classes=None):
+    """Assigns words to frequency classes of equal size.
+
+    Words are sorted by decreasing count and cut into `num_classes`
+    contiguous bins, about sqrt(V) by default, so that frequent words
+    share the first classes and rare words the last ones.
+    """
+    vocab_size = len(counts)
+    if num_classes is None:
+        num_classes = int(numpy.ceil(numpy.sqrt(vocab_size)))
+    class_size = int(numpy.ceil(vocab_size / float(num_classes)))
+    word_classes = numpy.zeros(vocab_size, dtype='int64')
+    word_classes[numpy.argsort(-counts, kind='mergesort')] = \
+        numpy.arange(vocab_size) // class_size
+    return word_classes
+
+
+if __name__ == "__main__":
+    import argparse
+    import cPickle
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Build the word classes of a ClassSoftmaxEmitter")
+    parser.add_argument("trg_data", help="Tokenized target side text")
+    parser.add_argument("trg_vocab", help="Pickled target vocabulary")
+    parser.add_argument("saveto", help="Where to pickle the classes")
+    parser.add_argument("--trg-vocab-size", type=int, default=40001)
+    parser.add_argument("--unk-id", type=int, default=1)
+    parser.add_argument("--eos-idx", type=int, default=40000)
+    parser.add_argument("--num-classes", type=int, default=None)
+    args = parser.parse_args()
+
+    word_classes = build_word_classes(
+        count_words(args.trg_data, cPickle.load(open(args.trg_vocab)),
+                    args.trg_vocab_size, args.unk_id, args.eos_idx),
+        args.num_classes)
+    logger.info("Built {} classes of at most {} words".format(
+        word_classes.max() + 1, numpy.bincount(word_classes).max()))
+    cPickle.dump(word_classes, open(args.saveto, 'wb'),
+                 protocol=cPickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,170 @@
+# Fork bricks doing a single matrix product for all their outputs
+import logging
+import numpy
+
+from blocks.bricks import Initializable, Linear
+from blocks.bricks.base import application, lazy
+
+logger = logging.getLogger(__name__)
+
+
+class FusedFork(Initializable):
+    """Drop-in replacement of Fork with a single linear transformation.
+
+    The weights of the transformations of all outputs are concatenated
+    into one matrix, so that the input is multiplied once and the result
+    is split into the outputs. The parameters are named ``fused.W`` and
+    ``fused.b``; :meth:`fuse_param_values` and :meth:`split_param_values`
+    map them from and to the ``fork_<output_name>`` parameters of a Fork.
+
+    Parameters
+    ----------
+    output_names : list of str
+        The names of the outputs.
+    input_dim : int
+        The dimension of the input.
+    output_dims : list of int
+        The dimensions of the outputs.
+
+    """
+    @lazy(allocation=['input_dim', 'output_dims'])
+    def __init__(self, output_names, input_dim, output_dims, **kwargs):
+        super(FusedFork, self).__init__(**kwargs)
+        self.output_names = output_names
+        self.input_dim = input_dim
+        self.output_dims = output_dims
+
+        self.linear = Linear(name='fused')
+        self.children = [self.linear]
+
+    def _push_allocation_config(self):
+        self.linear.input_dim = self.input_dim
+        self.linear.output_dim = sum(self.output_dims)
+
+    def _split(self, output):
+        outputs = []
+        start = 0
+        for dim in self.output_dims:
+            outputs.append(output[(slice(None),) * (output.ndim - 1) +
+                                  (slice(start, start + dim),)])
+            start += dim
+        return outputs
+
+    @application(inputs=['input_'])
+    def apply(self, input_):
+        return self._split(self.linear.apply(input_))
+
+    @apply.property('outputs')
+    def apply_outputs(self):
+        return self.output_names
+
+    def _names(self, path):
+        fused = ['{}/{}.{}'.format(path, self.linear.name, suffix)
+                 for suffix in ['W', 'b']]
+        original = [['{}/fork_{}.{}'.format(path, name, suffix)
+                     for name in self.output_names] for suffix in ['W', 'b']]
+        return zip(fused, original, [1, 0])
+
+    def fuse_param_values(self, values, path):
+        """Replaces the values of Fork parameters by fused ones, in place.
+
+        Parameters
+        ----------
+        values : dict
+            Parameter values by name, as in a dump.
+        path : str
+            The name of this brick in `values`, e.g.
+            ``/bidirectionalencoder/fwd_fork``.
+
+        """
+        for fused, original, axis in self._names(path):
+            if all(name in values for name in original):
+                values[fused] = numpy.concatenate(
+                    [values.pop(name) for name in original], axis=axis)
+
+    def split_param_values(self, values, path):
+        """Replaces fused parameter values by those of a Fork, in place."""
+        for fused, original, axis in self._names(path):
+            if fused in values:
+                parts = numpy.split(values.pop(fused),
+                                    numpy.cumsum(self.output_dims)[:-1],
+                                    axis=axis)
+                values.update(zip(original, parts))
+
+
+class FusedDistribute(FusedFork):
+    """Drop-in replacement of Distribute with a single transformation.
+
+    Parameters
+    ----------
+    target_names : list of str
+        The inputs to which the transformed source is added.
+    source_name : str
+        The input to transform.
+
+    """
+    def __init__(self, target_names, source_name, **kwargs):
+        super(FusedDistribute, self).__init__(target_names, **kwargs)
+        self.target_names = target_names
+        self.source_name = source_name
+
+    @property
+    def source_dim(self):
+        return self.input_dim
+
+    @source_dim.setter
+    def source_dim(self, value):
+        self.input_dim = value
+
+    @property
+    def target_dims(self):
+        return self.output_dims
+
+    @target_dims.setter
+    def target_dims(self, value):
+        self.output_dims = value
+
+    @application
+    def apply(self, **kwargs):
+        source = kwargs.pop(self.source_name)
+        return [kwargs[name] + output for name, output in
+                zip(self.target_names,
+                    self._split(self.linear.apply(source)))]
+
+    @apply.property('inputs')
+    def apply_inputs(self):
+        return [self.source_name] + self.target_names
+
+    @apply.property('outputs')
+    def apply_outputs(self):
+        return self.target_names
+
+
+def _all_bricks(bricks):
+    for brick in bricks:
+        yield brick
+        for child in _all_bricks(brick.children):
+            yield child
+
+
+def _fused_forks(model):
+    """The FusedFork bricks of a model and their paths."""
+    names = dict((param, name) for name, param
+                 in model.get_params().iteritems())
+    for brick in _all_bricks(model.get_top_bricks()):
+        if isinstance(brick, FusedFork):
+            yield brick, names[brick.linear.W].rsplit('/', 1)[0]
+
+
+def fuse_dumped_params(model, values):
+    """Maps dumped Fork parameters to the FusedFork bricks of a model."""
+    for brick, path in _fused_forks(model):
+        brick.fuse_param_values(values, path)
+    return values
+
+
+def split_fused_params(model, values):
+    """Maps the FusedFork parameters of a model to Fork ones, to dump."""
+    for brick, path in _fused_forks(model):
+        brick.split_param_values(values, path)
+    return values
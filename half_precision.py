@@ -0,0 +1,101 @@
+# Step rules keeping their state in half precision
+import logging
+from collections import OrderedDict
+import numpy
+import theano
+from theano import tensor
+
+from blocks.algorithms import StepRule
+from blocks.utils import shared_floatx
+
+logger = logging.getLogger(__name__)
+
+# Scaled values are kept below 2 ** 15, the largest float16 is 65504
+MAX_EXPONENT = 15
+
+
+def _scale(max_abs, max_scale_exponent):
+    """Largest power of two scaling `max_abs` into the float16 range."""
+    exponent = tensor.floor(
+        MAX_EXPONENT - tensor.log2(tensor.maximum(max_abs, 1e-30)))
+    return tensor.cast(2 ** tensor.minimum(exponent, max_scale_exponent),
+                       theano.config.floatX)
+
+
+def _row_update(state, new_value):
+    """Whether an update only sets some rows of the state."""
+    return (new_value.owner is not None and
+            isinstance(new_value.owner.op,
+                       tensor.subtensor.AdvancedIncSubtensor1) and
+            new_value.owner.inputs[0] is state)
+
+
+class Float16State(StepRule):
+    """Stores the state of a step rule in float16.
+
+    The state variables of `step_rule`, e.g. the two accumulators of
+    AdaDelta, are replaced by float16 shared variables. The steps are
+    still computed in float32: the state is cast up when it is read and
+    cast down when it is updated. Every state variable is stored times a
+    power of two scale, chosen at every update as the largest one which
+    keeps the variable under 2 ** 15, so that small values such as mean
+    squared gradients do not underflow. This halves the memory of the
+    optimizer state.
+
+    Scalar states, such as the time step of Adam, stay in float32, and
+    so do the states of which only some rows are updated, as by the
+    _SubtensorFix rules: with a scale for the whole variable, every row
+    update would read and write all of it.
+
+    Parameters
+    ----------
+    step_rule : StepRule
+        The step rule whose state to store in float16.
+    max_scale_exponent : int
+        The logarithm of the largest scale, 24 so that the smallest
+        positive float16 is scaled back to about 2 ** -48.
+
+    """
+    def __init__(self, step_rule, max_scale_exponent=24):
+        self.step_rule = step_rule
+        self.max_scale_exponent = max_scale_exponent
+
+    def compute_steps(self, previous_steps):
+        steps, updates = self.step_rule.compute_steps(previous_steps)
+
+        replace = {}
+        half_states = []
+        for i, (state, new_value) in enumerate(updates):
+            if (state.ndim == 0 or state.dtype != theano.config.floatX or
+                    _row_update(state, new_value)):
+                continue
+            name = state.name or 'state_{}'.format(i)
+            value = state.get_value()
+            scale = shared_floatx(
+                _scale(numpy.abs(value).max(),
+                       self.max_scale_exponent).eval(),
+                name=name + '_scale')
+            half = theano.shared((value * scale.get_value()).astype('float16'),
+                                 name=name)
+            replace[state] = tensor.cast(half, theano.config.floatX) / scale
+            half_states.append((state, half, scale))
+        logger.info("{} step rule states stored in float16".format(
+            len(half_states)))
+
+        names = steps.keys()
+        outputs = theano.clone([steps[name] for name in names] +
+                               [new_value for _, new_value in updates],
+                               replace=replace)
+        steps = OrderedDict(zip(names, outputs[:len(names)]))
+        new_values = OrderedDict(zip([state for state, _ in updates],
+                                     outputs[len(names):]))
+
+        half_updates = [(state, new_value) for state, new_value
+                        in new_values.items() if state not in replace]
+        for state, half, scale in half_states:
+            new_value = new_values[state]
+            new_scale = _scale(abs(new_value).max(), self.max_scale_exponent)
+            half_updates.append(
+                (half, tensor.cast(new_value * new_scale, 'float16')))
+            half_updates.append((scale, new_scale))
+        return steps, half_updates
@@ -0,0 +1,148 @@
+# Attention over a window of the source around a predicted position
+import logging
+import numpy
+import theano
+from theano import tensor
+
+from blocks.bricks import Logistic, MLP, Tanh
+from blocks.bricks.attention import SequenceContentAttention
+from blocks.bricks.base import application
+
+logger = logging.getLogger(__name__)
+
+
+class LocalContentAttention(SequenceContentAttention):
+    """Content attention restricted to a window of the attended sequence.
+
+    The local-p attention of Luong et al. (2015): the aligned position of
+    every sentence is predicted from the decoder state as ``(S - 1) *
+    sigmoid(v^T tanh(W s))``, where S is the length of the source, and
+    the energies are only computed for the ``2 * window + 1`` positions
+    around it. The weights are favoured near the predicted position with
+    a Gaussian of standard deviation ``window / 2``, through which the
+    position predictor is trained. A step therefore costs O(window)
+    instead of O(S).
+
+    The weights glimpse only spans the window, and the positions of its
+    weights in the source are the ``weight_positions`` glimpse, so the
+    decoder keeps O(window) instead of O(S) values per step. The weights
+    of positions out of the sentence are zero. :meth:`alignment` expands
+    the weights of a whole decoding to the source, outside of its scan.
+
+    Parameters
+    ----------
+    window : int
+        The number of positions attended on each side of the predicted
+        position.
+
+    """
+    def __init__(self, window, **kwargs):
+        super(LocalContentAttention, self).__init__(**kwargs)
+        self.window = window
+
+        self.position_predictor = MLP([Tanh(), Logistic()], [None, None, 1],
+                                      name='position_predictor')
+        self.children.append(self.position_predictor)
+
+    def _push_allocation_config(self):
+        super(LocalContentAttention, self)._push_allocation_config()
+        self.position_predictor.dims = [self.state_dims[0], self.match_dim, 1]
+
+    def get_dim(self, name):
+        if name in ['weights', 'weight_positions']:
+            return 2 * self.window + 1
+        return super(LocalContentAttention, self).get_dim(name)
+
+    @application
+    def initial_glimpses(self, name, batch_size, attended):
+        if name == 'weight_positions':
+            return tensor.zeros((batch_size, self.get_dim(name)),
+                                dtype='int64')
+        if name == 'weights':
+            return tensor.zeros((batch_size, self.get_dim(name)))
+        return super(LocalContentAttention, self).initial_glimpses(
+            name, batch_size, attended)
+
+    @application(outputs=['weighted_averages', 'weights', 'weight_positions'])
+    def take_glimpses(self, attended, preprocessed_attended=None,
+                      attended_mask=None, **states):
+        if preprocessed_attended is None:
+            preprocessed_attended = self.preprocess(attended)
+        length = attended.shape[0]
+        batch_size = attended.shape[1]
+        if attended_mask is not None:
+            lengths = attended_mask.sum(axis=0)
+        else:
+            lengths = tensor.ones((batch_size,)) * length
+
+        # Window positions, those out of the sentence are masked
+        positions = (lengths - 1) * self.position_predictor.apply(
+            states[self.state_names[0]])[:, 0]
+        indices = (tensor.cast(tensor.round(positions), 'int64')[:, None] +
+                   numpy.arange(-self.window, self.window + 1))
+        window_mask = tensor.cast((indices >= 0) &
+                                  (indices < lengths[:, None]),
+                                  theano.config.floatX)
+        indices = tensor.clip(indices, 0, length - 1)
+
+        # Gather the window with flat indices, (window, batch, dim)
+        flat_indices = (indices * batch_size +
+                        tensor.arange(batch_size)[:, None]).T.flatten()
+
+        def gather(variable):
+            return variable.reshape(
+                (length * batch_size, variable.shape[2]))[flat_indices] \
+                .reshape((indices.shape[1], batch_size, variable.shape[2]))
+        window_attended = gather(attended)
+
+        transformed_states = self.state_transformers.apply(as_dict=True,
+                                                           **states)
+        match_vectors = sum(transformed_states.values(),
+                            gather(preprocessed_attended))
+        energies = self.energy_computer.apply(match_vectors).reshape(
+            match_vectors.shape[:-1], ndim=match_vectors.ndim - 1)
+
+        # Masked softmax over the window times the Gaussian prior
+        unnormalized = (tensor.exp(energies - energies.max(axis=0)) *
+                        window_mask.T)
+        weights = unnormalized / unnormalized.sum(axis=0)
+        weights *= tensor.exp(
+            -(indices - positions[:, None]) ** 2 /
+            (2 * (self.window / 2.) ** 2)).T
+        weighted_averages = (weights[:, :, None] * window_attended).sum(axis=0)
+        return weighted_averages, weights.T, indices
+
+    def alignment(self, weights, weight_positions, length):
+        """The weights of a decoding over the whole source.
+
+        Parameters
+        ----------
+        weights : Theano variable
+            The weights glimpses of the decoding, (time, batch, window).
+        weight_positions : Theano variable
+            The weight_positions glimpses of the decoding.
+        length : Theano variable
+            The length of the source.
+
+        Returns
+        -------
+        Theano variable
+            The weights of every source position, (time, batch, length).
+            Positions are clipped to the sentence, so repeated ones have a
+            zero weight.
+
+        """
+        rows = weights.shape[0] * weights.shape[1]
+        flat_positions = (tensor.arange(rows)[:, None] * length +
+                          weight_positions.reshape((rows, weights.shape[2])))
+        flat_weights = tensor.inc_subtensor(
+            tensor.zeros((rows * length,),
+                         dtype=weights.dtype)[flat_positions.flatten()],
+            weights.flatten())
+        return flat_weights.reshape((weights.shape[0], weights.shape[1],
+                                     length))
+
+    @take_glimpses.property('inputs')
+    def take_glimpses_inputs(self):
+        return (['attended', 'preprocessed_attended', 'attended_mask'] +
+                self.state_names)
@@ -0,0 +1,193 @@
+# Peak memory of the training function by batch shape
+import itertools
+import json
+import logging
+import re
+from StringIO import StringIO
+import numpy
+import theano
+from theano.compile.function_module import Function
+
+from fuel.transformers import Transformer
+
+logger = logging.getLogger(__name__)
+
+
+def _features(batch_size, source_length, target_length):
+    """The terms of the parameters, encoder, decoder and attention."""
+    return numpy.array([1., batch_size * source_length,
+                        batch_size * target_length,
+                        batch_size * source_length * target_length])
+
+
+class MemoryModel(object):
+    """Peak memory of a training step as a function of the batch shape.
+
+    The peak is modelled as ``a + B * (b * S + c * T + d * S * T)`` for a
+    batch of B sentences of source length S and target length T: the
+    parameters and optimizer state, the encoder states, the decoder
+    states and readouts, and the attention weights of every target word
+    over the source.
+
+    Parameters
+    ----------
+    coefficients : list of float
+        The coefficients a, b, c and d, in megabytes.
+
+    """
+    def __init__(self, coefficients):
+        self.coefficients = numpy.asarray(coefficients, dtype='float64')
+
+    @classmethod
+    def fit(cls, measurements):
+        """Least squares fit of (B, S, T, megabytes) measurements."""
+        measurements = numpy.asarray(measurements, dtype='float64')
+        features = numpy.array([_features(*shape)
+                                for shape in measurements[:, :3]])
+        coefficients = numpy.linalg.lstsq(features, measurements[:, 3])[0]
+        return cls(coefficients)
+
+    @classmethod
+    def load(cls, path):
+        return cls(json.load(open(path))['coefficients'])
+
+    def save(self, path, measurements=()):
+        json.dump({'coefficients': self.coefficients.tolist(),
+                   'measurements': [list(measurement)
+                                    for measurement in measurements]},
+                  open(path, 'w'), indent=2)
+
+    def predict(self, batch_size, source_length, target_length):
+        """Peak megabytes of a batch."""
+        return float(self.coefficients.dot(
+            _features(batch_size, source_length, target_length)))
+
+    def max_batch_size(self, source_length, target_length, budget):
+        """The largest number of sentences of a batch within the budget."""
+        fixed = self.coefficients[0]
+        per_sentence = self.coefficients[1:].dot(
+            _features(1, source_length, target_length)[1:])
+        if per_sentence <= 0:
+            return numpy.inf
+        return max(int((budget - fixed) / per_sentence), 0)
+
+
+def _peak_memory(function):
+    """Peak megabytes of the last call of a memory profiled function.
+
+    The estimate is that of the Theano memory profiler, from the shapes
+    of the variables of the call, on the CPU and the GPU together.
+
+    """
+    summary = StringIO()
+    function.profile.summary_memory(summary)
+    match = re.search(r'Max peak memory with current setting.*?'
+                      r'CPU \+ GPU: (\d+)KB', summary.getvalue(), re.DOTALL)
+    if match is None:
+        raise ValueError("No peak memory in the profile of {}".format(
+            function.name))
+    return int(match.group(1)) / 1024.
+
+
+def profile_memory(algorithm, shapes, src_vocab_size, trg_vocab_size):
+    """Measures the peak memory of the training steps of some shapes.
+
+    The algorithm is initialized with the memory profiler of Theano, and
+    a step is done on a random batch of every (batch size, source length,
+    target length) shape, so the parameters are changed. The peak is
+    that of the function of the algorithm using the most memory.
+
+    Returns
+    -------
+    list of tuples
+        The (batch size, source length, target length, megabytes)
+        measurements.
+
+    """
+    flags = theano.config.profile, theano.config.profile_memory
+    theano.config.profile = theano.config.profile_memory = True
+    try:
+        algorithm.initialize()
+    finally:
+        theano.config.profile, theano.config.profile_memory = flags
+    functions = [value for value in vars(algorithm).values()
+                 if isinstance(value, Function)]
+
+    rng = numpy.random.RandomState(1234)
+    measurements = []
+    for batch_size, source_length, target_length in shapes:
+        algorithm.process_batch({
+            'source': rng.randint(src_vocab_size,
+                                  size=(batch_size, source_length)),
+            'source_mask': numpy.ones((batch_size, source_length),
+                                      dtype=theano.config.floatX),
+            'target': rng.randint(trg_vocab_size,
+                                  size=(batch_size, target_length)),
+            'target_mask': numpy.ones((batch_size, target_length),
+                                      dtype=theano.config.floatX)})
+        peak = max(_peak_memory(function) for function in functions)
+        logger.info("Batch {} x {} -> {}: {:.1f} MB".format(
+            batch_size, source_length, target_length, peak))
+        measurements.append((batch_size, source_length, target_length, peak))
+    return measurements
+
+
+def profile_shapes(batch_size, seq_len):
+    """Shapes from a few sentences to the largest batch of a config."""
+    batch_sizes = sorted(set([max(batch_size / 4, 1),
+                              max(batch_size / 2, 1), batch_size]))
+    lengths = sorted(set([max(seq_len / 5, 1), max(seq_len / 2, 1),
+                          seq_len]))
+    return list(itertools.product(batch_sizes, lengths, lengths))
+
+
+class MemoryCappedBatch(Transformer):
+    """Batches examples, fewer of them when they would not fit in memory.
+
+    Examples are added to a batch up to `batch_size`, unless the memory
+    predicted for the batch padded to its longest source and target
+    would exceed `budget`, in which case the example starts the next
+    batch. With sorted examples, long sentences thus get smaller batches.
+
+    Parameters
+    ----------
+    data_stream : DataStream
+        A stream of (source, target) examples.
+    batch_size : int
+        The largest number of examples of a batch.
+    memory_model : MemoryModel
+        The model of the peak memory of a batch.
+    budget : float
+        The megabytes a batch may use.
+
+    """
+    def __init__(self, data_stream, batch_size, memory_model, budget,
+                 **kwargs):
+        super(MemoryCappedBatch, self).__init__(data_stream, **kwargs)
+        self.batch_size = batch_size
+        self.memory_model = memory_model
+        self.budget = budget
+        self.pending = None
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        examples = []
+        if self.pending is not None:
+            examples.append(self.pending)
+            self.pending = None
+        while len(examples) < self.batch_size:
+            try:
+                example = next(self.child_epoch_iterator)
+            except StopIteration:
+                if not examples:
+                    raise
+                break
+            lengths = [max(len(past[i]) for past in examples + [example])
+                       for i in range(2)]
+            if examples and self.memory_model.predict(
+                    len(examples) + 1, *lengths) > self.budget:
+                self.pending = example
+                break
+            examples.append(example)
+        return tuple(numpy.asarray(source) for source in zip(*examples))
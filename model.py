@@ -1,22 +1,28 @@
 # This is the RNNsearch model
 from collections import Counter
+from functools import partial
 import argparse
+import cPickle
 import importlib
 import logging
+import os
 import pprint
+import theano
 from theano import tensor
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 from toolz import merge
 from picklable_itertools.extras import equizip
 
 from blocks.algorithms import (GradientDescent, StepClipping, AdaDelta,
-                               CompositeRule, RemoveNotFinite)
-from blocks.dump import MainLoopDumpManager
+                               CompositeRule, RemoveNotFinite, Scale,
+                               Momentum, RMSProp, Adam)
+from blocks.dump import MainLoopDumpManager, save_parameter_values
 from blocks.filter import VariableFilter
 from blocks.main_loop import MainLoop
 from blocks.model import Model
 from blocks.graph import ComputationGraph, apply_noise, apply_dropout
 from blocks.initialization import IsotropicGaussian, Orthogonal, Constant
-from blocks.extensions import Printing
+from blocks.extensions import FinishAfter, Printing
 from blocks.extensions.monitoring import TrainingDataMonitoring
 from blocks.extensions.saveload import LoadFromDump, Dump
 from blocks.extensions.plot import Plot
@@ -29,6 +35,7 @@ from blocks.bricks.lookup import LookupTable
 from blocks.bricks.parallel import Fork
 from blocks.bricks.recurrent import GatedRecurrent, Bidirectional
 from blocks.select import Selector
+from blocks.utils import dict_subset, dict_union
 from blocks.bricks.sequence_generators import (
     LookupFeedback, Readout, SoftmaxEmitter,
     SequenceGenerator
@@ -36,7 +43,18 @@ from blocks.bricks.sequence_generators import (
 
 import config
 
-from sampling import BleuValidator, Sampler
+from embeddings import FactorizedLookupTable, HashedLookupTable
+from emitters import (ClassSoftmaxEmitter, SampledSoftmaxEmitter,
+                      ShortlistLinear, ShortlistSoftmaxEmitter)
+from fork import (FusedDistribute, FusedFork, fuse_dumped_params,
+                  split_fused_params)
+from half_precision import Float16State
+from local_attention import LocalContentAttention
+from memory_profile import MemoryModel, profile_memory, profile_shapes
+from profiling import Profiler
+from sampling import BleuValidator, PerplexityValidator, Sampler
+from shortlist import Shortlist
+from training_log import ColumnarTrainingLog
 
 logger = logging.getLogger(__name__)
 
@@ -50,7 +68,7 @@ args = parser.parse_args()
 
 # Make config global, nasty workaround since parameterizing stream
 # will cause erroneous picklable behaviour, find a better solution
-config = getattr(config, args.proto)()
+config = config.get_config(args.proto)
 
 
 # Helper class
@@ -59,35 +77,93 @@ class InitializableFeedforwardSequence(FeedforwardSequence, Initializable):
 
 
 class MainLoopDumpManagerWMT15(MainLoopDumpManager):
-
-    def load_to(self, main_loop):
+    """Dump manager which can store the parameters in float16.
+
+    The parameters of FusedFork bricks are dumped as those of the Fork
+    bricks they replace, so that dumps can be loaded with or without
+    fused forks. A ColumnarTrainingLog is flushed to its files before it
+    is dumped.
+    """
+
+    def __init__(self, folder, float16=False):
+        super(MainLoopDumpManagerWMT15, self).__init__(folder)
+        self.float16 = float16
+
+    def dump_parameters(self, main_loop):
+        values = split_fused_params(main_loop.model,
+                                    main_loop.model.get_param_values())
+        if self.float16:
+            values = {name: value.astype('float16')
+                      for name, value in values.iteritems()}
+        save_parameter_values(values, self.path_to_parameters)
+
+    def dump_log(self, main_loop):
+        if isinstance(main_loop.log, ColumnarTrainingLog):
+            main_loop.log.flush()
+        super(MainLoopDumpManagerWMT15, self).dump_log(main_loop)
+
+    def load_to(self, main_loop, strict=False):
         """Loads the dump from the root folder into the main loop.
 
-        Only difference from super().load_to is the exception handling
-        for each step separately.
+        Differences from super().load_to are the exception handling
+        for each step separately, that parameters dumped from Fork
+        bricks are loaded into their FusedFork replacements, that
+        float16 parameters are cast back to floatX and that the files of a
+        ColumnarTrainingLog are truncated to the dumped log.
+
+        Errors are logged, so that training can start from scratch,
+        unless `strict` is set, in which case they are raised, as are
+        dumped parameters which are not exactly those of the model.
         """
         try:
-            logger.info("Loading model parameters...")
-            params = self.load_parameters()
-            main_loop.model.set_param_values(params)
-            for p, v in params.iteritems():
-                logger.info("Loaded {:15}: {}".format(v.shape, p))
-            logger.info("Number of parameters loaded: {}".format(len(params)))
+            self.load_parameters_to(main_loop.model, strict=strict)
         except Exception as e:
+            if strict:
+                raise
             logger.error("Error {0}".format(str(e)))
 
         try:
             logger.info("Loading iteration state...")
             main_loop.iteration_state = self.load_iteration_state()
         except Exception as e:
+            if strict:
+                raise
             logger.error("Error {0}".format(str(e)))
 
         try:
             logger.info("Loading log...")
             main_loop.log = self.load_log()
+            if isinstance(main_loop.log, ColumnarTrainingLog):
+                main_loop.log.truncate()
         except Exception as e:
+            if strict:
+                raise
             logger.error("Error {0}".format(str(e)))
 
+    def load_parameters_to(self, model, strict=False):
+        """Loads the dumped parameters into a model.
+
+        With `strict`, the dumped parameters must be exactly those of the
+        model, instead of only those with the same names being loaded.
+        """
+        logger.info("Loading model parameters...")
+        if not os.path.isfile(self.path_to_parameters):
+            raise IOError("No parameters dumped at {}".format(
+                self.path_to_parameters))
+        params = fuse_dumped_params(model, {
+            name: value.astype(theano.config.floatX) for name, value
+            in self.load_parameters().iteritems()})
+        names = set(model.get_params())
+        if strict and set(params) != names:
+            raise ValueError(
+                "Dumped parameters do not match the model, missing: {}, "
+                "unknown: {}".format(sorted(names - set(params)),
+                                     sorted(set(params) - names)))
+        model.set_param_values(params)
+        for p, v in params.iteritems():
+            logger.info("Loaded {:15}: {}".format(v.shape, p))
+        logger.info("Number of parameters loaded: {}".format(len(params)))
+
 
 class LoadFromDumpWMT15(LoadFromDump):
     """Wrapper to use MainLoopDumpManagerWMT15"""
@@ -97,6 +173,14 @@ class LoadFromDumpWMT15(LoadFromDump):
         self.manager = MainLoopDumpManagerWMT15(config_path)
 
 
+class DumpWMT15(Dump):
+    """Wrapper to use MainLoopDumpManagerWMT15"""
+
+    def __init__(self, state_path, float16=False, **kwargs):
+        super(DumpWMT15, self).__init__(state_path, **kwargs)
+        self.manager = MainLoopDumpManagerWMT15(state_path, float16=float16)
+
+
 class LookupFeedbackWMT15(LookupFeedback):
 
     @application
@@ -128,19 +212,107 @@ class BidirectionalWMT15(Bidirectional):
                 for f, b in equizip(forward, backward)]
 
 
+class FusedBidirectionalWMT15(BidirectionalWMT15):
+    """Runs both directions of a bidirectional GRU in a single scan.
+
+    The recurrent weights of the forward and backward networks are
+    stacked block-diagonally, so that every step computes the gates of
+    both directions with one matrix product and their candidate states
+    with another one, instead of two scans of three products each. The
+    parameters are still those of the `forward` and `backward` children,
+    and the outputs are the same as those of BidirectionalWMT15.
+
+    """
+    @application
+    def apply(self, forward_dict, backward_dict):
+        """Applies forward and backward networks and concatenates outputs."""
+        forward, backward = self.children
+        dim = forward.dim
+
+        def block_diagonal(forward_weights, backward_weights):
+            zeros = tensor.zeros_like(forward_weights)
+            return tensor.concatenate(
+                [tensor.concatenate([forward_weights, zeros], axis=1),
+                 tensor.concatenate([zeros, backward_weights], axis=1)],
+                axis=0)
+
+        state_to_gates = tensor.concatenate(
+            [block_diagonal(forward.state_to_update, backward.state_to_update),
+             block_diagonal(forward.state_to_reset, backward.state_to_reset)],
+            axis=1)
+        state_to_state = block_diagonal(forward.state_to_state,
+                                        backward.state_to_state)
+
+        # Time runs backwards for the second half of the features
+        def stack(name):
+            return tensor.concatenate(
+                [forward_dict[name], backward_dict[name][::-1]], axis=2)
+        ones = tensor.ones((1, 1, dim))
+        mask = tensor.concatenate(
+            [forward_dict['mask'][:, :, None] * ones,
+             backward_dict['mask'][::-1][:, :, None] * ones], axis=2)
+        batch_size = mask.shape[1]
+        initial_states = tensor.concatenate(
+            [forward.initial_state('states', batch_size),
+             backward.initial_state('states', batch_size)], axis=1)
+
+        def step(inputs, gate_inputs, mask, states):
+            gate_values = forward.gate_activation.apply(
+                states.dot(state_to_gates) + gate_inputs)
+            update_values = gate_values[:, :2 * dim]
+            reset_values = gate_values[:, 2 * dim:]
+            next_states = forward.activation.apply(
+                (states * reset_values).dot(state_to_state) + inputs)
+            next_states = (next_states * update_values +
+                           states * (1 - update_values))
+            return mask * next_states + (1 - mask) * states
+
+        states, _ = theano.scan(
+            step,
+            sequences=[stack('inputs'),
+                       tensor.concatenate([stack('update_inputs'),
+                                           stack('reset_inputs')], axis=2),
+                       mask],
+            outputs_info=[initial_states],
+            name='fused_bidirectional')
+        return [tensor.concatenate([states[:, :, :dim],
+                                    states[::-1, :, dim:]], axis=2)]
+
+
 class BidirectionalEncoder(Initializable):
-    def __init__(self, vocab_size, embedding_dim, state_dim, **kwargs):
+    def __init__(self, vocab_size, embedding_dim, state_dim, fused=False,
+                 fused_forks=False, embeddings='full', embedding_buckets=None,
+                 embedding_hashes=None, embedding_frequent=None,
+                 embedding_rank=None, **kwargs):
         super(BidirectionalEncoder, self).__init__(**kwargs)
         self.vocab_size = vocab_size
         self.embedding_dim = embedding_dim
         self.state_dim = state_dim
 
-        self.lookup = LookupTable(name='embeddings')
-        self.bidir = BidirectionalWMT15(GatedRecurrent(activation=Tanh(), dim=state_dim))
-        self.fwd_fork = Fork([name for name in self.bidir.prototype.apply.sequences
-                          if name != 'mask'], prototype=Linear(), name='fwd_fork')
-        self.back_fork = Fork([name for name in self.bidir.prototype.apply.sequences
-                          if name != 'mask'], prototype=Linear(), name='back_fork')
+        # The table is the LookupTable whose rows are looked up
+        if embeddings == 'full':
+            self.lookup = LookupTable(name='embeddings')
+            self.table = self.lookup
+        elif embeddings == 'hashed':
+            self.lookup = HashedLookupTable(
+                n_buckets=embedding_buckets, n_hashes=embedding_hashes,
+                n_frequent=embedding_frequent, name='embeddings')
+            self.table = self.lookup.table
+        elif embeddings == 'factorized':
+            self.lookup = FactorizedLookupTable(rank=embedding_rank,
+                                                name='embeddings')
+            self.table = self.lookup.table
+        else:
+            raise ValueError("Unknown embeddings: {}".format(embeddings))
+        bidirectional = FusedBidirectionalWMT15 if fused else BidirectionalWMT15
+        # Both encoders have the parameter names of BidirectionalWMT15
+        self.bidir = bidirectional(GatedRecurrent(activation=Tanh(), dim=state_dim),
+                                   name='bidirectionalwmt15')
+        fork = FusedFork if fused_forks else partial(Fork, prototype=Linear())
+        self.fwd_fork = fork([name for name in self.bidir.prototype.apply.sequences
+                          if name != 'mask'], name='fwd_fork')
+        self.back_fork = fork([name for name in self.bidir.prototype.apply.sequences
+                          if name != 'mask'], name='back_fork')
 
         self.children = [self.lookup, self.bidir, self.fwd_fork, self.back_fork]
 
@@ -192,44 +364,290 @@ class GRUInitialState(GatedRecurrent):
         return super(GRUInitialState, self).initial_state(state_name, batch_size, *args, **kwargs)
 
 
+class SequenceGeneratorWMT15(SequenceGenerator):
+    """Sequence generator computing readouts of non-padded positions only.
+
+    The cost matrix is computed like in SequenceGenerator, except that the
+    readout sources and outputs are first packed into a single row of the
+    positions where the mask is non-zero. The readout, output projection and
+    softmax are therefore not computed for padding, and the costs are
+    scattered back into a (time, batch) matrix with zeros for padding.
+
+    """
+    @application
+    def cost_matrix(self, application_call, outputs, mask, **kwargs):
+        batch_size = outputs.shape[1]
+
+        # Prepare input for the iterative part
+        states = dict_subset(kwargs, self._state_names, must_have=False)
+        contexts = dict_subset(kwargs, self._context_names, must_have=False)
+        feedback = self.readout.feedback(outputs)
+        inputs = self.fork.apply(feedback, as_dict=True)
+
+        # Run the recurrent network
+        results = self.transition.apply(
+            mask=mask, return_initial_states=True, as_dict=True,
+            **dict_union(inputs, states, contexts))
+
+        # Separate the deliverables, as in SequenceGenerator
+        states = {name: results[name][:-1] for name in self._state_names}
+        glimpses = {name: results[name][1:] for name in self._glimpse_names}
+        feedback = tensor.roll(feedback, 1, 0)
+        feedback = tensor.set_subtensor(
+            feedback[0],
+            self.readout.feedback(self.readout.initial_outputs(batch_size)))
+
+        # Packed inputs are kept 3D (1 x positions x dim) so that bricks
+        # still treat them as sequences and not as a single step
+        positions = mask.flatten().nonzero()[0]
+
+        def pack(variable):
+            return variable.reshape(
+                (outputs.shape[0] * batch_size, variable.shape[-1])
+            )[positions][None, :, :]
+
+        sources = dict_union(states, glimpses, {'feedback': feedback})
+        readouts = self.readout.readout(
+            **{name: pack(sources[name]) for name in self.readout.source_names})
+        packed_costs = self.readout.cost(
+            readouts, outputs.flatten()[positions][None, :])
+        costs = tensor.set_subtensor(
+            tensor.zeros((outputs.shape[0] * batch_size,),
+                         dtype=packed_costs.dtype)[positions],
+            packed_costs[0]).reshape(outputs.shape)
+
+        for name, variable in list(glimpses.items()) + list(states.items()):
+            application_call.add_auxiliary_variable(
+                variable.copy(), name=name)
+
+        # This variables can be used to initialize the initial states of the
+        # next batch using the last states of the current batch.
+        for name in self._state_names:
+            application_call.add_auxiliary_variable(
+                results[name][-1].copy(), name=name+"_final_value")
+
+        return costs
+
+
+class CheckpointedSequenceGenerator(SequenceGenerator):
+    """Sequence generator recomputing the decoder during backpropagation.
+
+    The target sequence is cut into segments of `checkpoint_every` steps
+    and an outer scan runs the attention recurrent network, the readout
+    and the softmax of one segment at a time. Only the states at segment
+    boundaries and the costs are outputs of the outer scan, so the
+    gradient recomputes every segment from its first states instead of
+    keeping the activations of all steps: memory grows with T / k + k
+    instead of T, i.e. O(sqrt(T)) for k ~ sqrt(T), at the price of a
+    second forward pass.
+
+    Feedback lookups are computed outside of the scan so that the sparse
+    lookup gradients and noise still find them. Since the readout is not
+    part of the outer graph, dropout after the maxout is applied here,
+    with masks drawn once per batch so that the recomputation sees them.
+
+    Parameters
+    ----------
+    checkpoint_every : int
+        The number of steps of a segment.
+    dropout : float
+        The probability to drop maxout outputs, 1 for no dropout, like
+        config['dropout'].
+    dropout_dim : int
+        The dimension of the maxout outputs.
+
+    """
+    def __init__(self, checkpoint_every, dropout=1.0, dropout_dim=None,
+                 **kwargs):
+        super(CheckpointedSequenceGenerator, self).__init__(**kwargs)
+        self.checkpoint_every = checkpoint_every
+        self.dropout = dropout
+        self.dropout_dim = dropout_dim
+
+    @application
+    def cost_matrix(self, application_call, outputs, mask, **kwargs):
+        n_steps = outputs.shape[0]
+        batch_size = outputs.shape[1]
+        k = self.checkpoint_every
+        n_segments = (n_steps + k - 1) // k
+
+        # Everything not recurrent is computed for all steps at once
+        contexts = dict_subset(kwargs, self._context_names, must_have=False)
+        preprocessed = self.transition.preprocessed_attended_name
+        contexts[preprocessed] = self.transition.attention.preprocess(
+            contexts[self.transition.attended_name])
+        feedback = self.readout.feedback(outputs)
+        sequences = self.fork.apply(feedback, as_dict=True)
+        feedback = tensor.roll(feedback, 1, 0)
+        sequences['feedback'] = tensor.set_subtensor(
+            feedback[0],
+            self.readout.feedback(self.readout.initial_outputs(batch_size)))
+        sequences['outputs'] = outputs
+        sequences['mask'] = mask
+        if self.dropout < 1.0:
+            rng = MRG_RandomStreams(self.rng.randint(2 ** 30))
+            sequences['dropout'] = rng.binomial(
+                (n_steps, batch_size, self.dropout_dim),
+                p=1 - self.dropout,
+                dtype=theano.config.floatX) / (1 - self.dropout)
+
+        # Padding steps are masked out, they keep the states unchanged
+        def segment(variable):
+            shape = [variable.shape[i] for i in range(1, variable.ndim)]
+            padded = tensor.concatenate([variable, tensor.zeros(
+                [n_segments * k - n_steps] + shape, dtype=variable.dtype)])
+            return padded.reshape([n_segments, k] + shape,
+                                  ndim=variable.ndim + 1)
+
+        sequence_names = sorted(sequences)
+        state_names = self.transition.do_apply.states
+        context_names = sorted(contexts)
+        initial_states = [
+            self.transition.initial_state(name, batch_size, **contexts)
+            for name in state_names]
+
+        def step(*args):
+            args = list(args)
+            segment_sequences = dict(
+                zip(sequence_names, args[:len(sequence_names)]))
+            del args[:len(sequence_names)]
+            segment_states = dict(zip(state_names, args[:len(state_names)]))
+            segment_contexts = dict(zip(context_names,
+                                        args[len(state_names):]))
+
+            results = self.transition.do_apply(
+                mask=segment_sequences['mask'], return_initial_states=True,
+                as_dict=True, **dict_union(
+                    dict_subset(segment_sequences, self.fork.output_names),
+                    segment_states, segment_contexts))
+            sources = dict_union(
+                {name: results[name][:-1] for name in self._state_names},
+                {name: results[name][1:] for name in self._glimpse_names},
+                {'feedback': segment_sequences['feedback']})
+            readouts = self.readout.readout(
+                **dict_subset(sources, self.readout.source_names))
+            if self.dropout < 1.0:
+                maxout, = VariableFilter(name='maxout_apply_output')(
+                    ComputationGraph(readouts))
+                readouts, = ComputationGraph(readouts).replace(
+                    {maxout: maxout * segment_sequences['dropout']}).outputs
+            costs = self.readout.cost(readouts, segment_sequences['outputs'])
+            return [results[name][-1] for name in state_names] + [costs]
+
+        results, _ = theano.scan(
+            step, sequences=[segment(sequences[name])
+                             for name in sequence_names],
+            outputs_info=initial_states + [None],
+            non_sequences=[contexts[name] for name in context_names],
+            n_steps=n_segments, name='checkpointed_cost_matrix')
+
+        # This variables can be used to initialize the initial states of the
+        # next batch using the last states of the current batch.
+        for name, variable in zip(state_names, results):
+            if name in self._state_names:
+                application_call.add_auxiliary_variable(
+                    variable[-1].copy(), name=name+"_final_value")
+
+        return results[-1].reshape(
+            (n_segments * k, batch_size))[:n_steps]
+
+
 class Decoder(Initializable):
     def __init__(self, vocab_size, embedding_dim, state_dim,
-                 representation_dim, **kwargs):
+                 representation_dim, softmax='full', softmax_samples=None,
+                 softmax_classes=None, shortlist=False, fused_forks=False,
+                 packed_cost=False, checkpoint_every=None, dropout=1.0,
+                 attention='global', attention_window=None, **kwargs):
         super(Decoder, self).__init__(**kwargs)
         self.vocab_size = vocab_size
         self.embedding_dim = embedding_dim
         self.state_dim = state_dim
         self.representation_dim = representation_dim
+        self.softmax = softmax
 
         self.transition = GRUInitialState(
             attended_dim=state_dim, dim=state_dim,
             activation=Tanh(), name='decoder')
-        self.attention = SequenceContentAttention(
+        if attention == 'global':
+            attention = SequenceContentAttention
+        elif attention == 'local':
+            attention = partial(LocalContentAttention, attention_window)
+        else:
+            raise ValueError("Unknown attention: {}".format(attention))
+        self.attention = attention(
             state_names=self.transition.apply.states,
             attended_dim=representation_dim,
             match_dim=state_dim, name="attention")
 
+        post_merge = [Bias(dim=state_dim, name='maxout_bias').apply,
+                      Maxout(num_pieces=2, name='maxout').apply,
+                      Linear(input_dim=state_dim / 2, output_dim=embedding_dim,
+                             use_bias=False, name='softmax0').apply]
+        if softmax == 'full':
+            readout_dim = self.vocab_size
+            self.output_projection = ShortlistLinear(
+                use_shortlist=shortlist, input_dim=embedding_dim,
+                name='softmax1')
+            if shortlist:
+                emitter = ShortlistSoftmaxEmitter(self.output_projection,
+                                                  initial_output=-1)
+            else:
+                emitter = SoftmaxEmitter(initial_output=-1)
+            post_merge.append(self.output_projection.apply)
+        elif softmax == 'sampled':
+            # The emitter owns softmax1 so that it can slice it
+            readout_dim = embedding_dim
+            emitter = SampledSoftmaxEmitter(
+                vocab_size, softmax_samples, shortlist=shortlist,
+                initial_output=-1)
+            self.output_projection = emitter.projection
+        elif softmax == 'class':
+            if shortlist:
+                raise ValueError("Shortlists need a flat softmax")
+            readout_dim = embedding_dim
+            emitter = ClassSoftmaxEmitter(
+                cPickle.load(open(softmax_classes)), initial_output=-1)
+            self.output_projection = None
+        else:
+            raise ValueError("Unknown softmax: {}".format(softmax))
+
         readout = Readout(
             source_names=['states', 'feedback', self.attention.take_glimpses.outputs[0]],
-            readout_dim=self.vocab_size,
-            emitter=SoftmaxEmitter(initial_output=-1),
+            readout_dim=readout_dim,
+            emitter=emitter,
             feedback_brick=LookupFeedbackWMT15(vocab_size, embedding_dim),
-            post_merge=InitializableFeedforwardSequence(
-                [Bias(dim=state_dim, name='maxout_bias').apply,
-                 Maxout(num_pieces=2, name='maxout').apply,
-                 Linear(input_dim=state_dim / 2, output_dim=embedding_dim,
-                        use_bias=False, name='softmax0').apply,
-                 Linear(input_dim=embedding_dim, name='softmax1').apply]),
+            post_merge=InitializableFeedforwardSequence(post_merge),
             merged_dim=state_dim)
 
-        self.sequence_generator = SequenceGenerator(
+        fork = FusedFork if fused_forks else partial(Fork, prototype=Linear())
+        if checkpoint_every:
+            if packed_cost:
+                raise ValueError("Checkpointed costs cannot be packed")
+            sequence_generator = partial(
+                CheckpointedSequenceGenerator, checkpoint_every,
+                dropout=dropout, dropout_dim=state_dim / 2)
+        elif packed_cost:
+            sequence_generator = SequenceGeneratorWMT15
+        else:
+            sequence_generator = SequenceGenerator
+        self.sequence_generator = sequence_generator(
             readout=readout,
             transition=self.transition,
             attention=self.attention,
-            fork=Fork([name for name in self.transition.apply.sequences
-                       if name != 'mask'], prototype=Linear())
+            fork=fork([name for name in self.transition.apply.sequences
+                       if name != 'mask'], name='fork')
         )
 
+        if fused_forks:
+            # AttentionRecurrent creates its own Distribute, replace it
+            att_trans = self.sequence_generator.transition
+            distribute = att_trans.distribute
+            att_trans.distribute = FusedDistribute(
+                distribute.target_names, distribute.source_name,
+                name=distribute.name)
+            att_trans.children[att_trans.children.index(distribute)] = \
+                att_trans.distribute
+
         self.children = [self.sequence_generator]
 
     @application(inputs=['representation', 'source_sentence_mask',
@@ -260,8 +678,84 @@ class Decoder(Initializable):
             attended=representation,
             attended_mask=tensor.ones(source_sentence.shape).T)
 
+    @application
+    def greedy_generate(self, representation, source_sentence_mask, eos_idx):
+        """Argmax translations of a batch of padded source sentences.
+
+        The steps are those of SequenceGenerator.generate, with the most
+        probable word emitted instead of a sampled one. Decoding stops
+        once every sentence has emitted `eos_idx`, or after three times
+        the length of the source. Returns the outputs, their mask, which
+        covers the first end of sentence symbol, and their costs, all of
+        shape (time, batch).
 
-def main(config, tr_stream, dev_stream):
+        """
+        generator = self.sequence_generator
+        transition = generator.transition
+        readout = generator.readout
+        state_names = generator._state_names
+        glimpse_names = generator._glimpse_names
+        batch_size = representation.shape[1]
+        contexts = {transition.attended_name: representation,
+                    transition.attended_mask_name: source_sentence_mask.T}
+        preprocessed = {transition.preprocessed_attended_name:
+                        transition.attention.preprocess(representation)}
+        initial_states = transition.initial_states(batch_size, as_dict=True,
+                                                   **contexts)
+
+        def step(outputs, finished, *states):
+            states = dict(zip(state_names + glimpse_names, states))
+            glimpses = transition.take_glimpses(
+                as_dict=True, **dict_union(states, contexts, preprocessed))
+            states = dict_subset(states, state_names)
+            readouts = readout.readout(
+                feedback=readout.feedback(outputs),
+                **dict_union(states, glimpses, contexts))
+            probs = readout.emitter.probs(readouts)
+            best = probs.argmax(axis=1)
+            if isinstance(readout.emitter, ShortlistSoftmaxEmitter):
+                best = readout.emitter.words(readouts, best)
+            next_outputs = tensor.switch(finished, eos_idx, best)
+            mask = tensor.cast(1 - finished, theano.config.floatX)
+            costs = -tensor.log(probs.max(axis=1)) * mask
+            feedback = generator.fork.apply(readout.feedback(next_outputs),
+                                            as_dict=True)
+            next_states = transition.compute_states(
+                as_list=True, **dict_union(feedback, states, glimpses,
+                                           contexts))
+            next_finished = finished | tensor.eq(next_outputs, eos_idx)
+            return ([next_outputs, next_finished] + next_states +
+                    [glimpses[name] for name in glimpse_names] +
+                    [mask, costs],
+                    theano.scan_module.until(next_finished.all()))
+
+        results, _ = theano.scan(
+            step, outputs_info=(
+                [readout.initial_outputs(batch_size),
+                 tensor.zeros((batch_size,), dtype='int8')] +
+                [initial_states[name]
+                 for name in state_names + glimpse_names] +
+                [None, None]),
+            n_steps=3 * source_sentence_mask.shape[1], name='greedy_generate')
+        return results[0], results[-2], results[-1]
+
+
+def main(config, tr_stream, dev_stream, dev_masked_stream=None):
+
+    # Warn if the largest batches may not fit in memory
+    if config['memory_model'] and config['memory_budget']:
+        memory_model = MemoryModel.load(config['memory_model'])
+        peak = memory_model.predict(config['batch_size'], config['seq_len'],
+                                    config['seq_len'])
+        if peak > config['memory_budget'] and \
+                not config['memory_cap_batches']:
+            logger.warning(
+                "Batches of {} sentences of {} words may use {:.0f} MB, over "
+                "the budget of {:.0f} MB, only {} of them fit".format(
+                    config['batch_size'], config['seq_len'], peak,
+                    config['memory_budget'], memory_model.max_batch_size(
+                        config['seq_len'], config['seq_len'],
+                        config['memory_budget'])))
 
     # Create Theano variables
     source_sentence = tensor.lmatrix('source')
@@ -272,11 +766,29 @@ def main(config, tr_stream, dev_stream):
 
     # Construct model
     encoder = BidirectionalEncoder(config['src_vocab_size'], config['enc_embed'],
-                                   config['enc_nhids'])
+                                   config['enc_nhids'],
+                                   fused=config['fused_encoder'],
+                                   fused_forks=config['fused_forks'],
+                                   embeddings=config['enc_embeddings'],
+                                   embedding_buckets=config['enc_embed_buckets'],
+                                   embedding_hashes=config['enc_embed_hashes'],
+                                   embedding_frequent=config['enc_embed_frequent'],
+                                   embedding_rank=config['enc_embed_rank'])
     decoder = Decoder(config['trg_vocab_size'], config['dec_embed'],
-                      config['dec_nhids'], config['enc_nhids'] * 2)
+                      config['dec_nhids'], config['enc_nhids'] * 2,
+                      softmax=config['softmax'],
+                      softmax_samples=config['softmax_samples'],
+                      softmax_classes=config['softmax_classes'],
+                      shortlist=bool(config['shortlist']),
+                      fused_forks=config['fused_forks'],
+                      packed_cost=config['packed_cost'],
+                      checkpoint_every=config['checkpoint_every'],
+                      dropout=config['dropout'],
+                      attention=config['attention'],
+                      attention_window=config['attention_window'])
     cost = decoder.cost(encoder.apply(source_sentence, source_sentence_mask),
                         source_sentence_mask, target_sentence, target_sentence_mask)
+    validation_cost = cost
 
     # Initialize model
     encoder.weights_init = decoder.weights_init = IsotropicGaussian(config['weight_scale'])
@@ -290,8 +802,9 @@ def main(config, tr_stream, dev_stream):
 
     cg = ComputationGraph(cost)
 
-    # apply dropout for regularization
-    if config['dropout'] < 1.0:
+    # apply dropout for regularization, checkpointed decoders do it
+    # themselves since the maxout is inside their scan
+    if config['dropout'] < 1.0 and not config['checkpoint_every']:
         # dropout is applied to the output of maxout in ghog
         dropout_inputs = [x for x in cg.intermediary_variables
                           if x.name == 'maxout_apply_output']
@@ -305,6 +818,14 @@ def main(config, tr_stream, dev_stream):
         dec_params = Selector(decoder.sequence_generator.readout).get_params().values()
         dec_params += Selector(decoder.sequence_generator.fork).get_params().values()
         dec_params += Selector(decoder.transition.initial_transformer).get_params().values()
+        if config['weight_noise_sparse']:
+            # Only draw noise for the embeddings looked up in the batch
+            from subtensor_gradient import apply_sparse_noise
+            lookups = [encoder.table, decoder.sequence_generator.readout.feedback_brick.lookup]
+            cg = apply_sparse_noise(cg, lookups, config['weight_noise_ff'])
+            tables = [lookup.W for lookup in lookups]
+            enc_params = [param for param in enc_params if param not in tables]
+            dec_params = [param for param in dec_params if param not in tables]
         cg = apply_noise(cg, enc_params+dec_params, config['weight_noise_ff'])
 
     cost = cg.outputs[0]
@@ -324,26 +845,53 @@ def main(config, tr_stream, dev_stream):
         logger.info('    {:15}: {}'.format(value.get_value().shape, name))
     logger.info("Total number of parameters: {}".format(len(enc_dec_param_dict)))
 
-    # Set up training algorithm
+    # Set up training algorithm, updating once every few batches if
+    # gradients are accumulated
+    if config['accumulate_gradients'] > 1:
+        from subtensor_gradient import AccumulatingGradientDescent
+        gradient_descent = partial(AccumulatingGradientDescent,
+                                   config['accumulate_gradients'])
+    elif args.subtensor_fix:
+        from subtensor_gradient import GradientDescent_SubtensorFix
+        gradient_descent = GradientDescent_SubtensorFix
+    else:
+        gradient_descent = GradientDescent
+
+    # The optimizer state can be stored in float16
+    half = Float16State if config['float16_state'] else lambda rule: rule
     if args.subtensor_fix:
-        assert config['step_rule'] == 'AdaDelta'
-        from subtensor_gradient import GradientDescent_SubtensorFix, AdaDelta_SubtensorFix, subtensor_params
-        lookups = subtensor_params(cg, [encoder.lookup, decoder.sequence_generator.readout.feedback_brick.lookup])
-        algorithm = GradientDescent_SubtensorFix(
+        import subtensor_gradient
+        from subtensor_gradient import subtensor_params
+        lookups = subtensor_params(cg, [encoder.table, decoder.sequence_generator.readout.feedback_brick.lookup])
+        step_rule = getattr(subtensor_gradient,
+                            config['step_rule'] + '_SubtensorFix')
+        algorithm = gradient_descent(
             subtensor_params=lookups,
             cost=cost, params=cg.parameters,
             step_rule=CompositeRule([StepClipping(config['step_clipping']),
                                      RemoveNotFinite(0.9),
-                                     AdaDelta_SubtensorFix(subtensor_params=lookups)])
+                                     half(step_rule(subtensor_params=lookups))])
         )
     else:
-        algorithm = GradientDescent(
+        algorithm = gradient_descent(
             cost=cost, params=cg.parameters,
             step_rule=CompositeRule([StepClipping(config['step_clipping']),
                                      RemoveNotFinite(0.9),
-                                     eval(config['step_rule'])()])
+                                     half(eval(config['step_rule'])())])
         )
 
+    # Measure the memory of training steps by batch shape instead of
+    # training
+    if config['memory_profile']:
+        measurements = profile_memory(
+            algorithm, profile_shapes(config['batch_size'], config['seq_len']),
+            config['src_vocab_size'], config['trg_vocab_size'])
+        memory_model = MemoryModel.fit(measurements)
+        memory_model.save(config['memory_profile'], measurements)
+        logger.info("Memory model written to {}".format(
+            config['memory_profile']))
+        return memory_model
+
     # Set up beam search and sampling computation graphs
     sampling_representation = encoder.apply(
         sampling_input, tensor.ones(sampling_input.shape))
@@ -353,47 +901,133 @@ def main(config, tr_stream, dev_stream):
         bricks=[decoder.sequence_generator], name="outputs")(
             ComputationGraph(generated[1]))  # generated[1] is the next_outputs
 
+    # Greedy decoding of padded batches, cheaper than beam search
+    greedy_search = None
+    if config['val_beam_every'] > 1 or config['sampling_greedy']:
+        sampling_input_mask = tensor.matrix('input_mask')
+        logger.info("Compiling the greedy search")
+        greedy_search = theano.function(
+            [sampling_input, sampling_input_mask],
+            decoder.greedy_generate(
+                encoder.apply(sampling_input, sampling_input_mask),
+                sampling_input_mask, config['trg_eos_idx']))
+
+    # Restrict decoding to a per-sentence vocabulary if necessary
+    shortlist = None
+    if config['shortlist']:
+        shortlist = Shortlist(
+            decoder.output_projection, config['shortlist'],
+            config['shortlist_top_k'], config['shortlist_translations'],
+            extra=[config['unk_id'], config['trg_eos_idx']])
+
     # Set up training model
     training_model = Model(cost)
 
+    # Replayed batches do not lead to the vocabularies of the text files
+    src_vocab = trg_vocab = trg_ivocab = None
+    if config['replay_batches']:
+        src_vocab = cPickle.load(open(config['src_vocab']))
+        trg_vocab = cPickle.load(open(config['trg_vocab']))
+        trg_ivocab = {v: k for k, v in trg_vocab.items()}
+
+    # Validate on the perplexity of the development set, BLEU can then be
+    # computed only when it improves
+    if config['bleu_on_ppl_improvement'] and not (
+            config['ppl_val_freq'] and dev_masked_stream is not None):
+        raise ValueError("BLEU on perplexity improvement needs ppl_val_freq "
+                         "and a development set with its references")
+    bleu_validator = BleuValidator(
+        sampling_input, samples=samples, config=config,
+        model=search_model, data_stream=dev_stream,
+        src_eos_idx=config['src_eos_idx'],
+        trg_eos_idx=config['trg_eos_idx'],
+        shortlist=shortlist, trg_ivocab=trg_ivocab,
+        greedy_search=(greedy_search if config['val_beam_every'] > 1
+                       else None),
+        every_n_batches=(None if config['bleu_on_ppl_improvement']
+                         else config['bleu_val_freq']))
+    validators = [bleu_validator]
+    if config['ppl_val_freq'] and dev_masked_stream is not None:
+        # Checkpointed decoders apply dropout in their own graph, and the
+        # sampled softmax only estimates the cost over the vocabulary
+        checkpoint_dropout = (config['checkpoint_every'] and
+                              config['dropout'] < 1.0)
+        emitter = decoder.sequence_generator.readout.emitter
+        sampled = isinstance(emitter, SampledSoftmaxEmitter)
+        if checkpoint_dropout or sampled:
+            if checkpoint_dropout:
+                decoder.sequence_generator.dropout = 1.0
+            emitter.full_cost = sampled
+            validation_cost = decoder.cost(
+                encoder.apply(source_sentence, source_sentence_mask),
+                source_sentence_mask, target_sentence, target_sentence_mask)
+            if checkpoint_dropout:
+                decoder.sequence_generator.dropout = config['dropout']
+            emitter.full_cost = False
+        validators.append(PerplexityValidator(
+            [source_sentence, source_sentence_mask,
+             target_sentence, target_sentence_mask],
+            validation_cost, dev_masked_stream,
+            bleu_validator=(bleu_validator
+                            if config['bleu_on_ppl_improvement'] else None),
+            every_n_batches=config['ppl_val_freq']))
+
     # Set extensions
     extensions = [
+        FinishAfter(after_n_batches=config['finish_after']),
         Sampler(
             model=search_model, config=config, data_stream=tr_stream,
+            src_vocab=src_vocab, trg_vocab=trg_vocab,
             src_eos_idx=config['src_eos_idx'],
             trg_eos_idx=config['trg_eos_idx'],
+            shortlist=shortlist,
+            greedy_search=(greedy_search if config['sampling_greedy']
+                           else None),
+            background=config['sampling_background'],
+            min_interval=config['sampling_interval'],
             every_n_batches=config['sampling_freq']),
-        BleuValidator(
-            sampling_input, samples=samples, config=config,
-            model=search_model, data_stream=dev_stream,
-            src_eos_idx=config['src_eos_idx'],
-            trg_eos_idx=config['trg_eos_idx'],
-            every_n_batches=config['bleu_val_freq']),
+    ] + validators + [
         TrainingDataMonitoring([cost], after_batch=True),
         #Plot('En-Fr', channels=[['decoder_cost_cost']],
         #     after_batch=True),
         Printing(after_batch=True),
-        Dump(config['saveto'], every_n_batches=config['save_freq'])
+        DumpWMT15(config['saveto'], float16=config['float16_dump'],
+                  every_n_batches=config['save_freq'])
     ]
 
     # Reload model if necessary
     if config['reload']:
         extensions += [LoadFromDumpWMT15(config['saveto'])]
 
+    # Time every batch, after all other extensions
+    if config['profile_freq']:
+        extensions += [Profiler(summary_freq=config['profile_freq'])]
+
+    # Keep the log on disk, except for the last batches
+    log = None
+    if config['log_window']:
+        # Not 'log', which is the file of the pickled log of the dumps
+        log = ColumnarTrainingLog(
+            os.path.join(config['saveto'], 'log_columns'),
+            window=config['log_window'])
+
     # Initialize main loop
     main_loop = MainLoop(
         model=training_model,
         algorithm=algorithm,
         data_stream=tr_stream,
+        log=log,
         extensions=extensions
     )
 
     # Train!
     main_loop.run()
+    return main_loop
 
 
 if __name__ == "__main__":
     logger.info("Model options:\n{}".format(pprint.pformat(config)))
     stream = importlib.import_module(config['stream'])
-    main(config, stream.masked_stream, stream.dev_stream)
+    main(config, stream.masked_stream, stream.dev_stream,
+         getattr(stream, 'dev_masked_stream', None))
 
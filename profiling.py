@@ -0,0 +1,98 @@
+# Where the training time goes, batch by batch
+import logging
+import time
+from collections import defaultdict, deque
+
+import numpy
+
+from blocks.extensions import SimpleExtension
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler(SimpleExtension):
+    """Records the time breakdown and throughput of every batch.
+
+    Before training, the `process_batch` method of the algorithm and the
+    `dispatch` method of every other extension are wrapped with timers.
+    After every batch, the following entries are added to the log:
+
+    * ``profile_data``: the time not spent in the algorithm or in the
+      extensions, i.e. mostly waiting for the data stream,
+    * ``profile_compute``: the time of the Theano update,
+    * ``profile_<extension name>``: the time of each extension,
+    * ``profile_source_tokens`` and ``profile_target_tokens``,
+    * ``profile_padding``: the ratio of padded positions in the batch,
+    * ``profile_words_per_sec``: target tokens per second of wall time.
+
+    The times of a batch are those spent since the previous one, so the
+    profiler should be the last extension of the main loop. Every
+    `summary_freq` batches, the means over these batches are logged.
+
+    Parameters
+    ----------
+    summary_freq : int
+        The number of batches between summaries.
+
+    """
+    def __init__(self, summary_freq=100, **kwargs):
+        kwargs.setdefault('before_training', True)
+        kwargs.setdefault('after_batch', True)
+        super(Profiler, self).__init__(**kwargs)
+        self.summary_freq = summary_freq
+        self.times = defaultdict(float)
+        self.window = deque(maxlen=summary_freq)
+        self.last_batch_end = None
+
+    def _timed(self, name, method):
+        def timed_method(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.times[name] += time.time() - start
+        return timed_method
+
+    def do(self, which_callback, *args):
+        if which_callback == 'before_training':
+            algorithm = self.main_loop.algorithm
+            algorithm.process_batch = self._timed(
+                'compute', algorithm.process_batch)
+            for extension in self.main_loop.extensions:
+                if extension is not self:
+                    extension.dispatch = self._timed(
+                        extension.name, extension.dispatch)
+            self.last_batch_end = time.time()
+            return
+
+        batch, = args
+        now = time.time()
+        total = now - self.last_batch_end
+        record = {'data': total - sum(self.times.values())}
+        record.update(self.times)
+        self.times.clear()
+
+        source_tokens = batch['source_mask'].sum()
+        target_tokens = batch['target_mask'].sum()
+        record['source_tokens'] = source_tokens
+        record['target_tokens'] = target_tokens
+        record['padding'] = 1. - (
+            (source_tokens + target_tokens) /
+            float(batch['source_mask'].size + batch['target_mask'].size))
+        record['words_per_sec'] = target_tokens / total
+
+        current_row = self.main_loop.log.current_row
+        for name, value in record.items():
+            current_row['profile_' + name] = value
+        self.window.append(record)
+
+        if self.main_loop.status['iterations_done'] % self.summary_freq == 0:
+            names = sorted(set(name for past in self.window for name in past))
+            logger.info("Profile of the last {} batches: {}".format(
+                len(self.window), ", ".join(
+                    "{} {:.4g}".format(name, numpy.mean(
+                        [past.get(name, 0.) for past in self.window]))
+                    for name in names)))
+
+        # Time spent in the profiler belongs to the next batch
+        self.last_batch_end = now
@@ -0,0 +1,146 @@
+# Recording and replay of padded batches
+import logging
+import os
+import numpy
+import theano
+
+from fuel.streams import AbstractDataStream
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ('source', 'source_mask', 'target', 'target_mask')
+
+# The file ends with the byte offset of the index, the number of batches
+# and the size of the stored word indices, as int64
+FOOTER_SIZE = 3
+
+
+def record_batches(stream, path, vocab_size, n_batches=None):
+    """Writes the padded batches of a stream to a file.
+
+    Every batch is stored as its source and target word indices followed
+    by the lengths of its sentences, in 16 bits when the vocabularies
+    allow it, so a batch takes about as much space as its text. The masks
+    are rebuilt from the lengths, which is exact since padding only adds
+    positions at the end of the sentences. An index of the batches, of
+    their offsets and shapes, follows.
+
+    Parameters
+    ----------
+    stream : DataStream
+        A stream of batches with the sources of ``masked_stream``.
+    path : str
+        The file to write.
+    vocab_size : int
+        The largest vocabulary size, of the source or the target.
+    n_batches : int, optional
+        The number of batches to record, the whole epoch by default.
+
+    Returns
+    -------
+    int
+        The number of batches recorded.
+
+    """
+    dtype = numpy.dtype('uint16' if vocab_size <= 2 ** 16 else 'uint32')
+    index = []
+    offset = 0
+    with open(path, 'wb') as batches:
+        for batch in stream.get_epoch_iterator(as_dict=True):
+            if n_batches is not None and len(index) >= n_batches:
+                break
+            source, target = batch['source'], batch['target']
+            parts = [source.flatten(), target.flatten(),
+                     batch['source_mask'].sum(axis=1),
+                     batch['target_mask'].sum(axis=1)]
+            for part in parts:
+                part.astype(dtype).tofile(batches)
+            index.append((offset, source.shape[0], source.shape[1],
+                          target.shape[1]))
+            offset += sum(len(part) for part in parts)
+        numpy.array(index, dtype='int64').tofile(batches)
+        numpy.array([offset * dtype.itemsize, len(index), dtype.itemsize],
+                    dtype='int64').tofile(batches)
+    logger.info("Recorded {} batches to {}".format(len(index), path))
+    return len(index)
+
+
+class BatchReplay(AbstractDataStream):
+    """Stream of the batches of a file written by :func:`record_batches`.
+
+    The file is memory mapped, so that batches are read at the speed of
+    the page cache and training steps can be timed with exactly the same
+    inputs, independently of the text pipeline. An epoch is the sequence
+    of recorded batches. The stream is pickled as its path, for dumps.
+
+    Parameters
+    ----------
+    path : str
+        The file of the batches.
+
+    """
+    def __init__(self, path, **kwargs):
+        super(BatchReplay, self).__init__(**kwargs)
+        self.path = path
+        self.sources = SOURCES
+        self.position = 0
+        self._fresh_state = True
+        self._map()
+
+    def _map(self):
+        footer = numpy.memmap(self.path, dtype='int64', mode='r',
+                              offset=os.path.getsize(self.path) -
+                              8 * FOOTER_SIZE, shape=(FOOTER_SIZE,))
+        index_offset, n_batches, itemsize = map(int, footer)
+        self.words = numpy.memmap(
+            self.path, dtype='uint16' if itemsize == 2 else 'uint32',
+            mode='r', shape=(index_offset // itemsize,))
+        self.index = numpy.memmap(self.path, dtype='int64', mode='r',
+                                  offset=index_offset, shape=(n_batches, 4))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['words'], state['index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+    @staticmethod
+    def _mask(lengths, length):
+        return (numpy.arange(length) < lengths[:, None]).astype(
+            theano.config.floatX)
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        if self.position >= len(self.index):
+            raise StopIteration
+        offset, batch_size, source_length, target_length = \
+            self.index[self.position]
+        self.position += 1
+        sizes = [batch_size * source_length, batch_size * target_length,
+                 batch_size, batch_size]
+        source, target, source_lengths, target_lengths = numpy.split(
+            self.words[offset:offset + sum(sizes)], numpy.cumsum(sizes)[:-1])
+        return (source.reshape((batch_size, source_length)).astype('int64'),
+                self._mask(source_lengths, source_length),
+                target.reshape((batch_size, target_length)).astype('int64'),
+                self._mask(target_lengths, target_length))
+
+    def reset(self):
+        self.position = 0
+
+    def next_epoch(self):
+        self.position = 0
+
+    def close(self):
+        pass
+
+    def get_epoch_iterator(self, **kwargs):
+        if not self._fresh_state:
+            self.next_epoch()
+        else:
+            self._fresh_state = False
+        return super(BatchReplay, self).get_epoch_iterator(**kwargs)
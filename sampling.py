@@ -1,19 +1,57 @@
+import ctypes
 import logging
+import multiprocessing
 import numpy
 import operator
 import os
 import re
 import signal
+import sys
+import theano
 import time
+from collections import Counter
+from multiprocessing.sharedctypes import RawArray
 
 from blocks.extensions import SimpleExtension
-from blocks.search import BeamSearch
 
 from subprocess import Popen, PIPE
 
+from beam_search import PrunedBeamSearch
+
 logger = logging.getLogger(__name__)
 
 
+def _bleu_statistics(hypothesis, reference):
+    """Lengths, n-gram matches and n-gram counts of a tokenized sentence."""
+    matches, totals = [], []
+    for n in range(1, 5):
+        hypothesis_ngrams = Counter(tuple(hypothesis[i:i + n])
+                                    for i in range(len(hypothesis) - n + 1))
+        reference_ngrams = Counter(tuple(reference[i:i + n])
+                                   for i in range(len(reference) - n + 1))
+        matches.append(sum((hypothesis_ngrams & reference_ngrams).values()))
+        totals.append(max(len(hypothesis) - n + 1, 0))
+    return [len(hypothesis), len(reference)] + matches + totals
+
+
+def _corpus_bleu(statistics):
+    """BLEU of summed sentence statistics, like multi-bleu.perl.
+
+    `statistics` can have a leading axis of corpora, e.g. bootstrap
+    resamples, in which case a BLEU score is returned for each of them.
+
+    """
+    statistics = numpy.asarray(statistics, dtype='float64')
+    hypothesis_length, reference_length = statistics[..., 0], statistics[..., 1]
+    matches, totals = statistics[..., 2:6], statistics[..., 6:10]
+    with numpy.errstate(divide='ignore'):
+        log_precision = numpy.log(
+            matches / numpy.maximum(totals, 1)).mean(axis=-1)
+    brevity_penalty = numpy.minimum(
+        0., 1. - reference_length / numpy.maximum(hypothesis_length, 1))
+    return 100 * numpy.exp(log_precision + brevity_penalty)
+
+
 class SamplingBase(object):
 
     def _get_attr_rec(self, obj, attr):
@@ -46,11 +84,23 @@ class SamplingBase(object):
 
 
 class Sampler(SimpleExtension, SamplingBase):
-
+    """Prints samples of the model for sentences of the current batch.
+
+    With `background`, the samples are generated by a worker process,
+    forked when sampling for the first time, so that training does not
+    wait for them. The parameters are copied into shared memory for the
+    worker, which loads them before sampling. A new request is dropped
+    if the worker is still busy with the previous one or if it comes
+    less than `min_interval` seconds after it, so that copying the
+    parameters does not slow training down either. Since the worker is
+    forked, this is only safe when training on CPU.
+
+    """
     def __init__(self, model, data_stream, config,
                  src_vocab=None, trg_vocab=None, src_ivocab=None,
                  trg_ivocab=None, src_eos_idx=-1, trg_eos_idx=-1,
-                 **kwargs):
+                 shortlist=None, greedy_search=None, background=False,
+                 min_interval=0., **kwargs):
         super(Sampler, self).__init__(**kwargs)
         self.model = model
         self.config = config
@@ -61,7 +111,57 @@ class Sampler(SimpleExtension, SamplingBase):
         self.trg_ivocab = trg_ivocab
         self.src_eos_idx = src_eos_idx
         self.trg_eos_idx = trg_eos_idx
+        self.shortlist = shortlist
+        self.greedy_search = greedy_search
+        self.background = background
+        self.min_interval = min_interval
         self.sampling_fn = model.get_theano_function()
+        self.worker = None
+
+    def _start_worker(self):
+        self.params = self.model.get_params()
+        self.snapshot = {}
+        for name, param in self.params.items():
+            value = param.get_value(borrow=True)
+            self.snapshot[name] = numpy.frombuffer(
+                RawArray(ctypes.c_char, value.nbytes),
+                dtype=value.dtype).reshape(value.shape)
+        self.jobs = multiprocessing.Queue()
+        self.idle = multiprocessing.Event()
+        self.idle.set()
+        self.last_request = 0
+        self.n_dropped = 0
+        self.worker = multiprocessing.Process(target=self._work)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _work(self):
+        # In the worker, the parameters are its own copies
+        while True:
+            input_, target_, input_mask = self.jobs.get()
+            for name, param in self.params.items():
+                param.set_value(self.snapshot[name])
+            self._sample(input_, target_, input_mask)
+            sys.stdout.flush()
+            self.idle.set()
+
+    def _request(self, input_, target_, input_mask):
+        if self.worker is None:
+            self._start_worker()
+        now = time.time()
+        if (not self.idle.is_set() or
+                now - self.last_request < self.min_interval):
+            self.n_dropped += 1
+            return
+        if self.n_dropped:
+            logger.info("{} sampling requests dropped".format(
+                self.n_dropped))
+            self.n_dropped = 0
+        self.idle.clear()
+        for name, param in self.params.items():
+            self.snapshot[name][...] = param.get_value(borrow=True)
+        self.jobs.put((input_, target_, input_mask))
+        self.last_request = now
 
     def do(self, which_callback, *args):
 
@@ -94,9 +194,20 @@ class Sampler(SimpleExtension, SamplingBase):
 
         input_ = src_batch[sample_idx, :]
         target_ = trg_batch[sample_idx, :]
-
-        # Sample
-        _1, outputs, _2, _3, costs = (self.sampling_fn(input_))
+        input_mask = batch['source_mask'][sample_idx, :]
+
+        if self.background:
+            self._request(input_, target_, input_mask)
+        else:
+            self._sample(input_, target_, input_mask)
+
+    def _sample(self, input_, target_, input_mask):
+        if self.shortlist:
+            self.shortlist.select(input_)
+        if self.greedy_search:
+            outputs, _, costs = self.greedy_search(input_, input_mask)
+        else:
+            _1, outputs, _2, _3, costs = (self.sampling_fn(input_))
         outputs = outputs.T
         costs = list(costs.T)
 
@@ -119,7 +230,8 @@ class BleuValidator(SimpleExtension, SamplingBase):
 
     def __init__(self, source_sentence, samples, model, data_stream,
                  config, n_best=1, track_n_models=1, trg_ivocab=None,
-                 src_eos_idx=-1, trg_eos_idx=-1, **kwargs):
+                 src_eos_idx=-1, trg_eos_idx=-1, shortlist=None,
+                 greedy_search=None, **kwargs):
         super(BleuValidator, self).__init__(**kwargs)
         self.source_sentence = source_sentence
         self.samples = samples
@@ -128,6 +240,8 @@ class BleuValidator(SimpleExtension, SamplingBase):
         self.config = config
         self.n_best = n_best
         self.track_n_models = track_n_models
+        self.shortlist = shortlist
+        self.greedy_search = greedy_search
         self.verbose = config.get('val_set_out', None)
 
         self.src_eos_idx = src_eos_idx
@@ -142,11 +256,22 @@ class BleuValidator(SimpleExtension, SamplingBase):
         self.eos_idx = self.src_eos_idx  #self.vocab[self.eos_sym]
         self.best_models = []
         self.val_bleu_curve = []
-        self.beam_search = BeamSearch(beam_size=self.config['beam_size'],
-                                      samples=samples)
+        self.beam_search = PrunedBeamSearch(
+            beam_size=self.config['beam_size'], samples=samples,
+            length_normalization=self.config['beam_length_norm'],
+            early_stop=self.config['beam_early_stop'],
+            shrink=self.config['beam_shrink'],
+            relative_threshold=self.config['beam_relative_threshold'],
+            absolute_threshold=self.config['beam_absolute_threshold'])
         self.multibleu_cmd = ['perl', self.config['bleu_script'],
                               self.config['val_set_grndtruth'], '<']
 
+        # Most validations can score a fixed subset of the development set
+        self.subset = None
+        self.best_subset_bleu = -numpy.inf
+        self.n_validations = 0
+        self.n_beam_validations = 0
+
         # Create saving directory if it does not exist
         if not os.path.exists(self.config['saveto']):
             os.makedirs(self.config['saveto'])
@@ -177,9 +302,159 @@ class BleuValidator(SimpleExtension, SamplingBase):
         self.model.set_param_values(
             self.main_loop.model.get_param_values())
 
+        # Get target vocabulary
+        if not self.trg_ivocab:
+            sources = self._get_attr_rec(self.main_loop, 'data_stream')
+            trg_vocab = sources.data_streams[1].dataset.dictionary
+            self.trg_ivocab = {v: k for k, v in trg_vocab.items()}
+
+        # Decode greedily, except every few validations
+        self.n_validations += 1
+        if self.greedy_search and \
+                self.n_validations % self.config['val_beam_every'] != 0:
+            self._evaluate_greedy()
+            return
+
+        # Score the subset, and the full set only every few validations or
+        # when the subset score improves enough
+        if self.config['val_subset_size']:
+            self.n_beam_validations += 1
+            subset_bleu = self._evaluate_subset()
+            improved = (subset_bleu >=
+                        self.best_subset_bleu + self.config['val_full_margin'])
+            self.best_subset_bleu = max(self.best_subset_bleu, subset_bleu)
+            if not improved and self.n_beam_validations % \
+                    self.config['val_full_every'] != 0:
+                return
+
         # Evaluate and save if necessary
         self._save_model(self._evaluate_model())
 
+    def _search(self, seq):
+        """Translations of a source sentence and their costs."""
+        input_ = numpy.tile(seq, (self.config['beam_size'], 1))
+        words = None
+        if self.shortlist:
+            words = self.shortlist.select(seq)
+
+        # draw sample, checking to ensure we don't get an empty string back
+        return self.beam_search.search(
+            input_values={self.source_sentence: input_},
+            max_length=3*len(seq), eol_symbol=self.trg_eos_idx,
+            ignore_first_eol=True, words=words)
+
+    def _sources(self):
+        """The source sentences of the development set."""
+        sources = []
+        for line in self.data_stream.get_epoch_iterator():
+            line[0][-1] = self.src_eos_idx
+            sources.append(self._oov_to_unk(line[0]))
+        self.data_stream.reset()
+        return sources
+
+    def _select_subset(self):
+        """Picks a sentence of every length quantile of the development set.
+
+        The sentences are sorted by length and split into
+        ``config['val_subset_size']`` strata of consecutive lengths, one
+        sentence being drawn from each with a fixed seed, so that the
+        subset is the same for the whole training.
+
+        """
+        sources = self._sources()
+        with open(self.config['val_set_grndtruth']) as grndtruth:
+            references = [reference.split() for reference in grndtruth]
+
+        rng = numpy.random.RandomState(1234)
+        order = numpy.argsort([len(seq) for seq in sources], kind='mergesort')
+        strata = numpy.array_split(
+            order, min(self.config['val_subset_size'], len(order)))
+        self.subset = [(sources[i], references[i])
+                       for i in sorted(rng.choice(stratum)
+                                       for stratum in strata)]
+        logger.info("Validation subset of {} sentences".format(
+            len(self.subset)))
+
+    def _evaluate_subset(self):
+        """BLEU of the subset, with a bootstrap confidence interval."""
+        if self.subset is None:
+            self._select_subset()
+
+        logger.info("Started Subset Validation: ")
+        val_start_time = time.time()
+        statistics = []
+        for seq, reference in self.subset:
+            trans, costs = self._search(seq)
+            hypothesis = []
+            if len(costs):
+                hypothesis = self._idx_to_word(
+                    trans[numpy.argmin(costs)][:-1], self.trg_ivocab).split()
+            statistics.append(_bleu_statistics(hypothesis, reference))
+        statistics = numpy.array(statistics)
+
+        # Resample the sentences of the subset with replacement
+        rng = numpy.random.RandomState(self.n_validations)
+        resamples = rng.randint(len(statistics), size=(
+            self.config['val_bootstrap'], len(statistics)))
+        bootstrap = _corpus_bleu(statistics[resamples].sum(axis=1))
+        bleu_score = _corpus_bleu(statistics.sum(axis=0))
+        low, high = numpy.percentile(bootstrap, [2.5, 97.5])
+        logger.info("Subset BLEU {:.2f}, 95% interval [{:.2f}, {:.2f}], "
+                    "took {:.1f} minutes".format(
+                        bleu_score, low, high,
+                        (time.time() - val_start_time) / 60.))
+
+        current_row = self.main_loop.log.current_row
+        current_row['validation_subset_bleu'] = bleu_score
+        current_row['validation_subset_bleu_low'] = low
+        current_row['validation_subset_bleu_high'] = high
+        return bleu_score
+
+    def _evaluate_greedy(self):
+        """BLEU of the argmax translations, decoded in batches.
+
+        The sentences are sorted by length so that batches are little
+        padded, and the translations are put back in order for scoring.
+        The score is only logged, models are saved on beam search scores.
+
+        """
+        logger.info("Started Greedy Validation: ")
+        val_start_time = time.time()
+        sources = self._sources()
+        translations = [None] * len(sources)
+        order = numpy.argsort([len(seq) for seq in sources], kind='mergesort')
+        batch_size = self.config['val_greedy_batch_size']
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            length = max(len(sources[i]) for i in indices)
+            input_ = numpy.zeros((len(indices), length), dtype='int64')
+            input_ += self.src_eos_idx
+            input_mask = numpy.zeros((len(indices), length),
+                                     dtype=theano.config.floatX)
+            for j, i in enumerate(indices):
+                input_[j, :len(sources[i])] = sources[i]
+                input_mask[j, :len(sources[i])] = 1
+            if self.shortlist:
+                self.shortlist.select(input_)
+
+            outputs, _, _ = self.greedy_search(input_, input_mask)
+            for j, i in enumerate(indices):
+                output = outputs[:, j].tolist()
+                if self.trg_eos_idx in output:
+                    output = output[:output.index(self.trg_eos_idx)]
+                translations[i] = self._idx_to_word(output, self.trg_ivocab)
+
+        mb_subprocess = Popen(self.multibleu_cmd, stdin=PIPE, stdout=PIPE)
+        stdout, _ = mb_subprocess.communicate(
+            "".join(trans_out + "\n" for trans_out in translations))
+        out_parse = re.match(r'BLEU = [-.0-9]+', stdout)
+        assert out_parse is not None
+        bleu_score = float(out_parse.group()[6:])
+        logger.info("Greedy BLEU {:.2f}, took {:.1f} minutes".format(
+            bleu_score, (time.time() - val_start_time) / 60.))
+        self.main_loop.log.current_row['validation_greedy_bleu'] = bleu_score
+        return bleu_score
+
     def _evaluate_model(self):
 
         logger.info("Started Validation: ")
@@ -187,12 +462,6 @@ class BleuValidator(SimpleExtension, SamplingBase):
         mb_subprocess = Popen(self.multibleu_cmd, stdin=PIPE, stdout=PIPE)
         total_cost = 0.0
 
-        # Get target vocabulary
-        if not self.trg_ivocab:
-            sources = self._get_attr_rec(self.main_loop, 'data_stream')
-            trg_vocab = sources.data_streams[1].dataset.dictionary
-            self.trg_ivocab = {v: k for k, v in trg_vocab.items()}
-
         if self.verbose:
             ftrans = open(self.config['val_set_out'], 'w')
 
@@ -203,14 +472,7 @@ class BleuValidator(SimpleExtension, SamplingBase):
 
             line[0][-1] = self.src_eos_idx
             seq = self._oov_to_unk(line[0])
-            input_ = numpy.tile(seq, (self.config['beam_size'], 1))
-
-            # draw sample, checking to ensure we don't get an empty string back
-            trans, costs = \
-                self.beam_search.search(
-                    input_values={self.source_sentence: input_},
-                    max_length=3*len(seq), eol_symbol=self.trg_eos_idx,
-                    ignore_first_eol=True)
+            trans, costs = self._search(seq)
 
             nbest_idx = numpy.argsort(costs)[:self.n_best]
             for j, best in enumerate(nbest_idx):
@@ -288,6 +550,66 @@ class BleuValidator(SimpleExtension, SamplingBase):
             signal.signal(signal.SIGINT, s)
 
 
+class PerplexityValidator(SimpleExtension):
+    """Computes the perplexity of the development set.
+
+    The training cost is computed, without any update, on the padded and
+    length sorted batches of `data_stream`, which costs a fraction of a
+    beam search. The mean log-likelihood of the target tokens and the
+    perplexity are added to the log as ``validation_log_likelihood`` and
+    ``validation_perplexity``.
+
+    The cost should be the one of the graph without dropout and noise.
+    With the sampled softmax, it is the sampled approximation.
+
+    Parameters
+    ----------
+    inputs : list of Theano variables
+        The inputs of the cost, named like the sources of the stream.
+    cost : Theano variable
+        The sum of the costs of the target tokens over the batch size,
+        like the cost of the decoder.
+    data_stream : DataStream
+        The development set, with target masks.
+    bleu_validator : BleuValidator, optional
+        Run each time the perplexity improves.
+
+    """
+    def __init__(self, inputs, cost, data_stream, bleu_validator=None,
+                 **kwargs):
+        super(PerplexityValidator, self).__init__(**kwargs)
+        self.inputs = inputs
+        self.data_stream = data_stream
+        self.bleu_validator = bleu_validator
+        self.best_perplexity = numpy.inf
+
+        logger.info("Compiling the validation cost")
+        self.cost_function = theano.function(inputs, cost)
+
+    def do(self, which_callback, *args):
+        start_time = time.time()
+        total_cost, n_tokens = 0., 0.
+        for batch in self.data_stream.get_epoch_iterator(as_dict=True):
+            cost = self.cost_function(*[batch[variable.name]
+                                        for variable in self.inputs])
+            total_cost += cost * batch['target_mask'].shape[0]
+            n_tokens += batch['target_mask'].sum()
+        log_likelihood = -total_cost / n_tokens
+        perplexity = numpy.exp(-log_likelihood)
+        logger.info("Validation log-likelihood {:.4f}, perplexity {:.2f}, "
+                    "took {:.1f}s".format(log_likelihood, perplexity,
+                                          time.time() - start_time))
+
+        current_row = self.main_loop.log.current_row
+        current_row['validation_log_likelihood'] = log_likelihood
+        current_row['validation_perplexity'] = perplexity
+
+        if perplexity < self.best_perplexity:
+            self.best_perplexity = perplexity
+            if self.bleu_validator is not None:
+                self.bleu_validator.do(which_callback, *args)
+
+
 class ModelInfo:
     def __init__(self, bleu_score, path=None):
         self.bleu_score = bleu_score
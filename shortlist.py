@@ -0,0 +1,97 @@
+# Per-sentence target vocabulary shortlists for fast decoding
+import argparse
+import cPickle
+import logging
+import numpy
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class Shortlist(object):
+    """Restricts the output layer to likely target words of a source.
+
+    The candidates of a source sentence (or batch) are the `top_k` most
+    frequent target words, i.e. the smallest indices of the frequency
+    sorted vocabulary, the `n_translations` best translations of every
+    source word found in the lexical table, and any word in `extra`,
+    such as the end of sentence and unknown word indices.
+
+    Parameters
+    ----------
+    projection : ShortlistLinear
+        The output projection to restrict.
+    lexical_table : str
+        Path to a pickled dictionary mapping source word indices to lists
+        of target word indices by decreasing probability, see
+        :func:`build_lexical_table`.
+    top_k : int
+        The number of most frequent target words always included.
+    n_translations : int
+        The number of translations included for every source word.
+    extra : list of int
+        Target word indices always included.
+
+    """
+    def __init__(self, projection, lexical_table, top_k, n_translations,
+                 extra=()):
+        self.projection = projection
+        self.n_translations = n_translations
+        self.always = numpy.union1d(numpy.arange(top_k),
+                                    numpy.asarray(extra, dtype='int64'))
+        logger.info("Loading lexical table {}".format(lexical_table))
+        self.table = cPickle.load(open(lexical_table))
+
+    def candidates(self, source):
+        translations = [self.table.get(idx, [])[:self.n_translations]
+                        for idx in set(numpy.asarray(source).flatten())]
+        return numpy.union1d(
+            self.always,
+            numpy.asarray(sum(translations, []), dtype='int64')
+        ).astype('int64')
+
+    def select(self, source):
+        """Gathers the output weights of the candidates of a source."""
+        shortlist = self.candidates(source)
+        self.projection.set_shortlist(shortlist)
+        return shortlist
+
+
+def build_lexical_table(lex_file, src_vocab, trg_vocab, src_vocab_size,
+                        trg_vocab_size, n_translations):
+    """Reads a lexical translation table into word index lists.
+
+    Every line of `lex_file` is of the form ``source target probability``,
+    e.g. a Moses ``lex.e2f`` table with its first two columns swapped.
+    Words out of the vocabularies are skipped.
+    """
+    table = defaultdict(list)
+    for line in open(lex_file):
+        src, trg, prob = line.split()
+        src_idx = src_vocab.get(src, src_vocab_size)
+        trg_idx = trg_vocab.get(trg, trg_vocab_size)
+        if src_idx < src_vocab_size and trg_idx < trg_vocab_size:
+            table[src_idx].append((float(prob), trg_idx))
+    return {src_idx: [trg_idx for _, trg_idx in
+                      sorted(translations, reverse=True)[:n_translations]]
+            for src_idx, translations in table.iteritems()}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("lex_file", help="Lexical translation table")
+    parser.add_argument("src_vocab", help="Pickled source vocabulary")
+    parser.add_argument("trg_vocab", help="Pickled target vocabulary")
+    parser.add_argument("saveto", help="Where to pickle the table")
+    parser.add_argument("--src-vocab-size", type=int, default=40001)
+    parser.add_argument("--trg-vocab-size", type=int, default=40001)
+    parser.add_argument("--n-translations", type=int, default=20)
+    args = parser.parse_args()
+
+    table = build_lexical_table(
+        args.lex_file, cPickle.load(open(args.src_vocab)),
+        cPickle.load(open(args.trg_vocab)), args.src_vocab_size,
+        args.trg_vocab_size, args.n_translations)
+    logger.info("Translations found for {} source words".format(len(table)))
+    cPickle.dump(table, open(args.saveto, 'wb'), protocol=cPickle.HIGHEST_PROTOCOL)
@@ -14,6 +14,9 @@ from fuel.streams import DataStream
 from fuel.transformers import (
     Merge, Batch, Filter, Padding, SortMapping, Unpack, Mapping)
 
+from memory_profile import MemoryCappedBatch, MemoryModel
+from replay import BatchReplay
+
 # Everthing here should be wrapped and parameterized by config
 # this import is to workaround for pickling errors when wrapped
 from model import config
@@ -61,29 +64,57 @@ en_vocab = config['trg_vocab']
 fi_file = config['src_data']
 en_file = config['trg_data']
 
-fi_dataset = TextFile([fi_file], cPickle.load(open(fi_vocab)), None)
-en_dataset = TextFile([en_file], cPickle.load(open(en_vocab)), None)
-
-stream = Merge([fi_dataset.get_example_stream(),
-                en_dataset.get_example_stream()],
-               ('source', 'target'))
-
-stream = Filter(stream, predicate=_too_long(config['seq_len']))
-stream = Mapping(stream, _oov_to_unk(
-                 src_vocab_size=config['src_vocab_size'],
-                 trg_vocab_size=config['trg_vocab_size'],
-                 unk_id=config['unk_id']))
-stream = Batch(stream,
-               iteration_scheme=ConstantScheme(
-                   config['batch_size']*config['sort_k_batches']))
-
-stream = Mapping(stream, SortMapping(_length))
-stream = Unpack(stream)
-stream = Batch(stream, iteration_scheme=ConstantScheme(config['batch_size']))
-masked_stream = Padding(stream)
-masked_stream = Mapping(
-    masked_stream, RemapWordIdx([(0, 0, config['src_eos_idx']),
-                                 (2, 0, config['trg_eos_idx'])]))
+
+def _masked_stream(src_file, trg_file, seq_len=None, batch=None):
+    """Padded batches of the sentence pairs of two text files.
+
+    Groups of `sort_k_batches` batches are sorted by target length before
+    being split into batches, by `batch`, or in batches of `batch_size`
+    pairs by default. Pairs with a sentence longer than `seq_len` are
+    dropped if it is given.
+    """
+    stream = Merge([TextFile([src_file], cPickle.load(open(fi_vocab)),
+                             None).get_example_stream(),
+                    TextFile([trg_file], cPickle.load(open(en_vocab)),
+                             None).get_example_stream()],
+                   ('source', 'target'))
+
+    if seq_len is not None:
+        stream = Filter(stream, predicate=_too_long(seq_len))
+    stream = Mapping(stream, _oov_to_unk(
+                     src_vocab_size=config['src_vocab_size'],
+                     trg_vocab_size=config['trg_vocab_size'],
+                     unk_id=config['unk_id']))
+    stream = Batch(stream,
+                   iteration_scheme=ConstantScheme(
+                       config['batch_size']*config['sort_k_batches']))
+
+    stream = Mapping(stream, SortMapping(_length))
+    stream = Unpack(stream)
+    if batch is not None:
+        stream = batch(stream)
+    else:
+        stream = Batch(stream,
+                       iteration_scheme=ConstantScheme(config['batch_size']))
+    masked_stream = Padding(stream)
+    return Mapping(
+        masked_stream, RemapWordIdx([(0, 0, config['src_eos_idx']),
+                                     (2, 0, config['trg_eos_idx'])]))
+
+
+# Train on recorded batches instead of the text files if necessary
+if config.get('replay_batches'):
+    masked_stream = BatchReplay(config['replay_batches'])
+elif config.get('memory_cap_batches'):
+    # Batches of long sentences can be made smaller to fit in memory
+    memory_model = MemoryModel.load(config['memory_model'])
+    masked_stream = _masked_stream(
+        fi_file, en_file, config['seq_len'],
+        lambda stream: MemoryCappedBatch(stream, config['batch_size'],
+                                         memory_model,
+                                         config['memory_budget']))
+else:
+    masked_stream = _masked_stream(fi_file, en_file, config['seq_len'])
 
 # Setup development set stream if necessary
 dev_stream = None
@@ -91,3 +122,11 @@ if 'val_set' in config and config['val_set']:
     dev_file = config['val_set']
     dev_dataset = TextFile([dev_file], cPickle.load(open(fi_vocab)), None)
     dev_stream = DataStream(dev_dataset)
+
+# Setup development set pairs, batched by length like the training data,
+# for the validation perplexity only
+dev_masked_stream = None
+if config.get('ppl_val_freq') and config.get('val_set') and \
+        config.get('val_set_grndtruth'):
+    dev_masked_stream = _masked_stream(config['val_set'],
+                                       config['val_set_grndtruth'])
@@ -6,8 +6,11 @@ import numpy
 import theano
 from theano import tensor
 from picklable_itertools.extras import equizip
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 
-from blocks.algorithms import GradientDescent, AdaDelta, Scale
+from blocks import config
+from blocks.algorithms import (GradientDescent, CompositeRule, Scale,
+                               BasicMomentum, BasicRMSProp, Adam, AdaDelta)
 from blocks.filter import VariableFilter
 from blocks.bricks.lookup import LookupTable
 from blocks.utils import named_copy, shared_floatx
@@ -16,6 +19,63 @@ from blocks.theano_expressions import l2_norm
 
 logger = logging.getLogger(__name__)
 
+def lookup_subtensors(cg, lookup):
+    """Returns the subtensors of the table taken by each lookup in the graph
+
+    The subtensor is the first input of the reshape giving the output of
+    the lookup, or of any elementwise operation in between, e.g. the
+    noise added by apply_sparse_noise.
+    """
+    assert isinstance(lookup, LookupTable)
+    branches = VariableFilter(bricks=[lookup], name='output_0')(cg)
+    subtensors = []
+    for branch in branches:
+        subtensor = branch.owner.inputs[0].owner.inputs[0]
+        while isinstance(subtensor.owner.op, tensor.Elemwise):
+            subtensor = subtensor.owner.inputs[0]
+        assert isinstance(subtensor.owner.op, tensor.subtensor.AdvancedSubtensor1)
+        subtensors.append(subtensor)
+    return subtensors
+
+def apply_sparse_noise(cg, lookups, level, seed=None):
+    """Adds weight noise to the rows of lookup tables used in the graph
+
+    The noise has the same distribution as the one added to the whole table
+    by apply_noise, one draw per row shared by all the lookups of that row,
+    but is only drawn for the rows actually used.
+
+    Parameters
+    ----------
+    cg : ComputationGraph
+        The ComputationGraph of the model.
+    lookups : list of LookupTable
+        The LookupTable to add noise to.
+    level : float
+        The standard deviation of the noise.
+    seed : int, optional
+        The seed of the random stream, blocks.config.default_seed by default.
+
+    Returns
+    -------
+    A new ComputationGraph with noisy lookup outputs.
+    """
+    if not seed:
+        seed = config.default_seed
+    rng = MRG_RandomStreams(seed)
+    replace = {}
+    for lookup in lookups:
+        subtensors = lookup_subtensors(cg, lookup)
+        indices = [subtensor.owner.inputs[1] % lookup.length for subtensor in subtensors]
+        unique, positions = tensor.extra_ops.Unique(return_inverse=True)(
+            tensor.concatenate(indices, axis=0))
+        noise = rng.normal((unique.shape[0], lookup.dim), std=level)[positions]
+        start = 0
+        for subtensor, indice in zip(subtensors, indices):
+            end = start + indice.shape[0]
+            replace[subtensor] = subtensor + noise[start:end]
+            start = end
+    return cg.replace(replace)
+
 def subtensor_params(cg, lookups):
     """Extract information used by the subtensor fix
     
@@ -30,30 +90,26 @@ def subtensor_params(cg, lookups):
     Returns
     -------
     subtensor_params : dict
-        Dictionary of the form {parameter: (subparam, canonized_indices, outputs, indices)}
+        Dictionary of the form {parameter: (subparam, canonized_indices, positions, outputs, indices)}
         Where :
             - subparam is the subtensor of the parameter contributing to the gradient
             - canonized_indices is the concatenation of indices without repetition such that param[canonized_indices] = subparam
+            - positions is the position in canonized_indices of each element of the concatenation of indices
             - outputs is the list of subtensors in the graph which are result of a lookup
             - indices is the list of indices in the graph which are used in a lookup so that forall i: param[indices[i]] = outputs[i]
     """
 
     def extract_ind_app(lookup):
-        assert isinstance(lookup, LookupTable)
         param = lookup.W
-        branches = VariableFilter(bricks=[lookup], name='output_0')(cg)
-        assert all([
-            isinstance(branch.owner.inputs[0].owner.inputs[0].owner.op,
-                       tensor.subtensor.AdvancedSubtensor1)
-            for branch in branches])
-        outputs = [branch.owner.inputs[0].owner.inputs[0] for branch in branches]
-        indices = [branch.owner.inputs[0].owner.inputs[0].owner.inputs[1] for branch in branches]
+        outputs = lookup_subtensors(cg, lookup)
+        indices = [output.owner.inputs[1] for output in outputs]
         canonized_indices = tensor.concatenate(indices, axis=0)
         canonized_indices = canonized_indices % lookup.length # Replace -1 with lookup.length - 1
-        canonized_indices = tensor.extra_ops.Unique()(tensor.sort(canonized_indices))
+        # Unique sorts its output
+        canonized_indices, positions = tensor.extra_ops.Unique(return_inverse=True)(canonized_indices)
 
         subparam = param[canonized_indices]
-        return {param: (subparam, canonized_indices, outputs, indices)}
+        return {param: (subparam, canonized_indices, positions, outputs, indices)}
 
     r = {}
     for lookup in lookups:
@@ -75,7 +131,7 @@ class GradientDescent_SubtensorFix(GradientDescent):
 
         # For each LookupTable, we replace it by its subtensors appearing in the graph
         params = [param for param in full_params if param not in subtensor_params]
-        for _, (_, _, outputs, _) in subtensor_params.iteritems():
+        for _, (_, _, _, outputs, _) in subtensor_params.iteritems():
             params.extend(outputs)
 
         super(GradientDescent, self).__init__(cost=cost, params=params, **kwargs)
@@ -86,13 +142,13 @@ class GradientDescent_SubtensorFix(GradientDescent):
             equizip(self.params, tensor.grad(self.cost, self.params)))
 
         # We combine the gradients extracted from the same parameter
-        for param, (subparam, canonized_indices, outputs, indices) in subtensor_params.iteritems():
-            # This is necessary if we want to compute the l2 norm correctly (e.g. for StepClipping)
-            tmp = shared_floatx(param.get_value() * 0.)
-            for (output, indice) in zip(outputs, indices):
-                tmp = tensor.inc_subtensor(tmp[indice], self.gradients[output])
-                del self.gradients[output]
-            self.gradients[subparam] = tmp[canonized_indices]
+        for param, (subparam, canonized_indices, positions, outputs, _) in subtensor_params.iteritems():
+            # Repeated indices are summed on the used rows only, instead of in a
+            # dense copy of the parameter. This is necessary if we want to compute
+            # the l2 norm correctly (e.g. for StepClipping)
+            gradients = tensor.concatenate([self.gradients.pop(output) for output in outputs], axis=0)
+            merged = tensor.zeros((canonized_indices.shape[0], param.shape[1]), dtype=param.dtype)
+            self.gradients[subparam] = tensor.inc_subtensor(merged[positions], gradients)
 
         # We remove the subtensors from the list of parameters
         self.params = full_params
@@ -108,75 +164,265 @@ class GradientDescent_SubtensorFix(GradientDescent):
         self.total_step_norm = named_copy(l2_norm(self.steps.values()),
                                           "total_step_norm")
 
-    def initialize(self):
-        all_updates = self.updates
+    def parameter_updates(self):
+        all_updates = []
 
         all_updates.extend([(param, param - self.steps[param]) for param in self.params if param not in self.subtensor_params])
 
         # Instead of substracting the gradient to the whole matrix, we only update the subtensor which is actually used
-        for param, (subparam, canonized_indices, _, _) in self.subtensor_params.iteritems():
+        for param, (subparam, canonized_indices, _, _, _) in self.subtensor_params.iteritems():
             new_value = tensor.inc_subtensor(param[canonized_indices], -self.steps[subparam])
             all_updates.append((param, new_value))
 
         all_updates.extend(self.step_rule_updates)
-        self._function = theano.function(self.inputs, [], updates=all_updates)
+        return all_updates
+
+    def initialize(self):
+        self._function = theano.function(self.inputs, [], updates=self.updates + self.parameter_updates())
+
+
+class AccumulatingGradientDescent(GradientDescent_SubtensorFix):
+    """Gradient descent updating the parameters every few batches.
+
+    The gradients of `n_micro_batches` consecutive batches are summed into
+    shared buffers, and their mean is given to the step rule once, as if
+    the batches had been a single one. The gradients of the lookup tables
+    in `subtensor_params` are not given dense buffers: the rows of every
+    micro-batch are kept with their indices, and at update time they are
+    merged on the rows used by any of the micro-batches, on which only the
+    step is computed and applied. Without `subtensor_params` all gradients
+    are dense, as in GradientDescent.
+
+    Parameters
+    ----------
+    n_micro_batches : int
+        The number of batches whose gradients make an update.
+
+    """
+    def __init__(self, n_micro_batches, *args, **kwargs):
+        super(AccumulatingGradientDescent, self).__init__(*args, **kwargs)
+        self.n_micro_batches = n_micro_batches
+        self.n_batches = 0
+        self._rows = []
 
-class AdaDelta_SubtensorFix(AdaDelta):
+    def initialize(self):
+        accumulate = []
+        replace = {}
+        scale = numpy.asarray(1. / self.n_micro_batches,
+                              dtype=theano.config.floatX)
+        for param in self.params:
+            if param in self.subtensor_params:
+                continue
+            buffer_ = shared_floatx(param.get_value() * 0,
+                                    name=param.name + '_gradient')
+            accumulate.append((buffer_, buffer_ + self.gradients[param]))
+            replace[self.gradients[param]] = buffer_ * scale
+        resets = [(buffer_, tensor.zeros_like(buffer_))
+                  for buffer_, _ in accumulate]
+
+        # The rows of the micro-batches are merged as in
+        # GradientDescent_SubtensorFix, and the step graph is rebuilt on them
+        rows = []
+        row_inputs = []
+        for param, (subparam, canonized_indices, _, _, _) in self.subtensor_params.iteritems():
+            rows.extend([canonized_indices, self.gradients[subparam]])
+            indices = tensor.lvector(param.name + '_indices')
+            gradients = tensor.matrix(param.name + '_rows', dtype=param.dtype)
+            row_inputs.extend([indices, gradients])
+            used_indices, positions = tensor.extra_ops.Unique(
+                return_inverse=True)(indices)
+            merged = tensor.zeros((used_indices.shape[0], param.shape[1]),
+                                  dtype=param.dtype)
+            replace[canonized_indices] = used_indices
+            replace[self.gradients[subparam]] = tensor.inc_subtensor(
+                merged[positions], gradients) * scale
+
+        updates = self.parameter_updates()
+        new_values = theano.clone([value for _, value in updates],
+                                  replace=replace)
+        self._accumulate = theano.function(self.inputs, rows,
+                                           updates=self.updates + accumulate)
+        self._update = theano.function(
+            row_inputs, [],
+            updates=zip([var for var, _ in updates], new_values) + resets)
+
+    def process_batch(self, batch):
+        ordered_batch = [batch[var.name] for var in self.inputs]
+        self._rows.append(self._accumulate(*ordered_batch))
+        self.n_batches += 1
+        if self.n_batches % self.n_micro_batches == 0:
+            self._update(*[numpy.concatenate(parts)
+                           for parts in zip(*self._rows)])
+            self._rows = []
+
+def row_lag(param, indices):
+    """Number of steps since each of the given rows was last updated
+
+    Returns
+    -------
+    time : shared variable
+        The number of steps already computed (+1).
+    lag : tensor
+        For every index, the current time minus the time of the last update
+        of the row, so that lag - 1 updates were skipped.
+    updates : list
+        Updates recording the current step.
+    """
+    time = theano.shared(numpy.int32(1))
+
+    # last_updated contains the last time each row was updated
+    last_updated = theano.shared(numpy.zeros(param.get_value().shape[0], dtype=numpy.int32))
+    last_updated_sub = last_updated[indices]
+
+    # We do the substraction as int in order to mitigate some of the numeric instability
+    lag = tensor.cast(time - last_updated_sub, dtype=theano.config.floatX)
+
+    updates = [(last_updated, tensor.set_subtensor(last_updated_sub, time)),
+               (time, time+1)]
+    return time, lag, updates
+
+class SubtensorStepRule(object):
+    """Mixin for step rules updating lookup tables on used rows only
+
+    Subclasses implement compute_step_subparam, which catches up lazily
+    with the decay of the rows which were skipped since their last update.
+    """
     def __init__(self, subtensor_params={}, *args, **kwargs):
-        super(AdaDelta_SubtensorFix, self).__init__(*args, **kwargs)
+        super(SubtensorStepRule, self).__init__(*args, **kwargs)
         self.subtensor_params = subtensor_params
 
     def compute_steps(self, previous_steps):
-        subparams = [subparam for (subparam, _, _, _) in self.subtensor_params.values()]
+        subparams = [subparam for (subparam, _, _, _, _) in self.subtensor_params.values()]
         keys = [param for param in previous_steps if param not in subparams]
         parameter_wise = [self.compute_step(param, previous_steps[param]) for param in keys]
-        
+
         # We use a special compute_step for lookup tables
-        for param, (subparam, canonized_indices, _, _) in self.subtensor_params.iteritems():
+        for param, (subparam, canonized_indices, _, _, _) in self.subtensor_params.iteritems():
             keys.append(subparam)
             parameter_wise.append(self.compute_step_subparam(param, canonized_indices, previous_steps[subparam]))
 
         steps, updates = equizip(*parameter_wise)
-        steps = OrderedDict((param, step) for param, step 
+        steps = OrderedDict((param, step) for param, step
                             in equizip(keys, steps))
         updates = list(itertools.chain(*updates))
         return steps, updates
 
     def compute_step_subparam(self, param, indices, previous_step):
-        mean_square_step_tm1 = shared_floatx(param.get_value() * 0.)
-        mean_square_delta_x_tm1 = shared_floatx(param.get_value() * 0.)
- 
-        # time is the number of step already computed (+1)
-        time = theano.shared(numpy.int32(1))
-
-        # last_updated contains the last time each row was updated
-        last_updated = theano.shared(numpy.zeros(param.get_value().shape[0], dtype=numpy.int32))
-        last_updated_sub = last_updated[indices]
-
-        # We do the substraction as int on the cpu in order to mitigate some of the numeric instability
-        lag = theano.sandbox.cuda.basic_ops.gpu_from_host(tensor.cast(time - last_updated_sub, dtype=theano.config.floatX))
-        
+        raise NotImplementedError
+
+class Scale_SubtensorFix(Scale):
+    """Scale is stateless, hence it supports subtensors as is"""
+    def __init__(self, subtensor_params={}, *args, **kwargs):
+        super(Scale_SubtensorFix, self).__init__(*args, **kwargs)
+
+class BasicMomentum_SubtensorFix(SubtensorStepRule, BasicMomentum):
+    def compute_step_subparam(self, param, indices, previous_step):
+        velocity = shared_floatx(param.get_value() * 0.,
+                                 name=param.name + '_velocity')
+        _, lag, updates = row_lag(param, indices)
+        velocity_sub = velocity[indices]
+
+        # The velocity kept moving the skipped rows, sum_{k=1}^{lag-1} momentum^k velocity
+        missed_step = tensor.shape_padright(
+            (self.momentum - self.momentum ** lag) / (1. - self.momentum)) * velocity_sub
+        velocity_t = tensor.shape_padright(self.momentum ** lag) * velocity_sub + previous_step
+
+        step = velocity_t + missed_step
+        updates.append((velocity, tensor.set_subtensor(velocity_sub, velocity_t)))
+        return step, updates
+
+class Momentum_SubtensorFix(CompositeRule):
+    def __init__(self, learning_rate=1.0, momentum=0., subtensor_params={}):
+        scale = Scale_SubtensorFix(learning_rate=learning_rate)
+        basic_momentum = BasicMomentum_SubtensorFix(
+            momentum=momentum, subtensor_params=subtensor_params)
+        self.learning_rate = scale.learning_rate
+        self.momentum = basic_momentum.momentum
+        self.components = [scale, basic_momentum]
+
+class BasicRMSProp_SubtensorFix(SubtensorStepRule, BasicRMSProp):
+    def compute_step_subparam(self, param, indices, previous_step):
+        mean_square_step_tm1 = shared_floatx(
+            param.get_value() * 0., name=param.name + '_mean_square_step')
+        _, lag, updates = row_lag(param, indices)
+        mean_square_step_tm1_sub = mean_square_step_tm1[indices]
+
+        # Skipped rows had zero gradients, so they only decayed
+        mean_square_step_t = (
+            tensor.shape_padright(self.decay_rate ** lag) * mean_square_step_tm1_sub +
+            (1 - self.decay_rate) * tensor.sqr(previous_step))
+        rms_step_t = tensor.maximum(tensor.sqrt(mean_square_step_t), self.epsilon)
+
+        step = previous_step / rms_step_t
+        updates.append((mean_square_step_tm1,
+                        tensor.set_subtensor(mean_square_step_tm1_sub, mean_square_step_t)))
+        return step, updates
+
+class RMSProp_SubtensorFix(CompositeRule):
+    def __init__(self, learning_rate=1.0, decay_rate=0.9, max_scaling=1e5, subtensor_params={}):
+        basic_rms_prop = BasicRMSProp_SubtensorFix(
+            decay_rate=decay_rate, max_scaling=max_scaling,
+            subtensor_params=subtensor_params)
+        scale = Scale_SubtensorFix(learning_rate=learning_rate)
+        self.learning_rate = scale.learning_rate
+        self.decay_rate = basic_rms_prop.decay_rate
+        self.components = [basic_rms_prop, scale]
+
+class Adam_SubtensorFix(SubtensorStepRule, Adam):
+    def compute_step_subparam(self, param, indices, previous_step):
+        mean = shared_floatx(param.get_value() * 0.,
+                             name=param.name + '_mean')
+        variance = shared_floatx(param.get_value() * 0.,
+                                 name=param.name + '_variance')
+        time, lag, updates = row_lag(param, indices)
+        t1 = tensor.cast(time, dtype=theano.config.floatX)
+
+        learning_rate = (self.learning_rate *
+                         tensor.sqrt((1. - (1. - self.beta2)**t1)) /
+                         (1. - (1. - self.beta1)**t1))
+        beta_1t = 1 - (1 - self.beta1) * self.decay_factor ** (t1 - 1)
+
+        # Like the other rules the moments of skipped rows are decayed,
+        # but the steps their mean would have taken are not applied
+        mean_sub = mean[indices]
+        variance_sub = variance[indices]
+        mean_t = (beta_1t * previous_step +
+                  tensor.shape_padright((1. - beta_1t) ** lag) * mean_sub)
+        variance_t = (self.beta2 * tensor.sqr(previous_step) +
+                      tensor.shape_padright((1. - self.beta2) ** lag) * variance_sub)
+
+        step = learning_rate * mean_t / (tensor.sqrt(variance_t) + self.epsilon)
+        updates.extend([(mean, tensor.set_subtensor(mean_sub, mean_t)),
+                        (variance, tensor.set_subtensor(variance_sub, variance_t))])
+        return step, updates
+
+class AdaDelta_SubtensorFix(SubtensorStepRule, AdaDelta):
+    def compute_step_subparam(self, param, indices, previous_step):
+        mean_square_step_tm1 = shared_floatx(
+            param.get_value() * 0., name=param.name + '_mean_square_step')
+        mean_square_delta_x_tm1 = shared_floatx(
+            param.get_value() * 0., name=param.name + '_mean_square_delta_x')
+        _, lag, updates = row_lag(param, indices)
+
         # We only update the relevant subtensors
         mean_square_delta_x_tm1_sub = mean_square_delta_x_tm1[indices]
         mean_square_step_tm1_sub = mean_square_step_tm1[indices]
- 
+
         mean_square_step_t = tensor.set_subtensor(mean_square_step_tm1_sub,
                 tensor.shape_padright(self.decay_rate ** lag) * mean_square_step_tm1_sub +
                 (1 - self.decay_rate) * tensor.sqr(previous_step)
             )
- 
+
         rms_delta_x_tm1 = tensor.sqrt(mean_square_delta_x_tm1_sub * tensor.shape_padright(self.decay_rate ** (lag-1.)) + self.epsilon)
         rms_step_t = tensor.sqrt(mean_square_step_t[indices] + self.epsilon)
         delta_x_t = rms_delta_x_tm1 / rms_step_t * previous_step
- 
+
         mean_square_delta_x_t = tensor.set_subtensor(mean_square_delta_x_tm1_sub,
                 tensor.shape_padright(self.decay_rate ** lag) * mean_square_delta_x_tm1_sub +
                 (1 - self.decay_rate) * tensor.sqr(delta_x_t)
             )
- 
+
         step = delta_x_t
-        updates = [(mean_square_step_tm1, mean_square_step_t),
-                   (mean_square_delta_x_tm1, mean_square_delta_x_t),
-                   (last_updated, tensor.set_subtensor(last_updated_sub, time)),
-                   (time, time+1)]
+        updates.extend([(mean_square_step_tm1, mean_square_step_t),
+                        (mean_square_delta_x_tm1, mean_square_delta_x_t)])
         return step, updates
@@ -0,0 +1,152 @@
+# Training log keeping only recent rows in memory
+import cPickle
+import logging
+import os
+import re
+from collections import defaultdict, deque
+
+import numpy
+
+from blocks.log import TrainingLog
+
+logger = logging.getLogger(__name__)
+
+RECORD = numpy.dtype([('iteration', 'int64'), ('value', 'float64')])
+
+
+class ColumnarTrainingLog(TrainingLog):
+    """Training log appending old rows to files, one per channel.
+
+    Only the rows of the last `window` iterations are kept in memory.
+    Older rows are buffered and appended every `chunk_size` rows to the
+    files of `directory`: numeric entries to binary files of (iteration,
+    value) records, one per channel, and other entries to a stream of
+    pickled (iteration, name, value) tuples. Pickling the log, as done by
+    Dump, therefore takes a constant time, as does loading it back.
+
+    Call :meth:`flush` before pickling, so that the files hold all the
+    rows out of the window, and :meth:`truncate` after unpickling, to
+    drop what was written to the files after the log was pickled.
+
+    Rows of iterations out of the window are read back from the buffer
+    and the files, which is slow, and are not added to the log again. A
+    KeyError is raised for past iterations without any entry.
+
+    Parameters
+    ----------
+    directory : str
+        Where to write the files.
+    window : int
+        The number of rows kept in memory.
+    chunk_size : int
+        The number of rows written at once.
+
+    """
+    def __init__(self, directory, window=1000, chunk_size=1000):
+        super(ColumnarTrainingLog, self).__init__()
+        self.directory = directory
+        self.window = window
+        self.chunk_size = chunk_size
+        self.recent = deque()
+        self.evicted = []
+        self.filenames = {}
+        self.sizes = {}
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def __reduce__(self):
+        reduced = list(super(ColumnarTrainingLog, self).__reduce__())
+        reduced[1] = (self.directory, self.window, self.chunk_size)
+        reduced[2] = self.__dict__
+        return tuple(reduced)
+
+    def __missing__(self, time):
+        if self.recent and time <= self.recent[-1]:
+            return self._past_row(time)
+        row = super(ColumnarTrainingLog, self).__missing__(time)
+        self.recent.append(time)
+        while len(self.recent) > self.window:
+            old = self.recent.popleft()
+            if old in self:
+                self.evicted.append((old, dict.pop(self, old)))
+        if len(self.evicted) >= self.chunk_size:
+            self.flush()
+        return row
+
+    def _past_row(self, time):
+        """The row of an iteration out of the window."""
+        for old, row in self.evicted:
+            if old == time:
+                return dict(row)
+        row = {}
+        for name in self.filenames:
+            if os.path.exists(self._path(name)):
+                records = numpy.fromfile(self._path(name), dtype=RECORD)
+                values = records['value'][records['iteration'] == time]
+                if len(values):
+                    row[name] = values[-1]
+        path = os.path.join(self.directory, 'others.pkl')
+        if os.path.exists(path):
+            with open(path, 'rb') as stream:
+                while True:
+                    try:
+                        old, name, value = cPickle.load(stream)
+                    except EOFError:
+                        break
+                    if old == time:
+                        row[name] = value
+        if not row:
+            raise KeyError(time)
+        return row
+
+    def _path(self, name):
+        if name not in self.filenames:
+            self.filenames[name] = re.sub(r'[^\w.-]', '_', name) + '.bin'
+        return os.path.join(self.directory, self.filenames[name])
+
+    def flush(self):
+        """Appends the rows out of the window to the files."""
+        channels = defaultdict(list)
+        others = []
+        for time, row in self.evicted:
+            for name, value in row.items():
+                if (numpy.ndim(value) == 0 and
+                        numpy.issubdtype(numpy.asarray(value).dtype,
+                                         numpy.number)):
+                    channels[name].append((time, value))
+                else:
+                    others.append((time, name, value))
+        self.evicted = []
+
+        for name, records in channels.items():
+            path = self._path(name)
+            with open(path, 'ab') as column:
+                numpy.array(records, dtype=RECORD).tofile(column)
+            self.sizes[path] = os.path.getsize(path)
+        if others:
+            path = os.path.join(self.directory, 'others.pkl')
+            with open(path, 'ab') as stream:
+                for record in others:
+                    cPickle.dump(record, stream,
+                                 protocol=cPickle.HIGHEST_PROTOCOL)
+            self.sizes[path] = os.path.getsize(path)
+
+    def truncate(self):
+        """Drops what was written to the files after the last flush."""
+        for path, size in self.sizes.items():
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                logger.info("Truncating {} to {} bytes".format(path, size))
+                with open(path, 'r+b') as column:
+                    column.truncate(size)
+
+    def channel(self, name):
+        """All the (iteration, value) records of a numeric channel."""
+        records = [numpy.fromfile(self._path(name), dtype=RECORD)
+                   if os.path.exists(self._path(name))
+                   else numpy.zeros(0, dtype=RECORD)]
+        rows = self.evicted + [(time, dict.get(self, time, {}))
+                               for time in self.recent]
+        records.append(numpy.array(
+            [(time, row[name]) for time, row in rows if name in row],
+            dtype=RECORD))
+        return numpy.concatenate(records)